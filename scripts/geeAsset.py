@@ -5,7 +5,11 @@ from ee.batch import Export
 from datetime import date
 from datetime import datetime, timedelta
 import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tethysapp.waterwatch import config
+from tethysapp.waterwatch import export_watermarks
 
 try:
     credentials = ee.ServiceAccountCredentials(config.EE_SERVICE_ACCOUNT,
@@ -14,6 +18,28 @@ try:
 except:
     ee.Initialize()
 
+# exports submitted in parallel
+EXPORT_CONCURRENCY = getattr(config, 'EXPORT_CONCURRENCY', 4)
+# EE refuses new tasks beyond 3000 queued ones per user, stay below
+MAX_QUEUED_TASKS = getattr(config, 'EE_MAX_QUEUED_TASKS', 2500)
+QUEUE_POLL_SECONDS = 60
+# attempts after the first failure of task.start() and the first delay between them (doubled each time)
+EXPORT_RETRIES = getattr(config, 'EXPORT_RETRIES', 5)
+EXPORT_BACKOFF = getattr(config, 'EXPORT_BACKOFF', 2)
+
+# export tasks are described as TASK_PREFIX + image name so pending ones can be recognised
+TASK_PREFIX = 'ewf_ponds_'
+# newest acquisition per region up to which every image is in the asset folder, see export_watermarks
+WATERMARK_PATH = getattr(config, 'EXPORT_WATERMARK_PATH',
+                         os.path.join(os.path.dirname(os.path.abspath(__file__)), 'watermarks.json'))
+
+# an image still missing from the folder after this many export attempts is no longer exported
+# and no longer holds the watermark back
+EXPORT_MAX_ATTEMPTS = getattr(config, 'EXPORT_MAX_ATTEMPTS', 3)
+
+_queue = {'count': None}
+_queue_lock = threading.Lock()
+
 
 def landsatQaMask(img):
     """Custom QA masking method for Landsat surface reflectance dataset
@@ -269,43 +295,130 @@ def watermapping(img):
     return out
 
 
+def reserve_queue_slot():
+    """Wait until EE accepts one more queued export task, then count it as queued
+
+    The number of queued (READY) tasks is read from the task list and then tracked locally,
+    it is only read again once the limit is reached.
+    """
+    with _queue_lock:
+        while True:
+            if _queue['count'] is None or _queue['count'] >= MAX_QUEUED_TASKS:
+                _queue['count'] = sum(1 for t in ee.batch.Task.list() if t.state == ee.batch.Task.State.READY)
+            if _queue['count'] < MAX_QUEUED_TASKS:
+                _queue['count'] += 1
+                return
+            print(f"{_queue['count']} tasks queued, waiting for room...")
+            time.sleep(QUEUE_POLL_SECONDS)
+
+
+def start_export(image, name, asset_id):
+    """Submit the export of one image, retried with exponential backoff
+    """
+    outScale = 30 if "LC08" in name else 10
+    task = ee.batch.Export.image.toAsset(image=image, description=(TASK_PREFIX + name)[:100],
+                                         assetId=asset_id + name,
+                                         scale=outScale,
+                                         maxPixels=1.0E13, region=image.geometry())
+    reserve_queue_slot()
+    for attempt in range(EXPORT_RETRIES + 1):
+        try:
+            task.start()
+            print(f"Started export of {name}")
+            return name
+        except Exception as e:
+            if attempt == EXPORT_RETRIES:
+                raise
+            delay = EXPORT_BACKOFF * 2 ** attempt
+            print(f"Export of {name} failed ({e}), retrying in {delay}s")
+            time.sleep(delay)
+            while not is_connected():
+                print("No connection: sleeping")
+                time.sleep(1)
+
+
+def existing_assets(asset_id):
+    """Names (as appended to asset_id) of the images already in the target folder, listed once
+    """
+    parent, prefix = asset_id.rsplit('/', 1)
+    names = set()
+    token = None
+    while True:
+        params = {'parent': parent}
+        if token:
+            params['pageToken'] = token
+        response = ee.data.listAssets(params)
+        for asset in response.get('assets', []):
+            base = (asset.get('id') or asset['name']).rsplit('/', 1)[-1]
+            if base.startswith(prefix):
+                names.add(base[len(prefix):])
+        token = response.get('nextPageToken')
+        if not token:
+            return names
+
+
+def pending_exports():
+    """Names of the images with an export task still queued or running
+    """
+    active = (ee.batch.Task.State.READY, ee.batch.Task.State.RUNNING)
+    return set(t.config.get('description', '')[len(TASK_PREFIX):] for t in ee.batch.Task.list()
+               if t.state in active and t.config.get('description', '').startswith(TASK_PREFIX))
+
+
+def region_start(region_name):
+    """Start of the date range of a region: a week back, or the watermark when it is older
+
+    The week is always reprocessed so late scenes and failed exports are picked up, only the
+    images that are missing from the folder are exported again.
+    """
+    start = datetime.today() - timedelta(days=7)
+    watermark = export_watermarks.loadWatermarks(WATERMARK_PATH).get(region_name)
+    if watermark is not None and 'time_start' in watermark:
+        start = min(start, datetime.utcfromtimestamp(watermark['time_start'] / 1000))
+    return ee.Date(start.strftime('%Y-%m-%d'))
+
+
 def process_data(geometry, asset_id, region_name):
+    iniDate = region_start(region_name)
     print("running: " + region_name + " from: " + iniDate.format('YYYY-MM-dd').getInfo() + " to " + endDate.format('YYYY-MM-dd').getInfo())
     mergedCollection = mergeCollections(LC, S2, geometry, iniDate, endDate).sort('system:time_start', False)
     # apply the multi-threshod water mapping process
     processedCollection = mergedCollection.map(watermapping)
-    # get some info for exports
-    wqImages = processedCollection.size().getInfo()
-    wqicList = processedCollection.toList(wqImages)
-    print(f"Attemping to export {wqImages} images...")
-    # loop through the imagery to export
-    for i in range(wqImages):
-        if i < 0:
-            print("Skipping: " + str(i))
-        else:
+    # all the image names and times in one request
+    info = ee.Dictionary({
+        'names': processedCollection.aggregate_array('system:index'),
+        'times': processedCollection.aggregate_array('system:time_start'),
+    }).getInfo()
+    names, times = info['names'], info['times']
+    wqicList = processedCollection.toList(len(names))
+
+    # only export what is neither in the folder nor on its way there, nor given up
+    existing = existing_assets(asset_id)
+    entry = export_watermarks.loadWatermarks(WATERMARK_PATH).get(region_name, {})
+    skipped = export_watermarks.givenUp(entry, EXPORT_MAX_ATTEMPTS) - existing
+    done = existing | pending_exports() | skipped
+    missing = [i for i, name in enumerate(names) if name not in done]
+    if skipped:
+        print(f"{len(skipped)} images given up after {EXPORT_MAX_ATTEMPTS} attempts: {', '.join(sorted(skipped))}")
+    print(f"{len(names)} images, {len(names) - len(missing)} already exported, attemping to export {len(missing)} images...")
+    # submit the exports side by side, each image is only a lazy reference until its task starts
+    failed = set()
+    with ThreadPoolExecutor(max_workers=EXPORT_CONCURRENCY) as pool:
+        futures = dict((pool.submit(start_export, ee.Image(wqicList.get(i)), names[i], asset_id), i) for i in missing)
+        for future in as_completed(futures):
             try:
-                print("In export loop: " + str(i))
-                thisImg = ee.Image(wqicList.get(i))
-                name = thisImg.get('system:index').getInfo()
-                outScale = 30 if "LC08" in name else 10
-                print(f"Image name:{name}")
-                task = ee.batch.Export.image.toAsset(image=thisImg, description='ewf_ponds',
-                                                     assetId=asset_id + name,
-                                                     scale=outScale,
-                                                     maxPixels=1.0E13, region=thisImg.geometry())
-                while not is_connected:
-                    print("No connection: sleeping")
-                    time.sleep(1)
-                try:
-                    task.start()
-                except:
-                    while not is_connected():
-                        print("No connection: sleeping")
-                        time.sleep(1)
-                    task.start()
+                future.result()
             except Exception as e:
-                print(e)
-                continue
+                failed.add(futures[future])
+                print(f"Export of {names[futures[future]]} failed: {e}")
+    print(f"{region_name}: {len(missing) - len(failed)} exports started, {len(failed)} failed")
+
+    # the watermark only moves past images whose asset is in the folder (a started export may
+    # still fail, it is confirmed by the listing of a later run) or that were given up
+    watermarks = export_watermarks.loadWatermarks(WATERMARK_PATH)
+    watermarks[region_name] = export_watermarks.advance(
+        watermarks.get(region_name), names, times, existing, set(names[i] for i in missing), EXPORT_MAX_ATTEMPTS)
+    export_watermarks.saveWatermarks(WATERMARK_PATH, watermarks)
 
 
 # sentinel2 band pass adjustment coefficients
@@ -346,9 +459,7 @@ region_info = json.load(f)
 
 f.close()
 
-# change dates to range to process
-iniDate = ee.Date((datetime.today() - timedelta(days=7)).strftime('%Y-%m-%d'))  # 1 week prior
-
+# change dates to range to process, the start of each region comes from region_start
 endDate = ee.Date(ee.Date(datetime.today().strftime('%Y-%m-%d')))  # today
 
 for region in region_info["regions"]:
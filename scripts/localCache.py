@@ -0,0 +1,151 @@
+"""Maintenance commands for the local copies of Earth Engine data used by the WaterWatch app
+
+Run from a crontab or by hand, e.g.
+    python scripts/localCache.py snapshot
+    python scripts/localCache.py check ponds
+    python scripts/localCache.py timeseries
+    python scripts/localCache.py rollups
+    python scripts/localCache.py hypsometry
+    python scripts/localCache.py forecast
+    python scripts/localCache.py classes
+    python scripts/localCache.py acquisitions
+    python scripts/localCache.py snapshot village && python scripts/localCache.py villagetiles
+"""
+import argparse
+import logging
+import sys
+
+from tethysapp.waterwatch import spatial_index
+from tethysapp.waterwatch import utilities  # registers the Earth Engine layers
+
+
+def _names(args):
+    unknown = [name for name in args.names if name not in spatial_index.SNAPSHOTS]
+    if unknown:
+        raise SystemExit(f"Unknown collection(s): {', '.join(unknown)}")
+    return args.names or list(spatial_index.SNAPSHOTS)
+
+
+def snapshot(args):
+    for name in _names(args):
+        count = spatial_index.refreshSnapshot(name)
+        print(f"{name}: saved {count} features to {spatial_index.snapshotPath(name)}")
+    return 0
+
+
+def check(args):
+    status = 0
+    for name in _names(args):
+        result = spatial_index.checkSnapshot(name)
+        state = "ok" if result['consistent'] else "out of date"
+        print(f"{name}: {state} ({result['local']} local, {result['server']} on server, "
+              f"{len(result['missing'])} missing, {len(result['extra'])} extra)")
+        if not result['consistent']:
+            status = 1
+    return status
+
+
+def timeseries(args):
+    for stats in utilities.updateTimeSeriesStore(args.ponds or None):
+        print(f"{stats['images']} images, {stats['reductions']} pond reductions, "
+              f"{stats['added']} acquisitions appended in {stats['seconds']:.1f}s "
+              f"({stats['pondsPerSecond']:.1f} ponds/sec)")
+    # the admin unit rollups follow the store
+    return rollups(argparse.Namespace(full=False))
+
+
+def rollups(args):
+    from tethysapp.waterwatch import rollups
+
+    days = rollups.updateRollups(full=args.full)
+    print(f"Admin unit rollups: {days} days recomputed")
+    return 0
+
+
+def hypsometry(args):
+    from tethysapp.waterwatch import hypsometry
+
+    count = hypsometry.rebuildTable()
+    print(f"Saved the DEM constants of {count} ponds to {hypsometry.tablePath()}")
+    return 0
+
+
+def forecast(args):
+    from tethysapp.waterwatch import forecast_batch
+
+    count, timings = forecast_batch.runBatch()
+    print(f"Forecast {count} ponds in {sum(timings.values()):.1f}s")
+    for stage, seconds in timings.items():
+        print(f"  {stage}: {seconds:.1f}s")
+    return 0
+
+
+def classes(args):
+    from tethysapp.waterwatch import pond_classes
+
+    result = pond_classes.refreshClasses()
+    print(f"Classified {len(result['classes'])} ponds for the acquisition of {result['acquisition']}")
+    return 0
+
+
+def acquisitions(args):
+    from tethysapp.waterwatch import acquisitions
+
+    added = acquisitions.refreshCatalog(full=args.full)
+    print(f"Added {added} images to {acquisitions.catalogPath()}")
+    return 0
+
+
+def villagetiles(args):
+    from tethysapp.waterwatch import village_tiles
+
+    count = village_tiles.seedTiles(args.max_zoom)
+    print(f"{count} village tiles up to date")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    cmd = commands.add_parser('snapshot', help='download GeoJSON snapshots of the pond, admin and village collections')
+    cmd.add_argument('names', nargs='*', help='collections to process, all by default')
+    cmd.set_defaults(func=snapshot)
+
+    cmd = commands.add_parser('check', help='compare the local snapshots with the server collections')
+    cmd.add_argument('names', nargs='*', help='collections to process, all by default')
+    cmd.set_defaults(func=check)
+
+    cmd = commands.add_parser('timeseries', help='append new acquisitions to the local pond time series store')
+    cmd.add_argument('--ponds', nargs='*', type=int, help='uniqIDs to update, every pond in the snapshot by default')
+    cmd.set_defaults(func=timeseries)
+
+    cmd = commands.add_parser('rollups', help='update the water statistics of the regions, communes and arrondissements')
+    cmd.add_argument('--full', action='store_true', help='recompute every day instead of the new ones')
+    cmd.set_defaults(func=rollups)
+
+    cmd = commands.add_parser('hypsometry', help='rebuild the per pond DEM constants used by the forecast')
+    cmd.set_defaults(func=hypsometry)
+
+    cmd = commands.add_parser('forecast', help='precompute the 15 day forecast of every pond')
+    cmd.set_defaults(func=forecast)
+
+    cmd = commands.add_parser('classes', help='rerun the pond classification for the latest acquisition')
+    cmd.set_defaults(func=classes)
+
+    cmd = commands.add_parser('acquisitions', help='add new processed_ponds images to the local acquisition catalog')
+    cmd.add_argument('--full', action='store_true', help='rebuild the catalog from scratch')
+    cmd.set_defaults(func=acquisitions)
+
+    cmd = commands.add_parser('villagetiles', help='render the village vector tiles from the village snapshot')
+    cmd.add_argument('--max-zoom', type=int, help='highest zoom level to render, VILLAGE_TILE_MAX_ZOOM by default')
+    cmd.set_defaults(func=villagetiles)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
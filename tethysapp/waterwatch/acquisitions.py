@@ -0,0 +1,188 @@
+import bisect
+import logging
+import threading
+
+import ee
+import numpy as np
+
+from .layers import getLayer
+from .pond_classes import latestAcquisition
+from .spatial_index import downloadCollection, rings, ringsIntersect
+from .storage import dataPath, atomicFile, modifiedTime
+
+log = logging.getLogger(__name__)
+
+# acquisition of a chart point: the image taken within this window after the clicked time
+MATCH_WINDOW = 2 * 24 * 3600 * 1000
+
+
+def catalogPath():
+    return dataPath('acquisitions.npz')
+
+
+def sensorOf(index):
+    """LC08 or S2 from the system:index of a processed_ponds image, None when it is not recognised
+    """
+    if 'LC08' in index or 'LC8' in index:
+        return 'LC08'
+    if 'S2' in index or index[:8].isdigit():
+        # Sentinel-2 indexes start with the acquisition date, 20190105T113451_...
+        return 'S2'
+    return None
+
+
+def _describe(image):
+    bounds = ee.List(image.geometry().bounds().coordinates().get(0))
+    return ee.Feature(image.geometry(), {
+        'id': image.get('system:id'),
+        'index': image.get('system:index'),
+        'time': image.get('system:time_start'),
+        'cloud': image.get('CLOUD_COVER'),
+        'lower': bounds.get(0),
+        'upper': bounds.get(2),
+    })
+
+
+def _arrays(rows):
+    """Catalog arrays of image rows, the footprint of each row is a GeoJSON geometry
+
+    Footprints are kept as vertex counts per ring and ring counts per image so catalogs concatenate.
+    """
+    rows = sorted(rows, key=lambda r: r['time'])
+    footprints = [rings(r['footprint']) for r in rows]
+    return {
+        'id': np.array([r['id'] for r in rows], dtype=str),
+        'time': np.array([r['time'] for r in rows], dtype=np.int64),
+        'bbox': np.array([r['lower'] + r['upper'] for r in rows], dtype=np.float64).reshape(-1, 4),
+        'sensor': np.array([sensorOf(r['index']) or '' for r in rows], dtype=str),
+        'cloud': np.array([np.nan if r.get('cloud') is None else r['cloud'] for r in rows], dtype=np.float64),
+        'ringCount': np.array([len(f) for f in footprints], dtype=np.int64),
+        'ringSize': np.array([len(ring) for f in footprints for ring in f], dtype=np.int64),
+        'vertices': np.concatenate([ring for f in footprints for ring in f] or [np.empty((0, 2))]),
+    }
+
+
+def refreshCatalog(full=False):
+    """Add the images of the water collection newer than the catalog, or rebuild it when full is set
+
+    Returns the number of images added.
+    """
+    old = None if full else loadCatalog()
+    collection = getLayer('waterCollection')
+    if old is not None and len(old['time']):
+        collection = collection.filter(ee.Filter.gt('system:time_start', int(old['time'][-1])))
+    rows = [dict(f['properties'], footprint=f['geometry'])
+            for f in downloadCollection(ee.FeatureCollection(collection.map(_describe)))]
+    new = _arrays(rows)
+    if old is not None:
+        new = dict((k, np.concatenate([old[k], new[k]])) for k in new)
+    with atomicFile(catalogPath()) as f:
+        np.savez(f, **new)
+    log.info("Acquisition catalog: %d images added, %d in total", len(rows), len(new['time']))
+    return len(rows)
+
+
+_catalog = None
+_lock = threading.Lock()
+
+
+def loadCatalog():
+    """Catalog arrays sorted by time (id, time, bbox, sensor, cloud, footprints), None when it was never built
+
+    A catalog written before the footprints were stored is not loaded, so it is rebuilt on the next refresh.
+    """
+    global _catalog
+    mtime = modifiedTime(catalogPath())
+    if mtime is None:
+        return None
+    if _catalog is None or _catalog[0] != mtime:
+        with _lock:
+            if _catalog is None or _catalog[0] != mtime:
+                with np.load(catalogPath()) as data:
+                    catalog = dict((k, data[k]) for k in data.files)
+                if 'ringCount' not in catalog:
+                    log.warning("The acquisition catalog has no footprints, run localCache.py acquisitions")
+                    return None
+                catalog['times'] = catalog['time'].tolist()
+                catalog['ringFirst'] = np.concatenate([[0], np.cumsum(catalog['ringCount'])])
+                catalog['vertexFirst'] = np.concatenate([[0], np.cumsum(catalog['ringSize'])])
+                _catalog = (mtime, catalog)
+    return _catalog[1]
+
+
+def isCurrent(catalog):
+    """True when the catalog holds the newest image of the collection
+    """
+    try:
+        newest = latestAcquisition()
+    except Exception as e:
+        log.warning("Could not check for new images: %s", e)
+        return True
+    return newest is None or bool(len(catalog['times']) and catalog['times'][-1] >= newest)
+
+
+def _current():
+    catalog = loadCatalog()
+    if catalog is None or not isCurrent(catalog):
+        return None
+    return catalog
+
+
+def footprint(catalog, i):
+    """Rings of the footprint of image i as (n, 2) arrays
+    """
+    first, last = catalog['ringFirst'][i], catalog['ringFirst'][i + 1]
+    starts = catalog['vertexFirst']
+    return [catalog['vertices'][starts[r]:starts[r + 1]] for r in range(first, last)]
+
+
+def covers(catalog, pond, candidates):
+    """The candidate images whose footprint intersects the pond rings, in order, as filterBounds does
+
+    Footprint bboxes are compared first, only the images they keep get the polygon test.
+    """
+    vertices = np.concatenate(pond)
+    west, south = vertices.min(axis=0)
+    east, north = vertices.max(axis=0)
+    b = catalog['bbox'][candidates]
+    near = candidates[(b[:, 0] <= east) & (b[:, 1] <= north) & (b[:, 2] >= west) & (b[:, 3] >= south)]
+    for i in near:
+        if ringsIntersect(footprint(catalog, i), pond):
+            yield int(i)
+
+
+def find(time, geometry, window=MATCH_WINDOW):
+    """First image over a pond GeoJSON geometry acquired in [time, time + window), as a row dict, or None
+
+    None is also returned without an up to date catalog, callers then search the collection on the server.
+    """
+    catalog = _current()
+    pond = rings(geometry)
+    if catalog is None or not pond:
+        return None
+    times = catalog['times']
+    start = bisect.bisect_left(times, int(time))
+    stop = bisect.bisect_left(times, int(time) + window)
+    i = next(covers(catalog, pond, np.arange(start, stop)), None)
+    return None if i is None else row(catalog, i)
+
+
+def latest(geometry):
+    """Newest image over a pond GeoJSON geometry as a row dict, None without an up to date catalog or an image
+    """
+    catalog = _current()
+    pond = rings(geometry)
+    if catalog is None or not pond:
+        return None
+    i = next(covers(catalog, pond, np.arange(len(catalog['times']))[::-1]), None)
+    return None if i is None else row(catalog, i)
+
+
+def row(catalog, i):
+    return {
+        'id': str(catalog['id'][i]),
+        'time': int(catalog['time'][i]),
+        'bbox': catalog['bbox'][i].tolist(),
+        'sensor': str(catalog['sensor'][i]) or None,
+        'cloud': None if np.isnan(catalog['cloud'][i]) else float(catalog['cloud'][i]),
+    }
@@ -1,9 +1,29 @@
 from .utilities import *
+from . import ee_client
+from . import metrics
+from . import jobs
 import json
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponse, HttpResponseNotModified
 import datetime
+from django.utils.http import parse_etags
 from django.views.decorators.csrf import csrf_exempt
+
+
+def _weak(etag):
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+def etagMatches(ifNoneMatch, etag):
+    """Weak comparison of an If-None-Match header with an ETag
+
+    Proxies that compress the response (nginx gzip) turn the ETag into a weak W/"..." one, and a
+    header may list several tags.
+    """
+    tags = parse_etags(ifNoneMatch or '')
+    return '*' in tags or _weak(etag) in [_weak(t) for t in tags]
+
 @csrf_exempt
+@ee_client.requestScope
 def getPondsUrl(request):
 
     return_obj = {}
@@ -12,7 +32,7 @@ def getPondsUrl(request):
     if request.is_ajax() and request.method == 'POST':
 
         try:
-            return_obj["url"]= initLayers()
+            return_obj["url"]= ee_client.call(initLayers)
             return_obj["success"] = "success"
 
         except Exception as e:
@@ -20,26 +40,30 @@ def getPondsUrl(request):
     return JsonResponse(return_obj)
 
 @csrf_exempt
+@ee_client.requestScope
 def getPondsList(request):
 
     return_obj = {}
-    centers=[]
-    names=[]
 
 
-    if request.is_ajax() and request.method == 'POST':
+    if request.is_ajax() and request.method in ('GET', 'POST'):
 
         try:
-            names,centers= pondsList()
-            return_obj["centers"]=centers
-            return_obj["names"]=names
-
-            return_obj["success"] = "success"
+            etag, body = ee_client.call(pond_catalog.getCatalog)
+            # the browser revalidates with If-None-Match and keeps its copy while the catalog is unchanged
+            if etagMatches(request.META.get('HTTP_IF_NONE_MATCH'), etag):
+                response = HttpResponseNotModified()
+            else:
+                response = HttpResponse(body, content_type='application/json')
+            response['ETag'] = etag
+            response['Cache-Control'] = 'no-cache'
+            return response
 
         except Exception as e:
             return_obj["error"] = "Error Processing Request. Error: "+ str(e)
     return JsonResponse(return_obj)
 
+@ee_client.requestScope
 def timeseries(request):
 
     return_obj = {}
@@ -52,7 +76,7 @@ def timeseries(request):
         lon = info.get('lon')
 
         try:
-            ts_vals,coordinates,name = checkFeature(lon,lat)
+            ts_vals,coordinates,name = ee_client.call(checkFeature, lon, lat, prefetch=True, **seriesOptions(info))
             return_obj["values"] = ts_vals
             return_obj["coordinates"] = coordinates
             return_obj["name"] = name
@@ -62,6 +86,7 @@ def timeseries(request):
             return_obj["error"] = "Error Processing Request. Error: "+ str(e)
     return JsonResponse(return_obj)
 
+@ee_client.requestScope
 def forecast(request):
 
     return_obj = {}
@@ -70,7 +95,7 @@ def forecast(request):
         lat = info.get('lat')
         lon = info.get('lon')
     try:
-        ts_vals,coordinates,name = forecastFeature(lon,lat)
+        ts_vals,coordinates,name = ee_client.call(forecastFeature, lon, lat)
         return_obj["values"] = ts_vals
         return_obj["coordinates"] = coordinates
         return_obj["name"] = name
@@ -79,6 +104,41 @@ def forecast(request):
         return_obj["error"] = "Error Processing Request. Error: "+ str(e)
     return JsonResponse(return_obj)
 
+def submitJob(request):
+
+    return_obj = {}
+
+    if request.is_ajax() and request.method == 'POST':
+
+        info = request.POST
+        try:
+            options = seriesOptions(info) if info.get('kind') == 'timeseries' else None
+            return_obj["job"] = jobs.submit(info.get('kind'), info.get('lon'), info.get('lat'), options)
+            return_obj["success"] = "success"
+
+        except Exception as e:
+            return_obj["error"] = "Error Processing Request. Error: "+ str(e)
+    return JsonResponse(return_obj)
+
+def jobStatus(request):
+
+    return_obj = {}
+
+    if request.is_ajax():
+
+        try:
+            state = jobs.status(request.GET.get('job') or request.POST.get('job'))
+            if state is None:
+                return_obj["error"] = "Error Processing Request. Error: unknown job"
+            else:
+                return_obj.update(state)
+                return_obj["success"] = "success"
+
+        except Exception as e:
+            return_obj["error"] = "Error Processing Request. Error: "+ str(e)
+    return JsonResponse(return_obj)
+
+@ee_client.requestScope
 def mndwi(request):
     return_obj = {}
 
@@ -92,17 +152,26 @@ def mndwi(request):
         lon = info.get('lon')
 
         try:
-            true_img,mndwi_img,properties = getMNDWI(lon,lat,x_val,y_val)
-            return_obj['water_mapurl'] = mndwi_img['tile_fetcher'].url_format
-            return_obj['true_mapurl'] = true_img['tile_fetcher'].url_format
+            urls = ee_client.call(getMNDWI, lon, lat, x_val, y_val)
+            return_obj['water_mapurl'] = urls['water_mapurl']
+            return_obj['true_mapurl'] = urls['true_mapurl']
             return_obj["date"] = clicked_date
-            return_obj["cloud_cover"] = properties["CLOUD_COVER"]
+            return_obj["cloud_cover"] = urls['properties']["CLOUD_COVER"]
             return_obj["success"] = "success"
 
         except Exception as e:
             return_obj["error"] = "Error Processing Request. Error: "+ str(e)
 
     return JsonResponse(return_obj)
+def adminUnits(lon, lat):
+    # the three lookups are independent, run them side by side
+    return ee_client.gather(
+        (sampledFeature, 'region', lon, lat),
+        (sampledFeature, 'commune', lon, lat),
+        (sampledFeature, 'arrondissement', lon, lat),
+    )
+
+@ee_client.requestScope
 def details(request):
 
     return_obj = {}
@@ -113,20 +182,18 @@ def details(request):
         lon = info.get('lon')
 
         try:
-            ponds = filterPond(lon,lat)
-            region = filterRegion(lon,lat)
-            commune = filterCommune(lon,lat)
-            arrondissement = filterArrondissement(lon,lat)
-            namePond = ponds.getInfo()['features'][0]['properties']['Nom']
-            if len(namePond) < 2:
+            pond = ee_client.call(sampledFeature, 'ponds', lon, lat)
+            region, commune, arrondissement = cache.fetch('details', pond['properties']['uniqID'], adminUnits, lon, lat)
+            namePond = pond['properties']['Nom']
+            if not namePond or len(namePond) < 2:
                 namePond = 'Unnamed Pond'
 
-            coordinates = ponds.getInfo()['features'][0]['geometry']['coordinates']
+            coordinates = pond['geometry']['coordinates']
 
-            sup_Pond = ponds.getInfo()['features'][0]['properties']['Sup']
-            nameRegion = region.getInfo()['features'][0]['properties']['nom']
-            nameCommune = commune.getInfo()['features'][0]['properties']['nom']
-            nameArrondissement = arrondissement.getInfo()['features'][0]['properties']['nom']
+            sup_Pond = pond['properties']['Sup']
+            nameRegion = region['properties']['nom']
+            nameCommune = commune['properties']['nom']
+            nameArrondissement = arrondissement['properties']['nom']
 
             return_obj["namePond"] = namePond
             return_obj["sup_Pond"] = sup_Pond
@@ -141,13 +208,37 @@ def details(request):
 
     return JsonResponse(return_obj)
 
+@ee_client.requestScope
 def coucheVillages(request):
     return_obj = {}
     if request.is_ajax() and request.method == 'POST':
         try:
-            village = checkVillage()
+            info = request.POST
+            bbox = [info.get('west'), info.get('south'), info.get('east'), info.get('north')]
+            village = ee_client.call(checkVillage, bbox)
             return_obj["village"] = village
             return_obj["success"] = "success"
         except Exception as e:
             return_obj["error"] = _("Error Processing Request. Error: ")+ str(e)
-    return JsonResponse(return_obj)
\ No newline at end of file
+    return JsonResponse(return_obj)
+def villageTile(request, z, x, y):
+    try:
+        from . import village_tiles
+        tile = village_tiles.getTile(int(z), int(x), int(y))
+    except Exception as e:
+        return JsonResponse({"error": "Error Processing Request. Error: "+ str(e)}, status=500)
+    # tiles without villages are empty, which the MVT format reads as a tile without features
+    response = HttpResponse(tile, content_type='application/vnd.mapbox-vector-tile')
+    response['Cache-Control'] = 'max-age=86400'
+    return response
+
+def coalescingStats(request):
+    return JsonResponse({"endpoints": flights.stats(), "inFlight": flights.inFlight(), "success": "success"})
+
+def cacheStats(request):
+    return JsonResponse(dict(cache.stats(), success="success"))
+
+def metricsText(request):
+    # Prometheus text format, counted per worker process
+    body = metrics.registry.render(coalescing=flights.stats(), cache=cache.stats(), memo=ee_client.memoStats())
+    return HttpResponse(body, content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,6 +1,9 @@
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
 import json
 from .utilities import *
+from . import ee_client
+from . import rollups
 
 def api_get_ponds(request):
 
@@ -20,6 +23,7 @@ def api_get_ponds(request):
     return  JsonResponse(json_obj)
 
 
+@ee_client.requestScope
 def api_get_timeseries(request):
     json_obj = {}
 
@@ -30,7 +34,7 @@ def api_get_timeseries(request):
         lon = info.get('longitude')
 
         try:
-            ts_vals,coordinates,name = checkFeature(lon,lat)
+            ts_vals,coordinates,name = checkFeature(lon,lat,**seriesOptions(info))
             json_obj["values"] = ts_vals
             json_obj["coordinates"] = coordinates
             json_obj["name"] = name
@@ -39,3 +43,94 @@ def api_get_timeseries(request):
         except Exception as e:
             json_obj["error"] = "Error Processing Request. Error: "+ str(e)
     return JsonResponse(json_obj)
+
+
+def _ndjson(ponds, unknown, options):
+    errors = len(unknown)
+    for uniqID in unknown:
+        yield json.dumps({"uniqID": uniqID, "error": "Unknown pond"}) + "\n"
+    for row in bulkTimeSeries(ponds, **options):
+        errors += "error" in row
+        yield json.dumps(row) + "\n"
+    # a stream cut short lacks this line
+    yield json.dumps({"ponds": len(ponds) + len(unknown), "errors": errors, "success": "success"}) + "\n"
+
+
+@csrf_exempt
+@ee_client.requestScope
+def api_get_timeseries_bulk(request):
+    """Time series of many ponds, streamed as newline delimited JSON with one line per pond
+
+    Ponds are given by uniqIDs (comma separated), bbox (west,south,east,north), commune (id_com)
+    or arrondissement (id_arro). start, end, max_points and interval shape every series as on
+    api/getTimeseries.
+    """
+    json_obj = {}
+
+    if request.method in ('GET', 'POST'):
+
+        info = request.GET if request.method == 'GET' else request.POST
+        uniqIDs = info.get('uniqIDs')
+        bbox = info.get('bbox')
+
+        try:
+            if bbox:
+                bbox = [float(v) for v in bbox.split(',')]
+                if len(bbox) != 4:
+                    raise ValueError("bbox is west,south,east,north")
+            ponds, unknown = selectPonds(
+                uniqIDs=[u.strip() for u in uniqIDs.split(',') if u.strip()] if uniqIDs else None,
+                bbox=bbox or None,
+                commune=info.get('commune') or None,
+                arrondissement=info.get('arrondissement') or None,
+            )
+            options = seriesOptions(info)
+        except Exception as e:
+            json_obj["error"] = "Error Processing Request. Error: "+ str(e)
+            return JsonResponse(json_obj)
+
+        response = StreamingHttpResponse(_ndjson(ponds, unknown, options), content_type='application/x-ndjson')
+        # nginx would otherwise hold the lines back until the whole batch is done
+        response['X-Accel-Buffering'] = 'no'
+        return response
+    return JsonResponse(json_obj)
+
+
+def api_get_rollups(request):
+    """Water fraction and pond class counts of admin units per acquisition day, from the precomputed rollups
+
+    level is region, commune or arrondissement, unit an id_reg, id_com or id_arro (every unit of
+    the level by default), start and end (YYYY-MM-DD, both included) bound the days.
+    """
+    json_obj = {}
+
+    if request.method == 'GET':
+
+        info = request.GET
+        level = info.get('level')
+
+        try:
+            if level not in rollups.LEVELS:
+                raise ValueError("level is one of %s" % ', '.join(sorted(rollups.LEVELS)))
+            units = [info['unit']] if info.get('unit') else rollups.levelUnits(level)
+            if units is None:
+                raise ValueError("The rollups were not built yet")
+            start = dateMillis(info.get('start'))
+            end = dateMillis(info.get('end'), endOfDay=True)
+
+            index = getIndex(level)
+            key = rollups.LEVELS[level]
+            names = {} if index is None else dict((str(f['properties'].get(key)), f['properties'].get('nom'))
+                                                   for f in index.features)
+            json_obj["level"] = level
+            json_obj["units"] = []
+            for unit in units:
+                rollup = rollups.unitSeries(level, unit, start, end)
+                if rollup is None:
+                    raise ValueError("Unknown %s: %s" % (level, unit))
+                json_obj["units"].append(dict(rollup, id=unit, name=names.get(str(unit))))
+            json_obj["success"] = "success"
+
+        except Exception as e:
+            json_obj = {"error": "Error Processing Request. Error: "+ str(e)}
+    return JsonResponse(json_obj)
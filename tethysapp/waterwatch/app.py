@@ -62,6 +62,16 @@ class Waterwatch(TethysAppBase):
                 url='waterwatch/api/getTimeseries',
                 controller='waterwatch.api.api_get_timeseries'
             ),
+            UrlMap(
+                name='getTimeseriesBulk',
+                url='waterwatch/api/getTimeseriesBulk',
+                controller='waterwatch.api.api_get_timeseries_bulk'
+            ),
+            UrlMap(
+                name='getRollups',
+                url='waterwatch/api/getRollups',
+                controller='waterwatch.api.api_get_rollups'
+            ),
             UrlMap(
                 name='details',
                 url='waterwatch/details',
@@ -72,6 +82,36 @@ class Waterwatch(TethysAppBase):
                 url='waterwatch/coucheVillages',
                 controller='waterwatch.ajax_controllers.coucheVillages'
             ),
+            UrlMap(
+                name='submit-job',
+                url='waterwatch/jobs/submit',
+                controller='waterwatch.ajax_controllers.submitJob'
+            ),
+            UrlMap(
+                name='job-status',
+                url='waterwatch/jobs/status',
+                controller='waterwatch.ajax_controllers.jobStatus'
+            ),
+            UrlMap(
+                name='coalescing-stats',
+                url='waterwatch/stats/coalescing',
+                controller='waterwatch.ajax_controllers.coalescingStats'
+            ),
+            UrlMap(
+                name='cache-stats',
+                url='waterwatch/stats/cache',
+                controller='waterwatch.ajax_controllers.cacheStats'
+            ),
+            UrlMap(
+                name='metrics',
+                url='waterwatch/metrics',
+                controller='waterwatch.ajax_controllers.metricsText'
+            ),
+            UrlMap(
+                name='village-tiles',
+                url='waterwatch/village-tiles/{z}/{x}/{y}',
+                controller='waterwatch.ajax_controllers.villageTile'
+            ),
         )
 
         return url_maps
@@ -0,0 +1,153 @@
+import logging
+import time
+from collections import defaultdict
+
+import ee
+import numpy as np
+
+from . import config
+from . import ee_client
+from . import timeseries_store
+from .layers import getLayer
+from .storage import dataPath, readJson, writeJson
+
+log = logging.getLogger(__name__)
+
+# ponds reduced per reduceRegions call, keeps request and response payloads well under the limits
+CHUNK_SIZE = getattr(config, 'EXTRACT_CHUNK_SIZE', 500)
+# images processed between two writes to the time series store (and the checkpoint)
+FLUSH_EVERY = getattr(config, 'EXTRACT_FLUSH_EVERY', 10)
+
+
+def checkpointPath():
+    return dataPath('timeseries', 'extract-checkpoint.json')
+
+
+def listImages(collection):
+    """Asset ids and acquisition times of a collection, in one request
+    """
+    info = ee_client.getInfo(ee.Dictionary({
+        'ids': collection.aggregate_array('system:id'),
+        'times': collection.aggregate_array('system:time_start'),
+    }))
+    return list(zip(info['ids'], info['times']))
+
+
+def _reduced(image, ponds):
+    return image.reduceRegions(
+        collection=ponds.filterBounds(image.geometry()),
+        reducer=ee.Reducer.mean(),
+        scale=image.projection().nominalScale(),
+    ).select(['.*'], None, False)
+
+
+def _stats(props):
+    """{"water": .., "stddev": ..} of the band means in the properties of a reduced pond
+    """
+    means = [v for k, v in props.items() if k != 'uniqID' and v is not None]
+    if not means:
+        return {"water": None, "stddev": None}
+    return {"water": float(np.mean(means)), "stddev": float(np.std(means))}
+
+
+def reduceImage(image, ponds):
+    """Mean of every band over every pond the image covers, one reduceRegions call
+
+    Returns {uniqID: {"water": .., "stddev": ..}} where water and stddev are the mean and
+    standard deviation of the band means, the same statistics makeTimeSeries computes.
+    """
+    rows = {}
+    for feature in ee_client.getInfo(_reduced(image, ponds))['features']:
+        props = feature['properties']
+        rows[props['uniqID']] = _stats(props)
+    return rows
+
+
+def reduceSeries(collection, ponds, count):
+    """Time series of at most count ponds over every image of a collection, in one request
+
+    Returns {uniqID: [[time, {"water": .., "stddev": ..}], ...]} oldest first, the format of
+    makeTimeSeries with the statistics of reduceImage. Ponds not covered by any image are left out.
+    """
+    def describe(image):
+        return ee.Feature(None, {
+            'time': image.get('system:time_start'),
+            'ponds': _reduced(image, ponds).toList(count),
+        })
+
+    info = ee_client.getInfo(ee.FeatureCollection(collection.sort('system:time_start').map(describe)))
+    series = defaultdict(list)
+    for image in info['features']:
+        for pond in image['properties']['ponds']:
+            props = pond['properties']
+            series[props['uniqID']].append([image['properties']['time'], _stats(props)])
+    return dict(series)
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def extractTimeSeries(uniqIDs, since=None, chunkSize=CHUNK_SIZE, flushEvery=FLUSH_EVERY):
+    """Reduce every image of the water collection over all given ponds and append to the store
+
+    Images are processed oldest first and the results are written to the time series store
+    every flushEvery images. The list of processed images is kept in a checkpoint file so an
+    interrupted run picks up where it stopped when called again with the same arguments.
+    """
+    collection = getLayer('waterCollection')
+    if since is not None:
+        collection = collection.filter(ee.Filter.gt('system:time_start', since))
+    images = listImages(collection.sort('system:time_start'))
+
+    uniqIDs = list(uniqIDs)
+    pondsFc = getLayer('ponds').select(['uniqID'])
+    chunks = [pondsFc.filter(ee.Filter.inList('uniqID', chunk)) for chunk in _chunks(uniqIDs, chunkSize)]
+
+    runKey = {'since': since, 'ponds': len(uniqIDs), 'images': len(images)}
+    checkpoint = readJson(checkpointPath(), {})
+    done = set(checkpoint.get('done', [])) if checkpoint.get('run') == runKey else set()
+    if done:
+        log.info("Resuming extraction, %d of %d images already processed", len(done), len(images))
+
+    stats = {'images': 0, 'reductions': 0, 'added': 0, 'seconds': 0.0}
+    buffered = defaultdict(list)
+    pending = []
+    start = time.time()
+
+    def flush():
+        for uniqID, values in buffered.items():
+            stats['added'] += timeseries_store.appendSeries(uniqID, values)
+        buffered.clear()
+        done.update(pending)
+        del pending[:]
+        writeJson(checkpointPath(), {'run': runKey, 'done': sorted(done)})
+
+    for imageId, imageTime in images:
+        if imageId in done:
+            continue
+        image = ee.Image(imageId)
+        for chunk in chunks:
+            rows = reduceImage(image, chunk)
+            for uniqID, value in rows.items():
+                buffered[uniqID].append([imageTime, value])
+            stats['reductions'] += len(rows)
+        pending.append(imageId)
+        stats['images'] += 1
+
+        if len(pending) >= flushEvery:
+            flush()
+            elapsed = time.time() - start
+            log.info("%d/%d images, %d pond reductions, %.1f ponds/sec",
+                     len(done), len(images), stats['reductions'], stats['reductions'] / max(elapsed, 1e-9))
+    flush()
+    # ponds without any acquisition still get an (empty) series so they count as stored
+    for uniqID in uniqIDs:
+        if timeseries_store.readSeries(uniqID) is None:
+            timeseries_store.appendSeries(uniqID, [])
+
+    stats['seconds'] = time.time() - start
+    stats['pondsPerSecond'] = stats['reductions'] / max(stats['seconds'], 1e-9)
+    writeJson(checkpointPath(), {})
+    return stats
@@ -1,23 +1,16 @@
 from django.shortcuts import render
-from .utilities import initLayers, initMndwi
+from .utilities import initMndwi
+from .layers import registry
 from .app import Waterwatch as app
-import ee
-from . import config
-from ee.ee_exception import EEException
 
 
 def home(request):
     """
     Controller for the app home page.
     """
-    try:
-        credentials = ee.ServiceAccountCredentials(config.EE_SERVICE_ACCOUNT,
-                                                   config.EE_SECRET_KEY)
-        ee.Initialize(credentials)
-    except EEException:
-        ee.Initialize()
+    # the ponds layer is requested by the page right after it loads, start building it now
+    registry.prewarm(['pondsTileUrl'])
 
-    ponds = initLayers()
     mndwi=initMndwi()
     context = {
         # 'ponds_mapurl': ponds['tile_fetcher'].url_format,
@@ -0,0 +1,246 @@
+import contextvars
+import copy
+import functools
+import json
+import logging
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from . import config
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+# Earth Engine calls made for the ajax views run on this bounded pool, so a slow backend ties up
+# at most EE_WORKERS threads and every view gives up after EE_TIMEOUT seconds instead of waiting
+EE_WORKERS = getattr(config, 'EE_WORKERS', 8)
+EE_TIMEOUT = getattr(config, 'EE_TIMEOUT', 60)
+# calls waiting for a free worker, beyond that new calls are refused at once
+EE_QUEUE = getattr(config, 'EE_QUEUE', 16)
+
+
+class EETimeout(Exception):
+    pass
+
+
+class EEBusy(Exception):
+    pass
+
+
+_executor = ThreadPoolExecutor(max_workers=EE_WORKERS, thread_name_prefix='ee')
+_slots = threading.BoundedSemaphore(EE_WORKERS + EE_QUEUE)
+
+
+def submit(fn, *args, **kwargs):
+    """Run fn on the Earth Engine pool in a copy of the caller's context, returns a Future
+    """
+    if not _slots.acquire(blocking=False):
+        raise EEBusy("Too many Earth Engine requests in progress, try again later")
+    context = contextvars.copy_context()
+    try:
+        future = _executor.submit(context.run, fn, *args, **kwargs)
+    except BaseException:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda f: _slots.release())
+    return future
+
+
+def _result(future, timeout, name):
+    try:
+        return future.result(timeout)
+    except TimeoutError:
+        # the worker finishes in the background, the slot is released when it does
+        future.cancel()
+        log.warning("%s did not finish within %ss", name, timeout)
+        raise EETimeout("Earth Engine did not answer within %s seconds" % timeout)
+
+
+def call(fn, *args, timeout=None, **kwargs):
+    """Run fn on the Earth Engine pool and wait for its result, at most timeout seconds
+    """
+    timeout = EE_TIMEOUT if timeout is None else timeout
+    return _result(submit(fn, *args, **kwargs), timeout, getattr(fn, '__name__', repr(fn)))
+
+
+def gather(*calls, timeout=None):
+    """Run independent (fn, args...) calls concurrently and return their results in order
+
+    The timeout applies to the whole group.
+    """
+    timeout = EE_TIMEOUT if timeout is None else timeout
+    futures = []
+    try:
+        for fn, *args in calls:
+            futures.append((submit(fn, *args), getattr(fn, '__name__', repr(fn))))
+    except EEBusy:
+        for future, _ in futures:
+            future.cancel()
+        raise
+    deadline = time.monotonic() + timeout
+    return [_result(future, max(deadline - time.monotonic(), 0), name) for future, name in futures]
+
+
+# getInfo results and Earth Engine calls of the current request, see requestScope
+_scope = contextvars.ContextVar('ee_scope', default=None)
+_totals = {'calls': 0, 'saved': 0}
+_totalsLock = threading.Lock()
+
+
+class _Scope(object):
+    def __init__(self):
+        self.values = {}
+        self.calls = 0
+        self.saved = 0
+        # (site, kind, outcome, seconds) of every call
+        self.records = []
+        self.lock = threading.Lock()
+
+
+def _site():
+    """module.function of the code that called into this module
+    """
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_globals.get('__name__') == __name__:
+        frame = frame.f_back
+    if frame is None:
+        return 'unknown'
+    return '%s.%s' % (frame.f_globals.get('__name__', '').rsplit('.', 1)[-1], frame.f_code.co_name)
+
+
+def _record(scope, site, kind, outcome, seconds=0.0, sent=0, received=0, error=None):
+    metrics.registry.record(site, kind, outcome, seconds, sent, received, error)
+    if scope is not None:
+        with scope.lock:
+            scope.records.append((site, kind, outcome, seconds))
+
+
+def _timed(scope, site, kind, sent, fn, *args):
+    start = time.perf_counter()
+    try:
+        value = fn(*args)
+    except Exception as e:
+        _record(scope, site, kind, 'error', time.perf_counter() - start, sent, error=type(e).__name__)
+        raise
+    seconds = time.perf_counter() - start
+    received = len(json.dumps(value, default=str)) if kind == 'getInfo' else 0
+    _record(scope, site, kind, 'ok', seconds, sent, received)
+    return value
+
+
+def getInfo(obj):
+    """obj.getInfo(), fetched once per request for identical computed objects
+
+    Outside of a requestScope this is a plain getInfo call. Every call is timed and counted
+    against the function that made it.
+    """
+    site = _site()
+    scope = _scope.get()
+    key = obj.serialize()
+    if scope is None:
+        return _timed(None, site, 'getInfo', len(key), obj.getInfo)
+    with scope.lock:
+        scope.calls += 1
+        hit = key in scope.values
+        if hit:
+            scope.saved += 1
+    with _totalsLock:
+        _totals['calls'] += 1
+        _totals['saved'] += hit
+    if hit:
+        _record(scope, site, 'getInfo', 'memo')
+    else:
+        value = _timed(scope, site, 'getInfo', len(key), obj.getInfo)
+        with scope.lock:
+            scope.values.setdefault(key, value)
+    # callers are free to modify what they get back
+    return copy.deepcopy(scope.values[key])
+
+
+def getMapId(obj, visParams=None):
+    """obj.getMapId(visParams), timed and counted like getInfo
+    """
+    return _timed(_scope.get(), _site(), 'getMapId', len(obj.serialize()), obj.getMapId, visParams)
+
+
+def serverTiming(seconds, records):
+    """Server-Timing header value, the time spent in round trips by each call site and in the whole view
+    """
+    sites = {}
+    for site, kind, outcome, elapsed in records:
+        entry = sites.setdefault(site, {'seconds': 0.0, 'getInfo': 0, 'getMapId': 0, 'memo': 0})
+        if outcome == 'memo':
+            entry['memo'] += 1
+        else:
+            entry['seconds'] += elapsed
+            entry[kind] += 1
+    parts = []
+    for site, entry in sorted(sites.items(), key=lambda item: -item[1]['seconds']):
+        desc = ', '.join('%d %s' % (entry[k], k) for k in ('getInfo', 'getMapId', 'memo') if entry[k])
+        parts.append('ee.%s;dur=%.1f;desc="%s"' % (site, entry['seconds'] * 1000, desc))
+    parts.append('total;dur=%.1f' % (seconds * 1000))
+    return ', '.join(parts)
+
+
+def _scoped(scope, content, finish):
+    """Iterate the body of a streamed response inside a request scope, finish runs when the stream ends
+    """
+    content = iter(content)
+    try:
+        while True:
+            token = _scope.set(scope)
+            try:
+                chunk = next(content)
+            except StopIteration:
+                return
+            finally:
+                _scope.reset(token)
+            yield chunk
+    finally:
+        finish()
+
+
+def requestScope(view):
+    """View decorator sharing one getInfo memo between every call made while handling the request
+
+    The number of round trips saved is logged and sent back in the X-EE-Roundtrips-Saved header,
+    the time spent in the Earth Engine calls of each call site in the Server-Timing header.
+    A streamed body is produced after the headers are sent, the scope then also covers its
+    iteration and the request is recorded when the stream ends, without the two headers.
+    """
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        start = time.perf_counter()
+        scope = _Scope()
+        token = _scope.set(scope)
+        try:
+            response = view(request, *args, **kwargs)
+        finally:
+            _scope.reset(token)
+
+        def finish():
+            seconds = time.perf_counter() - start
+            with scope.lock:
+                records = list(scope.records)
+            metrics.registry.recordRequest(view.__name__, seconds, records)
+            if scope.calls:
+                log.debug("%s: %d getInfo calls, %d round trips saved", view.__name__, scope.calls, scope.saved)
+            return seconds, records
+
+        if getattr(response, 'streaming', False):
+            response.streaming_content = _scoped(scope, response.streaming_content, finish)
+            return response
+        seconds, records = finish()
+        response['X-EE-Roundtrips-Saved'] = str(scope.saved)
+        response['Server-Timing'] = serverTiming(seconds, records)
+        return response
+    return wrapper
+
+
+def memoStats():
+    """getInfo calls made through the memo since the process started and how many were saved
+    """
+    with _totalsLock:
+        return dict(_totals)
@@ -0,0 +1,51 @@
+import json
+from datetime import datetime
+
+from .storage import atomicFile, readJson
+
+# Per region: the newest acquisition up to which every image is in the asset folder, and the
+# export attempts of the images not yet there
+#   {region: {"time_start": ms, "date": "YYYY-MM-DD", "attempts": {image name: attempts}}}
+
+
+def loadWatermarks(path):
+    return readJson(path, {})
+
+
+def saveWatermarks(path, watermarks):
+    with atomicFile(path, 'w') as f:
+        json.dump(watermarks, f, indent=2)
+
+
+def givenUp(entry, maxAttempts):
+    """Names of the images of a region whose export was attempted maxAttempts times without an asset
+    """
+    return set(name for name, count in entry.get('attempts', {}).items() if count >= maxAttempts)
+
+
+def advance(entry, names, times, existing, attempted, maxAttempts):
+    """Watermark entry of a region after a run over the images (names, times)
+
+    existing are the names in the asset folder before the run, attempted the names whose export
+    was submitted during it (started or not). The watermark stops before the oldest image that is
+    not in the folder, unless it was given up after maxAttempts, so a single image that never
+    exports does not pin the start of every later run.
+    """
+    entry = dict(entry or {})
+    previous = entry.get('attempts', {})
+    attempts = {}
+    for name in names:
+        if name in existing:
+            continue
+        count = previous.get(name, 0) + (1 if name in attempted else 0)
+        if count:
+            attempts[name] = count
+    entry['attempts'] = attempts
+    skipped = givenUp(entry, maxAttempts)
+
+    unconfirmed = [t for name, t in zip(names, times) if name not in existing and name not in skipped]
+    confirmed = [t for t in times if not unconfirmed or t < min(unconfirmed)]
+    if confirmed and max(confirmed) > entry.get('time_start', 0):
+        entry['time_start'] = max(confirmed)
+        entry['date'] = datetime.utcfromtimestamp(max(confirmed) / 1000).strftime('%Y-%m-%d')
+    return entry
@@ -0,0 +1,233 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import ee
+import numpy as np
+
+from . import config
+from .layers import getLayer
+from .spatial_index import downloadCollection
+from .storage import dataPath, atomicFile
+
+# forcing of this many model start times is kept in memory, older ones are read back from disk
+MEMORY_ENTRIES = getattr(config, 'FORCING_MEMORY_ENTRIES', 8)
+# forcing files on disk are deleted once their model start time is this old
+DISK_DAYS = getattr(config, 'FORCING_DISK_DAYS', 60)
+FORECAST_DAYS = 15
+ANTECEDENT_DAYS = 7
+PAGE_SIZE = 1000
+
+
+def prepGfs(img):
+    d = img.date()
+    offset = ee.Number(img.get("forecast_hours"))
+    new_date = d.advance(offset, "hour")
+    return img.set("system:time_start", new_date.millis())
+
+
+def accumGFS(collection, startDate, nDays):
+    if (nDays > 16):
+        raise Warning('Max forecast days is 16, only producing forecast for 16 days...')
+        nDays = 16
+
+    cnt = 1
+    imgList = []
+    precipScale = ee.Image(1).divide(ee.Image(1e3))
+    for i in range(nDays + 1):
+        t1 = startDate.advance(i, 'day')
+        t2 = t1.advance(1, "day")
+
+        dayPrecip = collection.filterDate(t1, t2)
+        imgList.append(dayPrecip.sum().multiply(precipScale)
+                       .set('system:time_start', t1.millis()))
+
+    return ee.ImageCollection(imgList)
+
+
+def accumCFS(collection, startDate, nDays):
+    imgList = []
+    precipScale = ee.Image(1).divide(ee.Image(1e3))
+    for i in range(nDays):
+        newDate = startDate.advance(i, 'day')
+        dayPrecip = collection.filterDate(newDate, newDate.advance(24, 'hour'))
+        imgList.append(dayPrecip.sum().multiply(precipScale) \
+                       .set('system:time_start', newDate.millis()))
+    return ee.ImageCollection(imgList)
+
+
+def calcInitIap(collection, startDate, pastDays):
+    off = pastDays * -1
+    s = startDate.advance(off, 'day')
+    e = s.advance(pastDays, 'day')
+    prevPrecip = collection.filterDate(s, e)
+
+    dailyPrev = accumCFS(prevPrecip, s, pastDays)
+
+    imgList = dailyPrev.toList(pastDays)
+    outList = []
+
+    for i in range(pastDays):
+        pr = ee.Image(imgList.get(i))
+        antecedent = pr.multiply(ee.Image(1).divide(pastDays - i))
+        outList.append(antecedent)
+
+    Iap = ee.ImageCollection(outList).sum().rename(['Iap'])
+
+    return Iap
+
+
+def buildForcing(modelDate, forecastDays=FORECAST_DAYS):
+    """GFS daily precipitation, CFS antecedent index and CFS precipitation of the previous day
+    """
+    gfs = getLayer('gfs')
+    cfs = getLayer('cfs')
+    precipData = gfs.filterDate(modelDate, modelDate.advance(1, 'hour')) \
+        .filterMetadata('forecast_hours', 'greater_than', 0) \
+        .select(['total_precipitation_surface'], ['precip']) \
+        .map(prepGfs)
+    return {
+        'dailyPrecip': accumGFS(precipData, modelDate, forecastDays),
+        'initIap': calcInitIap(cfs, modelDate, ANTECEDENT_DAYS),
+        'prevPrecip': ee.Image(cfs.filterDate(modelDate.advance(-1, 'day'), modelDate).select(['precip']).sum())
+            .multiply(getLayer('precipScale')),
+    }
+
+
+class ForcingCache(object):
+    """Forcing of the forecast model per model start time (ms), shared by every pond
+
+    images() memoizes the Earth Engine objects. samples() reduces the forcing over the ponds
+    of a start time in one pass and writes the averages to disk so other workers reuse them,
+    it is run by the forecast batch; pondForcing() only reads what was stored.
+    """
+
+    def __init__(self, forecastDays=FORECAST_DAYS):
+        self.forecastDays = forecastDays
+        self._images = OrderedDict()
+        self._samples = OrderedDict()
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _keyLock(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    @staticmethod
+    def _remember(entries, key, value):
+        entries[key] = value
+        entries.move_to_end(key)
+        while len(entries) > MEMORY_ENTRIES:
+            entries.popitem(last=False)
+
+    def images(self, modelDate):
+        key = int(modelDate)
+        with self._lock:
+            if key in self._images:
+                self._images.move_to_end(key)
+                return self._images[key]
+        images = buildForcing(ee.Date(key), self.forecastDays)
+        with self._lock:
+            self._remember(self._images, key, images)
+        return images
+
+    def path(self, modelDate):
+        return dataPath('forcing', '%d.npz' % int(modelDate))
+
+    def sample(self, modelDate, uniqIDs=None):
+        """Average the forcing over the ponds with these uniqIDs, or every pond, as a dict of arrays in uniqID order
+        """
+        ponds = getLayer('ponds').select(['uniqID'])
+        if uniqIDs is not None:
+            ponds = ponds.filter(ee.Filter.inList('uniqID', [int(u) for u in uniqIDs]))
+        images = self.images(modelDate)
+        days = self.forecastDays + 1
+        names = ['p%d' % i for i in range(days)]
+        stack = images['dailyPrecip'].toBands().rename(names) \
+            .addBands(images['prevPrecip'].rename('prevPrecip')) \
+            .addBands(images['initIap'])
+        reduced = stack.reduceRegions(
+            collection=ponds,
+            reducer=ee.Reducer.mean(),
+            scale=30,
+        ).select(['.*'], None, False)
+        rows = [f['properties'] for f in downloadCollection(reduced, PAGE_SIZE)]
+
+        def column(key):
+            return np.array([np.nan if r.get(key) is None else r[key] for r in rows], dtype=np.float64)
+
+        return {
+            'uniqID': np.array([r['uniqID'] for r in rows], dtype=np.int64),
+            'precip': np.stack([column(n) for n in names], axis=1) if rows else np.empty((0, days)),
+            'prevPrecip': column('prevPrecip'),
+            'Iap': column('Iap'),
+        }
+
+    def _entry(self, key, arrays):
+        entry = (arrays, dict((int(u), i) for i, u in enumerate(arrays['uniqID'])))
+        with self._lock:
+            self._remember(self._samples, key, entry)
+        return entry
+
+    def stored(self, modelDate):
+        """(arrays, row of each uniqID) sampled for a start time, None when nothing was stored
+        """
+        key = int(modelDate)
+        entry = self._samples.get(key)
+        if entry is not None:
+            return entry
+        try:
+            with np.load(self.path(key)) as data:
+                arrays = {k: data[k] for k in data.files}
+        except IOError:
+            return None
+        return self._entry(key, arrays)
+
+    def samples(self, modelDate, uniqIDs=None):
+        """Stored forcing of a start time, the ponds with these uniqIDs (or every pond) that are
+        missing are sampled in one reduction and added to the file on disk
+        """
+        key = int(modelDate)
+        with self._keyLock(key):
+            entry = self.stored(key)
+            if uniqIDs is None:
+                if entry is not None:
+                    return entry
+                arrays = self.sample(key)
+            else:
+                missing = sorted(set(int(u) for u in uniqIDs).difference(entry[1] if entry is not None else ()))
+                if not missing:
+                    return entry
+                arrays = self.sample(key, missing)
+                if entry is not None:
+                    arrays = dict((k, np.concatenate([entry[0][k], v])) for k, v in arrays.items())
+            with atomicFile(self.path(key)) as f:
+                np.savez(f, **arrays)
+            self.prune()
+            return self._entry(key, arrays)
+
+    def prune(self):
+        """Drop forcing files of model start times older than DISK_DAYS
+        """
+        folder = os.path.dirname(self.path(0))
+        oldest = (time.time() - DISK_DAYS * 86400) * 1000
+        for name in os.listdir(folder):
+            stem = name.split('.')[0]
+            if name.endswith('.npz') and stem.isdigit() and int(stem) < oldest:
+                os.unlink(os.path.join(folder, name))
+
+    def pondForcing(self, modelDate, uniqID):
+        """precip (per forecast day), prevPrecip and Iap of one pond, None if the pond was not sampled
+
+        Never reaches the server, a pond without stored forcing is left to the Earth Engine model.
+        """
+        entry = self.stored(modelDate)
+        i = None if entry is None else entry[1].get(int(uniqID))
+        if i is None:
+            return None
+        arrays = entry[0]
+        return {'precip': arrays['precip'][i], 'prevPrecip': arrays['prevPrecip'][i], 'Iap': arrays['Iap'][i]}
+
+
+cache = ForcingCache()
@@ -0,0 +1,142 @@
+import logging
+import threading
+import time
+
+import ee
+import numpy as np
+
+from . import acquisitions
+from . import config
+from . import forcing
+from . import forecast_model
+from . import hypsometry
+from .layers import getLayer
+from .spatial_index import downloadCollection
+from .storage import dataPath, atomicFile, modifiedTime
+
+log = logging.getLogger(__name__)
+
+# precomputed forecasts older than this, or started before the newest image over their pond,
+# are recomputed live by the forecast endpoint
+FORECAST_MAX_AGE = getattr(config, 'FORECAST_MAX_AGE', 24 * 3600)
+PAGE_SIZE = getattr(config, 'FORECAST_PAGE_SIZE', 200)
+
+
+def storePath():
+    return dataPath('forecasts', 'latest.npz')
+
+
+def pondStart(feature):
+    """Model start time and initial water fraction of a pond, computed as in forecastFeature
+    """
+    geometry = feature.geometry()
+    coll = getLayer('waterCollection').filterBounds(geometry).sort('system:time_start', False)
+    lastimg = ee.Image(coll.first())
+    featureImg = ee.Image(coll.reduce(ee.Reducer.firstNonNull())).rename(lastimg.bandNames())
+    pondFraction = featureImg.reduceRegion(ee.Reducer.mean(), geometry,
+                                           lastimg.projection().nominalScale()).get("mndwi_water")
+    return ee.Feature(ee.Algorithms.If(
+        coll.size().gt(0),
+        ee.Feature(None, {'uniqID': feature.get('uniqID'), 'lastTime': lastimg.get('system:time_start'),
+                          'pondFraction': pondFraction}),
+        ee.Feature(None, {'uniqID': feature.get('uniqID')}),
+    ))
+
+
+def runBatch():
+    """Forecast every pond with a hypsometry entry and store the pctArea series
+
+    Returns the number of ponds forecast and the time spent in each stage.
+    """
+    timings = {}
+    clock = time.time()
+
+    def stage(name):
+        nonlocal clock
+        now = time.time()
+        timings[name] = now - clock
+        clock = now
+        log.info("%s: %.1fs", name, timings[name])
+
+    table = hypsometry.loadTable()
+    if table is None:
+        raise RuntimeError("The hypsometry table is missing, run 'localCache.py hypsometry' first")
+    stage('load constants')
+
+    starts = [f['properties'] for f in downloadCollection(getLayer('ponds').map(pondStart), PAGE_SIZE)]
+    starts = [s for s in starts if s.get('lastTime') is not None and hypsometry.lookup(s['uniqID']) is not None]
+    stage('initial conditions')
+
+    groups = {}
+    for start in starts:
+        groups.setdefault(int(start['lastTime']), []).append(start)
+    # each start time is sampled over its own ponds only
+    samples = dict((modelDate, forcing.cache.samples(modelDate, [s['uniqID'] for s in group]))
+                   for modelDate, group in groups.items())
+    stage('forcing')
+
+    days = forcing.FORECAST_DAYS + 1
+    results = {'uniqID': [], 'modelDate': [], 'times': [], 'pctArea': []}
+    for modelDate, group in groups.items():
+        arrays, rows = samples[modelDate]
+        group = [s for s in group if int(s['uniqID']) in rows]
+        if not group:
+            continue
+        pond = np.array([table['rows'][int(s['uniqID'])] for s in group])
+        sample = np.array([rows[int(s['uniqID'])] for s in group])
+        initial = np.array([np.nan if s.get('pondFraction') is None else s['pondFraction'] for s in group])
+        out = forecast_model.forecast(table['area'][pond], table['So'][pond], initial,
+                                      arrays['precip'][sample], arrays['prevPrecip'][sample], arrays['Iap'][sample])
+        results['uniqID'].append(table['uniqID'][pond])
+        results['modelDate'].append(np.full(len(group), modelDate, dtype=np.int64))
+        results['times'].append(np.tile(forecast_model.forecastTimes(modelDate, days), (len(group), 1)))
+        results['pctArea'].append(out['pctArea'])
+    stage('model')
+
+    if results['uniqID']:
+        store = dict((k, np.concatenate(v)) for k, v in results.items())
+    else:
+        store = {'uniqID': np.empty(0, np.int64), 'modelDate': np.empty(0, np.int64),
+                 'times': np.empty((0, days), np.int64), 'pctArea': np.empty((0, days))}
+    with atomicFile(storePath()) as f:
+        np.savez(f, generated=time.time(), **store)
+    stage('write')
+
+    return len(store['uniqID']), timings
+
+
+_store = None
+_storeLock = threading.Lock()
+
+
+def _loadStore():
+    global _store
+    mtime = modifiedTime(storePath())
+    if mtime is None:
+        return None
+    if _store is None or _store[0] != mtime:
+        with _storeLock:
+            if _store is None or _store[0] != mtime:
+                with np.load(storePath()) as data:
+                    store = {k: data[k] for k in data.files}
+                store['rows'] = dict((int(u), i) for i, u in enumerate(store['uniqID']))
+                _store = (mtime, store)
+    return _store[1]
+
+
+def lookup(uniqID, geometry=None):
+    """Precomputed forecast of a pond, None when it is missing, older than FORECAST_MAX_AGE or stale
+
+    A forecast is stale once the acquisition catalog has an image over the pond GeoJSON geometry
+    newer than its model start date; without an up to date catalog only the age is checked.
+    """
+    store = _loadStore()
+    if store is None or time.time() - float(store['generated']) > FORECAST_MAX_AGE:
+        return None
+    i = store['rows'].get(int(uniqID))
+    if i is None:
+        return None
+    latest = acquisitions.latest(geometry) if geometry is not None else None
+    if latest is not None and latest['time'] > int(store['modelDate'][i]):
+        return None
+    return forecast_model.toValues(store['times'][i].tolist(), store['pctArea'][i])
@@ -0,0 +1,101 @@
+import numpy as np
+
+# Vectorized NumPy version of the pond water balance model of utilities.fClass (Soti et al.).
+# Every input holds one entry per pond (daily forcing one row per pond, one column per day)
+# so all ponds are stepped through the model together.
+
+# model parameters, same defaults as utilities.fClass
+PARAMS = {'k': 0.9, 'Gmax': 0.01487, 'L': 0.00114, 'Kr': 0.4946, 'n': 19.89, 'alpha': 2.514}
+H0 = 1.0
+DAY_MS = 24 * 3600 * 1000
+
+
+def _positive(x):
+    # same as ee where(x.lt(0), 0): negative values are clipped, NaN is left alone
+    return np.where(x < 0, 0, x)
+
+
+def hypsometry(pArea, So, alpha=PARAMS['alpha'], n=PARAMS['n'], h0=H0):
+    """Volume and contributing area constants of each pond, returns (Vo, Ac)
+    """
+    pArea = np.asarray(pArea, dtype=np.float64)
+    So = np.asarray(So, dtype=np.float64)
+    Vo = So * h0 / (alpha + 1)
+    Ac = n * pArea
+    return Vo, Ac
+
+
+def forecast(pArea, So, initial, precip, prevPrecip, initIap, Vo=None, Ac=None,
+             k=PARAMS['k'], Gmax=PARAMS['Gmax'], L=PARAMS['L'], Kr=PARAMS['Kr'],
+             n=PARAMS['n'], alpha=PARAMS['alpha'], h0=H0):
+    """Run the water balance model for N ponds
+
+    pArea, So, initial (water fraction at model start), prevPrecip (precipitation of the day
+    before the start) and initIap (antecedent precipitation index) have shape (N,), precip has
+    shape (N, D) with the daily forecast precipitation. Vo and Ac are derived from So and pArea
+    when not given.
+
+    Returns a dict of (N, D) arrays: precip, Iap, vol, area, height and pctArea.
+    """
+    pArea = np.asarray(pArea, dtype=np.float64)
+    So = np.asarray(So, dtype=np.float64)
+    precip = np.atleast_2d(np.asarray(precip, dtype=np.float64))
+    if Vo is None or Ac is None:
+        Vo, Ac = hypsometry(pArea, So, alpha=alpha, n=n, h0=h0)
+    Vo = np.asarray(Vo, dtype=np.float64)
+    Ac = np.asarray(Ac, dtype=np.float64)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # initial conditions
+        area = pArea * np.asarray(initial, dtype=np.float64)
+        height = (area / So) ** (h0 / alpha)
+        vol = Vo * (height / h0) ** (alpha + 1)
+        Iap = np.asarray(initIap, dtype=np.float64)
+        pastPr = np.asarray(prevPrecip, dtype=np.float64)
+
+        out = {key: np.empty(precip.shape) for key in ('precip', 'Iap', 'vol', 'area', 'height')}
+        for day in range(precip.shape[1]):
+            nowPr = precip[:, day]
+            # change in volume model
+            Iap = (Iap + pastPr) * k  # Eq 5 Soti et al
+            Gt = _positive(Gmax - Iap)  # Eq 4
+            Pe = _positive(nowPr - Gt)  # Eq 3
+            Qin = Kr * Pe * Ac  # Eq 2
+            dV = nowPr * pArea + Qin - L * area  # Eq 1
+            vol = _positive(vol + dV)
+
+            # empirical model for volume to area/height relationship
+            height = _positive(h0 * (vol / Vo) ** (1 / (alpha + 1)))
+            area = _positive(So * (height / h0) ** alpha)
+
+            out['precip'][:, day] = nowPr
+            out['Iap'][:, day] = Iap
+            out['vol'][:, day] = vol
+            out['area'][:, day] = area
+            out['height'][:, day] = height
+            pastPr = nowPr
+
+        pct = out['area'] / pArea[:, None]
+    out['pctArea'] = np.where(pct > 1, 1, pct)
+    return out
+
+
+def forecastTimes(modelDate, days):
+    """Timestamps (ms) of the model steps, the start of each forecast day plus six hours
+    """
+    return [int(modelDate) + i * DAY_MS + 6 * 3600 * 1000 for i in range(days)]
+
+
+def toValues(times, pctArea):
+    """One pond's pctArea series in the [time, {"water": value}] format fClass.forecast returns
+    """
+    return [[t, {"water": None if np.isnan(v) else float(v)}] for t, v in zip(times, pctArea)]
+
+
+def forecastPond(constants, initial, forcing, modelDate, **params):
+    """Forecast of one pond from its hypsometry constants and sampled forcing, as [time, {"water": ..}]
+    """
+    out = forecast([constants['area']], [constants['So']], [np.nan if initial is None else initial],
+                   [forcing['precip']], [forcing['prevPrecip']], [forcing['Iap']], **params)
+    times = forecastTimes(modelDate, len(forcing['precip']))
+    return toValues(times, out['pctArea'][0])
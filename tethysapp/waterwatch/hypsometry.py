@@ -0,0 +1,90 @@
+import threading
+
+import ee
+import numpy as np
+
+from . import config
+from . import forecast_model
+from .layers import getLayer
+from .spatial_index import downloadCollection
+from .storage import dataPath, atomicFile, modifiedTime
+
+# each pond costs three reductions on the server, keep the pages small
+PAGE_SIZE = getattr(config, 'HYPSOMETRY_PAGE_SIZE', 200)
+
+COLUMNS = ('area', 'pondMin', 'So', 'Vo', 'Ac')
+
+
+def tablePath():
+    return dataPath('hypsometry.npz')
+
+
+def pondConstants(feature):
+    """Pond area, minimum elevation and So of one pond, computed as in fClass.forecast
+    """
+    elv = getLayer('elv')
+    demScale = getLayer('demScale')
+    geometry = feature.geometry()
+    pondMin = ee.Number(elv.reduceRegion(
+        geometry=geometry,
+        reducer=ee.Reducer.min(),
+        scale=demScale, maxPixels=1e6
+    ).get('elevation'))
+    SoInit = ee.Image(0).where(elv.gte(pondMin).And(elv.lte(pondMin.add(forecast_model.H0))), 1)
+    count = ee.Number(SoInit.reduceRegion(
+        geometry=geometry,
+        reducer=ee.Reducer.sum(),
+        scale=demScale, maxPixels=1e6
+    ).get('constant'))
+    So = ee.Image(count).multiply(ee.Image.pixelArea()).reduceRegion(
+        ee.Reducer.mean(), geometry, 30).get('constant')
+    return ee.Feature(None, {'uniqID': feature.get('uniqID'), 'area': geometry.area(),
+                             'pondMin': pondMin, 'So': So})
+
+
+def rebuildTable():
+    """Compute the constants of every pond on the server and replace the local table
+    """
+    features = downloadCollection(getLayer('ponds').map(pondConstants), PAGE_SIZE)
+    rows = [f['properties'] for f in features]
+    table = {'uniqID': np.array([r['uniqID'] for r in rows], dtype=np.int64)}
+    for key in ('area', 'pondMin', 'So'):
+        table[key] = np.array([np.nan if r.get(key) is None else r[key] for r in rows], dtype=np.float64)
+    table['Vo'], table['Ac'] = forecast_model.hypsometry(table['area'], table['So'])
+    with atomicFile(tablePath()) as f:
+        np.savez(f, **table)
+    return len(rows)
+
+
+_table = None
+_tableLock = threading.Lock()
+
+
+def loadTable():
+    """The table as a dict of arrays plus a uniqID -> row lookup, None when it was never built
+    """
+    global _table
+    mtime = modifiedTime(tablePath())
+    if mtime is None:
+        return None
+    if _table is not None and _table[0] == mtime:
+        return _table[1]
+    with _tableLock:
+        if _table is None or _table[0] != mtime:
+            with np.load(tablePath()) as data:
+                table = {k: data[k] for k in data.files}
+            table['rows'] = dict((int(u), i) for i, u in enumerate(table['uniqID']))
+            _table = (mtime, table)
+    return _table[1]
+
+
+def lookup(uniqID):
+    """Stored constants of a pond, None when the pond is not in the table
+    """
+    table = loadTable()
+    if table is None:
+        return None
+    i = table['rows'].get(int(uniqID))
+    if i is None or np.isnan(table['So'][i]):
+        return None
+    return dict((k, float(table[k][i])) for k in COLUMNS)
@@ -0,0 +1,220 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from . import config
+from .spatial_index import locate
+from .storage import dataPath
+from .utilities import checkFeature, forecastFeature
+
+log = logging.getLogger(__name__)
+
+# Long running pond requests run as jobs: submit returns a job id at once, the work runs on a
+# local thread pool and the state is kept in SQLite so any worker process can answer a status poll
+JOB_WORKERS = getattr(config, 'JOB_WORKERS', 4)
+# running jobs not updated for this long are considered lost (hung), queued and running jobs
+# are also lost as soon as the process that owns them is gone
+JOB_TIMEOUT = getattr(config, 'JOB_TIMEOUT', 15 * 60)
+# finished jobs are kept this long for status polls
+JOB_KEEP = getattr(config, 'JOB_KEEP', 3600)
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+
+def _timeseries(lon, lat, **options):
+    ts_vals, coordinates, name = checkFeature(lon, lat, prefetch=True, **options)
+    return {"values": ts_vals, "coordinates": coordinates, "name": name}
+
+
+def _forecast(lon, lat):
+    ts_vals, coordinates, name = forecastFeature(lon, lat)
+    return {"values": ts_vals, "coordinates": coordinates, "name": name}
+
+
+TASKS = {
+    'timeseries': _timeseries,
+    'forecast': _forecast,
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    status TEXT NOT NULL,
+    progress REAL NOT NULL DEFAULT 0,
+    message TEXT,
+    result TEXT,
+    error TEXT,
+    owner TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key, status);
+"""
+
+
+def databasePath():
+    return dataPath('jobs', 'jobs.sqlite3')
+
+
+_schemaReady = False
+
+
+def _connect():
+    global _schemaReady
+    db = sqlite3.connect(databasePath(), timeout=30, isolation_level=None)
+    db.row_factory = sqlite3.Row
+    if not _schemaReady:
+        db.executescript(SCHEMA)
+        # databases created before jobs recorded their process
+        if 'owner' not in [c['name'] for c in db.execute('PRAGMA table_info(jobs)')]:
+            db.execute('ALTER TABLE jobs ADD COLUMN owner TEXT')
+        _schemaReady = True
+    return db
+
+
+def _bootId():
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as f:
+            return f.read().strip()
+    except IOError:
+        return None
+
+
+_BOOT = _bootId()
+
+
+def _processId(pid):
+    """boot:pid:start time of a running process, which a reused pid does not match, None when unknown
+    """
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            started = f.read().rsplit(')', 1)[1].split()[19]
+    except (IOError, IndexError):
+        return None
+    return '%s:%d:%s' % (_BOOT, pid, started)
+
+
+# without /proc the process cannot be checked from another one, its jobs then only time out
+OWNER = _processId(os.getpid()) or 'unchecked:' + uuid.uuid4().hex
+
+
+def _ownerAlive(owner):
+    if owner is None:
+        return False
+    if owner == OWNER or owner.startswith('unchecked:'):
+        return True
+    boot, pid, _ = owner.split(':')
+    return boot == str(_BOOT) and _processId(int(pid)) == owner
+
+
+def _lost(row, now):
+    """True for a queued or running job whose process is gone, or a running job not updated for JOB_TIMEOUT
+    """
+    if row['status'] not in (QUEUED, RUNNING):
+        return False
+    if not _ownerAlive(row['owner']):
+        return True
+    return row['status'] == RUNNING and now - row['updated'] > JOB_TIMEOUT
+
+
+def _jobKey(kind, lon, lat, options):
+    # the pond from the local snapshot, never from the server: submit answers at once
+    feature = locate('ponds', lon, lat)
+    if feature is not None:
+        key = '%s:%s' % (kind, feature['properties']['uniqID'])
+    else:
+        key = '%s:%.6f,%.6f' % (kind, float(lon), float(lat))
+    if options:
+        key += ':' + json.dumps(options, sort_keys=True)
+    return key
+
+
+def _update(jobId, **fields):
+    fields['updated'] = time.time()
+    names = ', '.join('%s = ?' % k for k in fields)
+    db = _connect()
+    try:
+        db.execute('UPDATE jobs SET %s WHERE id = ?' % names, list(fields.values()) + [jobId])
+    finally:
+        db.close()
+
+
+def _run(jobId, kind, args, options):
+    # the tasks do not report their own stages, progress only moves from queued (0) to
+    # computing (0.1) to done (1)
+    _update(jobId, status=RUNNING, progress=0.1, message='computing')
+    start = time.time()
+    try:
+        result = TASKS[kind](*args, **options)
+    except Exception as e:
+        log.warning("Job %s (%s) failed: %s", jobId, kind, e)
+        _update(jobId, status=FAILED, error=str(e), message='failed')
+    else:
+        _update(jobId, status=DONE, progress=1.0, result=json.dumps(result), message='done')
+        log.info("Job %s (%s) done in %.1fs", jobId, kind, time.time() - start)
+
+
+_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+_submitLock = threading.Lock()
+
+
+def submit(kind, lon, lat, options=None):
+    """Queue a pond job and return its id, an identical job already in flight is reused
+
+    options are passed to the task as keyword arguments, the time series options of checkFeature.
+    """
+    if kind not in TASKS:
+        raise ValueError("Unknown job type: %s" % kind)
+    options = dict((k, v) for k, v in (options or {}).items() if v is not None)
+    key = _jobKey(kind, lon, lat, options)
+    now = time.time()
+    with _submitLock:
+        db = _connect()
+        try:
+            # IMMEDIATE takes the write lock, so two workers cannot both miss the in-flight job
+            db.execute('BEGIN IMMEDIATE')
+            db.execute('DELETE FROM jobs WHERE status IN (?, ?) AND updated < ?', (DONE, FAILED, now - JOB_KEEP))
+            for row in db.execute('SELECT * FROM jobs WHERE key = ? AND status IN (?, ?)', (key, QUEUED, RUNNING)).fetchall():
+                if not _lost(row, now):
+                    db.execute('COMMIT')
+                    return row['id']
+            jobId = uuid.uuid4().hex
+            db.execute('INSERT INTO jobs (id, kind, key, status, created, updated, owner) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       (jobId, kind, key, QUEUED, now, now, OWNER))
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        finally:
+            db.close()
+    _executor.submit(_run, jobId, kind, (lon, lat), options)
+    return jobId
+
+
+def status(jobId):
+    """State of a job as a dict, with the result once it is done, None for an unknown id
+    """
+    db = _connect()
+    try:
+        row = db.execute('SELECT * FROM jobs WHERE id = ?', (jobId,)).fetchone()
+    finally:
+        db.close()
+    if row is None:
+        return None
+    state = {'job': row['id'], 'kind': row['kind'], 'status': row['status'],
+             'progress': row['progress'], 'message': row['message']}
+    if _lost(row, time.time()):
+        state.update(status=FAILED, message='lost')
+        state['error'] = "The job was interrupted, submit it again"
+    if row['status'] == DONE:
+        state['result'] = json.loads(row['result'])
+    if row['status'] == FAILED:
+        state['error'] = row['error']
+    return state
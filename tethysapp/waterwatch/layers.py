@@ -0,0 +1,103 @@
+import logging
+import threading
+import time
+
+import ee
+from . import config
+
+log = logging.getLogger(__name__)
+
+# map ids handed out by getMapId stop resolving after a few hours, rebuild them before that
+MAPID_TTL = getattr(config, 'EE_MAPID_TTL', 4 * 3600)
+
+_initLock = threading.Lock()
+_initialized = False
+
+
+def initializeEE():
+    """Initialize the Earth Engine client once per process
+    """
+    global _initialized
+    if _initialized:
+        return
+    with _initLock:
+        if _initialized:
+            return
+        try:
+            credentials = ee.ServiceAccountCredentials(config.EE_SERVICE_ACCOUNT,
+                                                       config.EE_SECRET_KEY)
+            ee.Initialize(credentials)
+        except:
+            ee.Initialize()
+        _initialized = True
+
+
+class LayerRegistry(object):
+    """Named Earth Engine objects and map ids that are built the first time they are used
+
+    Builders are registered with an optional ttl in seconds, values are memoized until
+    the ttl runs out (or forever when ttl is None).
+    """
+
+    def __init__(self):
+        self._builders = {}
+        self._values = {}
+        self._locks = {}
+
+    def register(self, name, ttl=None):
+        def decorator(builder):
+            self._builders[name] = (builder, ttl)
+            self._locks[name] = threading.Lock()
+            return builder
+
+        return decorator
+
+    def _fresh(self, name):
+        entry = self._values.get(name)
+        if entry is not None and (entry[1] is None or entry[1] > time.time()):
+            return entry
+        return None
+
+    def get(self, name):
+        entry = self._fresh(name)
+        if entry is not None:
+            return entry[0]
+
+        builder, ttl = self._builders[name]
+        # one build per name at a time, other threads wait for the result
+        with self._locks[name]:
+            entry = self._fresh(name)
+            if entry is not None:
+                return entry[0]
+            initializeEE()
+            value = builder()
+            expires = None if ttl is None else time.time() + ttl
+            self._values[name] = (value, expires)
+            return value
+
+    def invalidate(self, *names):
+        for name in names or list(self._values):
+            self._values.pop(name, None)
+
+    def prewarm(self, names=None):
+        """Build the given layers (all of them by default) in a background thread
+        """
+        names = list(names or self._builders)
+
+        def run():
+            for name in names:
+                try:
+                    self.get(name)
+                except Exception as e:
+                    log.warning("Could not prewarm layer %s: %s", name, e)
+
+        thread = threading.Thread(target=run, name='waterwatch-prewarm', daemon=True)
+        thread.start()
+        return thread
+
+
+registry = LayerRegistry()
+
+
+def getLayer(name):
+    return registry.get(name)
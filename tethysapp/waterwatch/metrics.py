@@ -0,0 +1,136 @@
+import threading
+from collections import defaultdict
+
+# upper bounds in seconds of the buckets of the Earth Engine call latency histogram
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Registry(object):
+    """Counters of the Earth Engine calls made by this worker and of the views that made them
+
+    Every worker process keeps its own counts, Prometheus adds up the workers it scrapes.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # (site, kind, outcome) -> calls
+        self.calls = defaultdict(int)
+        # (site, kind, error class) -> calls
+        self.errors = defaultdict(int)
+        # (site, kind) -> [calls per bucket..., seconds, round trips]
+        self.latency = {}
+        # (site, kind) -> [bytes sent, bytes received]
+        self.payload = defaultdict(lambda: [0, 0])
+        # view -> [requests, seconds, Earth Engine calls, round trips, seconds spent in round trips]
+        self.views = defaultdict(lambda: [0, 0, 0, 0, 0])
+
+    def record(self, site, kind, outcome, seconds=0.0, sent=0, received=0, error=None):
+        """One getInfo or getMapId call made from site, outcome is ok, error or memo
+        """
+        with self._lock:
+            self.calls[(site, kind, outcome)] += 1
+            if outcome == 'memo':
+                return
+            if error is not None:
+                self.errors[(site, kind, error)] += 1
+            latency = self.latency.setdefault((site, kind), [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    latency[i] += 1
+            latency[-2] += seconds
+            latency[-1] += 1
+            payload = self.payload[(site, kind)]
+            payload[0] += sent
+            payload[1] += received
+
+    def recordRequest(self, view, seconds, calls):
+        """A view that took seconds and made calls, the (site, kind, outcome, seconds) it recorded
+        """
+        roundTrips = [c for c in calls if c[2] != 'memo']
+        with self._lock:
+            totals = self.views[view]
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] += len(calls)
+            totals[3] += len(roundTrips)
+            totals[4] += sum(c[3] for c in roundTrips)
+
+    def render(self, coalescing=None, cache=None, memo=None):
+        """Prometheus text exposition of the counters
+
+        The stats of the request coalescing, the result cache and the getInfo memo are included when given.
+        """
+        out = []
+        with self._lock:
+            _family(out, 'waterwatch_ee_calls_total', 'counter', 'Earth Engine calls by call site and outcome',
+                    [({'site': s, 'kind': k, 'outcome': o}, n) for (s, k, o), n in sorted(self.calls.items())])
+            _family(out, 'waterwatch_ee_errors_total', 'counter', 'Earth Engine calls that raised, by error class',
+                    [({'site': s, 'kind': k, 'error': e}, n) for (s, k, e), n in sorted(self.errors.items())])
+
+            samples = []
+            for (site, kind), latency in sorted(self.latency.items()):
+                labels = {'site': site, 'kind': kind}
+                for bound, count in zip(self.buckets, latency):
+                    samples.append(('_bucket', dict(labels, le=_number(bound)), count))
+                samples.append(('_bucket', dict(labels, le='+Inf'), latency[-1]))
+                samples.append(('_sum', labels, latency[-2]))
+                samples.append(('_count', labels, latency[-1]))
+            _family(out, 'waterwatch_ee_call_seconds', 'histogram', 'Earth Engine round trip latency', samples)
+
+            _family(out, 'waterwatch_ee_sent_bytes_total', 'counter', 'Size of the serialized requests',
+                    [({'site': s, 'kind': k}, p[0]) for (s, k), p in sorted(self.payload.items())])
+            _family(out, 'waterwatch_ee_received_bytes_total', 'counter', 'Size of the JSON results',
+                    [({'site': s, 'kind': k}, p[1]) for (s, k), p in sorted(self.payload.items())])
+
+            views = sorted(self.views.items())
+            for i, (name, help) in enumerate([
+                    ('waterwatch_requests_total', 'Requests handled by each view'),
+                    ('waterwatch_request_seconds_total', 'Time spent in each view'),
+                    ('waterwatch_request_ee_calls_total', 'Earth Engine calls made by each view, memo hits included'),
+                    ('waterwatch_request_ee_round_trips_total', 'Earth Engine round trips made by each view'),
+                    ('waterwatch_request_ee_seconds_total', 'Time each view spent in Earth Engine round trips')]):
+                _family(out, name, 'counter', help, [({'view': view}, totals[i]) for view, totals in views])
+
+        if coalescing is not None:
+            for field, name, help in [('calls', 'waterwatch_coalescing_calls_total', 'Calls made through the request coalescing'),
+                                      ('coalesced', 'waterwatch_coalesced_calls_total', 'Calls that waited for an identical call in flight')]:
+                _family(out, name, 'counter', help,
+                        [({'endpoint': e}, s[field]) for e, s in sorted(coalescing.items())])
+        if cache is not None:
+            _family(out, 'waterwatch_result_cache_total', 'counter', 'Result cache lookups by outcome',
+                    [({'endpoint': e, 'result': r}, s[r]) for e, s in sorted(cache['endpoints'].items())
+                     for r in ('memoryHits', 'diskHits', 'misses')])
+            _family(out, 'waterwatch_result_cache_evictions_total', 'counter', 'Entries dropped from the memory tier',
+                    [({'endpoint': e}, s['evictions']) for e, s in sorted(cache['endpoints'].items())])
+            _family(out, 'waterwatch_result_cache_memory_entries', 'gauge', 'Entries in the memory tier',
+                    [({}, cache['memoryEntries'])])
+            _family(out, 'waterwatch_result_cache_invalidations_total', 'counter', 'Invalidations after a new image',
+                    [({}, cache['invalidations'])])
+        if memo is not None:
+            _family(out, 'waterwatch_ee_memo_calls_total', 'counter', 'getInfo calls made through the request memo',
+                    [({}, memo['calls'])])
+            _family(out, 'waterwatch_ee_memo_saved_total', 'counter', 'getInfo round trips saved by the request memo',
+                    [({}, memo['saved'])])
+        return ''.join(out)
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _family(out, name, kind, help, samples):
+    """Append a metric family, samples are (labels, value) or (suffix, labels, value)
+    """
+    out.append('# HELP %s %s\n# TYPE %s %s\n' % (name, help, name, kind))
+    for sample in samples:
+        suffix, labels, value = sample if len(sample) == 3 else ('',) + tuple(sample)
+        text = ','.join('%s="%s"' % (k, _escape(v)) for k, v in sorted(labels.items()))
+        out.append('%s%s%s %s\n' % (name, suffix, '{%s}' % text if text else '', _number(value)))
+
+
+registry = Registry()
@@ -0,0 +1,124 @@
+import hashlib
+import json
+import threading
+import time
+
+import numpy as np
+
+from . import config
+from .layers import getLayer
+from .spatial_index import _polygons, snapshotPath, getIndex, downloadCollection
+from .storage import dataPath, atomicFile, modifiedTime
+
+# without a ponds snapshot the catalog is downloaded from the server and rebuilt after this many seconds
+CATALOG_MAX_AGE = getattr(config, 'POND_CATALOG_MAX_AGE', 7 * 24 * 3600)
+
+
+def catalogPath():
+    return dataPath('catalog', 'ponds.json')
+
+
+def ringCentroid(ring):
+    """Area and centroid of a closed or open (n, 2) ring, shoelace formula
+    """
+    x, y = ring[:, 0], ring[:, 1]
+    xn, yn = np.roll(x, -1), np.roll(y, -1)
+    cross = x * yn - xn * y
+    area = cross.sum() / 2
+    if area == 0:
+        return 0.0, ring.mean(axis=0)
+    cx = ((x + xn) * cross).sum() / (6 * area)
+    cy = ((y + yn) * cross).sum() / (6 * area)
+    return abs(area), np.array([cx, cy])
+
+
+def featureCentroid(geometry):
+    """Area weighted centroid and bounding box of a GeoJSON geometry, holes are subtracted
+    """
+    polys = _polygons(geometry)
+    rings = [ring for poly in polys for ring in poly]
+    if not rings:
+        return None, None
+    points = np.concatenate(rings)
+    bbox = [points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max()]
+
+    weights, centers = [], []
+    for poly in polys:
+        for i, ring in enumerate(poly):
+            area, center = ringCentroid(ring)
+            weights.append(area if i == 0 else -area)
+            centers.append(center)
+    weights = np.array(weights)
+    if weights.sum() <= 0:
+        centroid = points.mean(axis=0)
+    else:
+        centroid = (weights[:, None] * np.array(centers)).sum(axis=0) / weights.sum()
+    return [float(c) for c in centroid], [float(b) for b in bbox]
+
+
+def buildCatalog(features):
+    """Named ponds sorted by name, one entry per name as the ponds list has always shown them
+    """
+    seen = {}
+    for feature in features:
+        name = feature['properties'].get('Nom')
+        if not name or str(name) in seen:
+            continue
+        centroid, bbox = featureCentroid(feature.get('geometry'))
+        if centroid is None:
+            continue
+        seen[str(name)] = (centroid, bbox, feature['properties'].get('uniqID'))
+    names = sorted(seen)
+    catalog = {
+        'names': names,
+        'centers': [seen[n][0] for n in names],
+        'bboxes': [seen[n][1] for n in names],
+        'uniqIDs': [seen[n][2] for n in names],
+    }
+    body = json.dumps(catalog, sort_keys=True).encode()
+    catalog['etag'] = '"%s"' % hashlib.sha1(body).hexdigest()
+    return catalog
+
+
+def rebuildCatalog():
+    """Rebuild the catalog from the ponds snapshot, or from the server when there is none
+    """
+    index = getIndex('ponds')
+    features = index.features if index is not None else downloadCollection(getLayer('ponds'))
+    catalog = buildCatalog(features)
+    with atomicFile(catalogPath(), 'w') as f:
+        json.dump(catalog, f)
+    return catalog
+
+
+def _stale():
+    built = modifiedTime(catalogPath())
+    if built is None:
+        return True
+    snapshot = modifiedTime(snapshotPath('ponds'))
+    if snapshot is not None:
+        return snapshot > built
+    return time.time() - built > CATALOG_MAX_AGE
+
+
+_cached = None
+_lock = threading.Lock()
+
+
+def getCatalog():
+    """Catalog as (etag, JSON body of the get-ponds-list response), kept in memory until the file changes
+    """
+    global _cached
+    if _stale():
+        with _lock:
+            if _stale():
+                rebuildCatalog()
+    mtime = modifiedTime(catalogPath())
+    if _cached is None or _cached[0] != mtime:
+        with _lock:
+            with open(catalogPath()) as f:
+                catalog = json.load(f)
+            etag = catalog.pop('etag')
+            catalog['success'] = 'success'
+            _cached = (mtime, etag, json.dumps(catalog).encode())
+    return _cached[1], _cached[2]
@@ -0,0 +1,92 @@
+import logging
+import threading
+import time
+
+import ee
+
+from . import config
+from . import ee_client
+from .layers import getLayer, MAPID_TTL
+from .storage import dataPath, readJson, writeJson
+
+log = logging.getLogger(__name__)
+
+# how often the water collection is asked whether a new acquisition arrived
+CHECK_INTERVAL = getattr(config, 'POND_CLASSES_CHECK_INTERVAL', 15 * 60)
+
+visParams = {'min': 0, 'max': 3, 'palette': 'red,yellow,green,gray'}
+
+_lock = threading.Lock()
+_latest = {'checked': 0, 'time': None}
+
+
+def classesPath():
+    return dataPath('pond_classes', 'classes.json')
+
+
+def mapIdPath():
+    return dataPath('pond_classes', 'mapid.json')
+
+
+def latestAcquisition():
+    """system:time_start of the newest image of the water collection, rechecked every CHECK_INTERVAL
+    """
+    if time.time() - _latest['checked'] > CHECK_INTERVAL:
+        _latest['time'] = ee_client.getInfo(getLayer('waterCollection').aggregate_max('system:time_start'))
+        _latest['checked'] = time.time()
+    return _latest['time']
+
+
+def refreshClasses(acquisition=None):
+    """Run pondClassifier over every pond and store pondCls per uniqID
+    """
+    if acquisition is None:
+        acquisition = latestAcquisition()
+    # pairs, so a pond without a class cannot shift the classes of the ponds after it
+    pairs = ee_client.getInfo(getLayer('ponds_cls').reduceColumns(ee.Reducer.toList(2), ['uniqID', 'pondCls']).get('list'))
+    classes = {'acquisition': acquisition, 'classes': dict((uniqID, cls) for uniqID, cls in pairs)}
+    writeJson(classesPath(), classes)
+    return classes
+
+
+def classImage(classes):
+    """Pond class image painted from stored classes, one cheap filter per class instead of pondClassifier
+    """
+    ponds = getLayer('ponds')
+    byClass = {}
+    for uniqID, cls in classes.items():
+        byClass.setdefault(cls, []).append(int(uniqID))
+    painted = ee.FeatureCollection([])
+    for cls, ids in byClass.items():
+        selected = ponds.filter(ee.Filter.inList('uniqID', ids)).map(lambda f, cls=cls: f.set('pondCls', cls))
+        painted = painted.merge(selected)
+    return painted.reduceToImage(properties=['pondCls'], reducer=ee.Reducer.first())
+
+
+def tileUrl():
+    """Tile url of the pond classification layer
+
+    The map id is painted from the stored classes and reused by every worker until its token
+    runs out or the classes are refreshed. Refreshing the classes runs pondClassifier over every
+    pond and is left to localCache.py classes, a request never waits on it. Before the first
+    refresh the layer is classified on the fly by the tile server.
+    """
+    classes = readJson(classesPath(), {})
+    stored = readJson(mapIdPath(), {})
+    if stored.get('acquisition') == classes.get('acquisition') and stored.get('expires', 0) > time.time():
+        return stored['url']
+
+    with _lock:
+        stored = readJson(mapIdPath(), {})
+        if stored.get('acquisition') == classes.get('acquisition') and stored.get('expires', 0) > time.time():
+            return stored['url']
+        if classes:
+            image = classImage(classes['classes'])
+        else:
+            log.warning("No stored pond classes, run localCache.py classes")
+            image = getLayer('Pimage')
+        mapId = ee_client.getMapId(image, visParams)
+        url = mapId['tile_fetcher'].url_format
+        writeJson(mapIdPath(), {'acquisition': classes.get('acquisition'), 'url': url,
+                                'expires': time.time() + MAPID_TTL})
+        return url
@@ -150,6 +150,47 @@ function ajax_update_database(ajax_url, ajax_data) {
 
     return xhr;
 }
+//submit a pond job (timeseries or forecast) and poll its status until it finishes
+//the returned promise resolves with the job result, shaped like the synchronous endpoints' response
+function run_job(kind, ajax_data) {
+    var deferred = jQuery.Deferred();
+    var data = jQuery.extend({'kind': kind}, ajax_data);
+
+    function poll(job) {
+        jQuery.ajax({
+            type: "GET",
+            url: "jobs/status/",
+            dataType: "json",
+            data: {'job': job}
+        }).done(function (state) {
+            if (!("success" in state)) {
+                deferred.resolve(state);
+            } else if (state.status === "done") {
+                state.result.success = "success";
+                deferred.resolve(state.result);
+            } else if (state.status === "failed") {
+                deferred.resolve({'error': state.error});
+            } else {
+                deferred.notify(state.progress, state.message);
+                setTimeout(function () { poll(job); }, 1000);
+            }
+        }).fail(function (xhr) {
+            deferred.resolve({'error': xhr.responseText});
+        });
+    }
+
+    ajax_update_database("jobs/submit", data).done(function (submitted) {
+        if ("success" in submitted) {
+            poll(submitted.job);
+        } else {
+            deferred.resolve(submitted);
+        }
+    }).fail(function (xhr) {
+        deferred.resolve({'error': xhr.responseText});
+    });
+    return deferred.promise();
+}
+
 //send data to database but follow this if you have files assosciated with it.
 function ajax_update_database_with_file(ajax_url, ajax_data,div_id) {
     //backslash at end of url is required
@@ -33,6 +33,9 @@ var LIBRARY_OBJECT = (function() {
         true_layer,    mndwi_mapid,
         mndwi_token;
 
+    // acquisitions drawn in the time series chart, the server picks them so the shape of the series is kept
+    var TS_MAX_POINTS = 600;
+
 
     /************************************************************************
      *                    PRIVATE FUNCTION DECLARATIONS
@@ -68,7 +71,12 @@ var LIBRARY_OBJECT = (function() {
 
     }
 
-    ajax_update_database("get-ponds-list", {}).done(function (data) {
+    // GET so the browser keeps the list and only revalidates it with its ETag
+    jQuery.ajax({
+        type: "GET",
+        url: "get-ponds-list/",
+        dataType: "json"
+    }).done(function (data) {
         if ("success" in data) {
             var j;
             var obj = [];
@@ -222,12 +230,23 @@ var LIBRARY_OBJECT = (function() {
             visible: false,
             name: 'layer_commune_senegal'
         });
-        var village_layer = new ol.layer.Tile({
+        // vector tiles of the local village snapshot, served from zoom 8 on
+        var village_layer = new ol.layer.VectorTile({
             title: 'Village Wendou',
-            source: new ol.source.TileWMS({
-                url: 'https://wendou_geoserver.csesn.dev/geoserver/wms',
-                params: {LAYERS: 'wendou:Village', TILED: true}
+            source: new ol.source.VectorTile({
+                format: new ol.format.MVT(),
+                url: 'village-tiles/{z}/{x}/{y}/',
+                tileGrid: ol.tilegrid.createXYZ({minZoom: 8, maxZoom: 14})
             }),
+            style: new ol.style.Style({
+                image: new ol.style.Circle({
+                    radius: 4,
+                    fill: new ol.style.Fill({color: '#8b4513'}),
+                    stroke: new ol.style.Stroke({color: '#ffffff', width: 1})
+                }),
+                stroke: new ol.style.Stroke({color: '#8b4513', width: 1})
+            }),
+            maxResolution: 611.5,
             zIndex: 900,
             visible: false,
             name: 'Village_Wendou'
@@ -559,7 +578,7 @@ var LIBRARY_OBJECT = (function() {
             var myGeoJSON2 = [];
             var mareSelect, buffered;
             var $elements;
-            var xhr = ajax_update_database('timeseries', {'lat': proj_coords[1], 'lon': proj_coords[0]}, 'name');
+            var xhr = run_job('timeseries', {'lat': proj_coords[1], 'lon': proj_coords[0], 'max_points': TS_MAX_POINTS});
             xhr.done(function (data) {
                 if ("success" in data) {
                     $('.info').html('');
@@ -572,7 +591,14 @@ var LIBRARY_OBJECT = (function() {
                     mareSelect = turf.polygon(data.coordinates);
 
                     buffered = turf.buffer(mareSelect, 10, {units: 'kilometers'});
-                    var villagehr = ajax_update_database('coucheVillages');
+                    // only the villages around the buffered pond are sent back
+                    var extent = turf.bbox(buffered);
+                    var villagehr = ajax_update_database('coucheVillages', {
+                        'west': extent[0],
+                        'south': extent[1],
+                        'east': extent[2],
+                        'north': extent[3]
+                    });
                     villagehr.done(function (data2) {
                         for (var iter = 0; iter < data2.village.length; iter++) {
                             var buff1 = turf.feature(data2.village[iter].geometry, data2.village[iter].properties);
@@ -623,7 +649,7 @@ var LIBRARY_OBJECT = (function() {
             });
 
 
-            var yhr = ajax_update_database('forecast', {'lat': proj_coords[1], 'lon': proj_coords[0]}, 'name');
+            var yhr = run_job('forecast', {'lat': proj_coords[1], 'lon': proj_coords[0]});
             yhr.done(function (data) {
                 if ("success" in data) {
                     $('.info').html('');
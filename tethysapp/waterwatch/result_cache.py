@@ -0,0 +1,203 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from . import config
+from .pond_classes import latestAcquisition
+from .storage import DATA_DIR, dataPath, readJson, writeJson
+
+log = logging.getLogger(__name__)
+
+# entries kept in the memory tier of each worker, the disk tier is shared by all workers
+MEMORY_ENTRIES = getattr(config, 'RESULT_CACHE_ENTRIES', 512)
+# files kept in the disk tier, swept every SWEEP_EVERY writes of a worker
+DISK_ENTRIES = getattr(config, 'RESULT_CACHE_DISK_ENTRIES', 50000)
+SWEEP_EVERY = 500
+
+# how long results stay valid, on top of the invalidation when a new processed_ponds image arrives
+TTL = {
+    'timeseries': getattr(config, 'TIMESERIES_CACHE_TTL', 24 * 3600),
+    # GFS runs every six hours
+    'forecast': getattr(config, 'FORECAST_CACHE_TTL', 6 * 3600),
+    'details': getattr(config, 'DETAILS_CACHE_TTL', 7 * 24 * 3600),
+}
+
+
+def _older(name, current):
+    try:
+        return int(name) < int(current)
+    except ValueError:
+        return False
+
+
+def _memoryKey(name, key):
+    return name, json.dumps(key, sort_keys=True, default=str)
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+        return 1
+    except OSError:
+        return 0
+
+
+def cacheDir():
+    return os.path.join(DATA_DIR, 'cache')
+
+
+class TieredCache(object):
+    """Results of the Earth Engine backed endpoints, in a memory LRU backed by JSON files on disk
+
+    Every entry records the generation it was computed for, the time of the newest image of the
+    water collection. Once a newer image is ingested the generation changes, every older entry
+    misses and the disk tier of the old generations is removed. Expired files are deleted when
+    they are read and by a periodic sweep, which also keeps the disk tier to maxFiles.
+    """
+
+    def __init__(self, generation, maxEntries=MEMORY_ENTRIES, maxFiles=DISK_ENTRIES):
+        self._generation = generation
+        self.maxEntries = maxEntries
+        self.maxFiles = maxFiles
+        self._writes = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._current = None
+        self._stats = defaultdict(lambda: {'memoryHits': 0, 'diskHits': 0, 'misses': 0, 'evictions': 0})
+        self.invalidations = 0
+
+    def generation(self):
+        """Time of the newest image as a string, None when it cannot be known and the cache is skipped
+        """
+        try:
+            current = str(self._generation())
+        except Exception as e:
+            # keep serving what was cached when the server cannot be asked, nothing is removed
+            log.warning("Could not check for new images: %s", e)
+            return self._current
+        if current != self._current:
+            self._invalidate(current)
+        return current
+
+    def _invalidate(self, current):
+        with self._lock:
+            if current == self._current:
+                return
+            if self._current is not None:
+                self.invalidations += 1
+                log.info("New image ingested, result cache invalidated")
+            self._current = current
+            self._memory.clear()
+        # the disk tier is shared, only generations older than this one go, another
+        # worker may already have seen a newer image
+        if os.path.isdir(cacheDir()):
+            for name in os.listdir(cacheDir()):
+                if _older(name, current):
+                    shutil.rmtree(os.path.join(cacheDir(), name), ignore_errors=True)
+
+    def _path(self, generation, name, key):
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+        return dataPath('cache', generation, name, digest + '.json')
+
+    def _lookup(self, generation, name, key, now):
+        """('memory' or 'disk', value) of a valid entry, (None, None) on a miss
+        """
+        memoryKey = _memoryKey(name, key)
+        with self._lock:
+            entry = self._memory.get(memoryKey)
+            if entry is not None and entry[0] > now and entry[1] == generation:
+                self._memory.move_to_end(memoryKey)
+                return 'memory', entry[2]
+
+        path = self._path(generation, name, key)
+        stored = readJson(path)
+        if stored is not None and stored['expires'] > now:
+            self._remember(memoryKey, stored['expires'], generation, stored['value'])
+            return 'disk', stored['value']
+        if stored is not None:
+            _unlink(path)
+        return None, None
+
+    def has(self, name, key):
+        """True when (name, key) would be answered without computing it
+        """
+        generation = self.generation()
+        return generation is not None and self._lookup(generation, name, key, time.time())[0] is not None
+
+    def fetch(self, name, key, fn, *args, ttl=None, **kwargs):
+        """Cached result of fn(*args, **kwargs) for (name, key), computed and stored on a miss
+        """
+        generation = self.generation()
+        if generation is None:
+            return fn(*args, **kwargs)
+        now = time.time()
+        stats = self._stats[name]
+
+        tier, value = self._lookup(generation, name, key, now)
+        with self._lock:
+            stats['misses' if tier is None else tier + 'Hits'] += 1
+        if tier is not None:
+            return value
+
+        value = fn(*args, **kwargs)
+        expires = now + (TTL.get(name, 3600) if ttl is None else ttl)
+        path = self._path(generation, name, key)
+        writeJson(path, {'expires': expires, 'value': value})
+        # the modification time carries the expiry, so the sweep does not read the files
+        os.utime(path, (expires, expires))
+        self._remember(_memoryKey(name, key), expires, generation, value)
+        with self._lock:
+            self._writes += 1
+            sweep = self._writes % SWEEP_EVERY == 0
+        if sweep:
+            self.sweep()
+        return value
+
+    def sweep(self, now=None):
+        """Delete the expired files of the disk tier, then the ones expiring first beyond maxFiles
+
+        Returns the number of files deleted.
+        """
+        now = time.time() if now is None else now
+        files = []
+        for folder, _, names in os.walk(cacheDir()):
+            # files being written are not .json yet
+            for name in names:
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(folder, name)
+                try:
+                    files.append((os.path.getmtime(path), path))
+                except OSError:
+                    pass
+        files.sort()
+        expired = sum(1 for expires, _ in files if expires <= now)
+        deleted = 0
+        for _, path in files[:max(expired, len(files) - self.maxFiles)]:
+            deleted += _unlink(path)
+        if deleted:
+            log.info("Result cache: %d files swept from the disk tier", deleted)
+        return deleted
+
+    def _remember(self, memoryKey, expires, generation, value):
+        with self._lock:
+            self._memory[memoryKey] = (expires, generation, value)
+            self._memory.move_to_end(memoryKey)
+            while len(self._memory) > self.maxEntries:
+                evicted, _ = self._memory.popitem(last=False)
+                self._stats[evicted[0]]['evictions'] += 1
+
+    def stats(self):
+        """Memory hits, disk hits, misses and memory evictions per endpoint
+        """
+        with self._lock:
+            result = dict((name, dict(stats)) for name, stats in self._stats.items())
+            return {'endpoints': result, 'memoryEntries': len(self._memory), 'invalidations': self.invalidations}
+
+
+cache = TieredCache(latestAcquisition)
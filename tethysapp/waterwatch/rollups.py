@@ -0,0 +1,200 @@
+import logging
+import threading
+import time
+
+import numpy as np
+
+from . import timeseries_store
+from .spatial_index import getIndex, snapshotPath
+from .storage import dataPath, atomicFile, readJson, writeJson, modifiedTime
+
+log = logging.getLogger(__name__)
+
+# admin levels and the pond property holding the unit of each pond, the filters of detailsFeature
+LEVELS = {
+    'region': 'id_reg',
+    'commune': 'id_com',
+    'arrondissement': 'id_arro',
+}
+
+# classes of pondClassifier, in the order of their values
+CLASSES = ('dry', 'partial', 'full', 'noData')
+
+DAY = 24 * 3600 * 1000
+
+
+def rollupPath(level):
+    return dataPath('rollups', level + '.npz')
+
+
+def statePath():
+    return dataPath('rollups', 'state.json')
+
+
+def pondClasses(water):
+    """pondClassifier classes of water fractions: 0 dry, 1 partly filled, 2 full, 3 without a value
+    """
+    water = np.asarray(water, dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        classes = (water > 0.25).astype(np.int8) + (water > 0.75)
+        return np.where(np.isnan(water) | (water < 0), 3, classes)
+
+
+def _pondDays(series, since):
+    """Days (00:00 UTC in milliseconds) with acquisitions of a pond from since on, and the mean water of each
+    """
+    keep = series['time'] >= since
+    days = series['time'][keep] // DAY * DAY
+    water = series['water'][keep]
+    if not len(days):
+        return days, water
+    days, which = np.unique(days, return_inverse=True)
+    valid = ~np.isnan(water)
+    total = np.bincount(which, np.where(valid, water, 0), minlength=len(days))
+    count = np.bincount(which, valid, minlength=len(days))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return days, np.where(count > 0, total / count, np.nan)
+
+
+def _rollup(unitCount, pondUnits, pondRows, days, water):
+    """Water sum and class counts per unit and day of the (pond, day) rows and their water
+
+    Returns (waterSum[units, days], classes[units, days, class]).
+    """
+    cell = pondUnits[pondRows[0]] * len(days) + np.searchsorted(days, pondRows[1])
+    size = unitCount * len(days)
+    valued = ~np.isnan(water)
+    waterSum = np.bincount(cell[valued], water[valued], minlength=size).reshape(unitCount, len(days))
+    classes = pondClasses(water)
+    counts = np.stack([np.bincount(cell[classes == c], minlength=size) for c in range(len(CLASSES))], axis=-1)
+    return waterSum, counts.reshape(unitCount, len(days), len(CLASSES)).astype(np.int32)
+
+
+def updateRollups(full=False):
+    """Bring the admin unit rollups up to date with the time series store
+
+    Only the days from the oldest acquisition added to the store since the last update on are
+    recomputed, everything is recomputed when full is set or the pond snapshot changed.
+    Returns the number of days recomputed.
+    """
+    index = getIndex('ponds')
+    if index is None:
+        raise RuntimeError("The pond snapshot is needed, run localCache.py snapshot ponds first")
+    snapshot = modifiedTime(snapshotPath('ponds'))
+    state = readJson(statePath(), {})
+    old = None if full or state.get('snapshot') != snapshot else loadRollups()
+    lasts = state.get('lasts', {}) if old is not None else {}
+
+    uniqIDs = [f['properties']['uniqID'] for f in index.features]
+    series = {}
+    since = None
+    for uniqID in uniqIDs:
+        s = timeseries_store.readSeries(uniqID)
+        if s is None or not len(s['time']):
+            continue
+        series[uniqID] = s
+        new = s['time'][s['time'] > lasts.get(str(uniqID), -1)]
+        if len(new):
+            first = int(new[0]) // DAY * DAY
+            since = first if since is None else min(since, first)
+    if since is None and old is not None:
+        log.info("Rollups: nothing new in the time series store")
+        return 0
+    if old is None:
+        since = -2 ** 62
+
+    rows, waters = [], []
+    for i, uniqID in enumerate(uniqIDs):
+        if uniqID in series:
+            days, water = _pondDays(series[uniqID], since)
+            rows.append(np.stack([np.full(len(days), i, dtype=np.int64), days]))
+            waters.append(water)
+    rows = np.concatenate(rows, axis=1) if rows else np.zeros((2, 0), dtype=np.int64)
+    water = np.concatenate(waters) if waters else np.zeros(0)
+    days = np.unique(rows[1])
+
+    for level, key in LEVELS.items():
+        pondUnits = np.array([str(f['properties'].get(key)) for f in index.features])
+        units, unitOf = np.unique(pondUnits, return_inverse=True)
+        ponds = np.bincount(unitOf, minlength=len(units))
+        waterSum, classes = _rollup(len(units), unitOf, rows, days, water)
+        if old is not None:
+            previous = old[level]
+            keep = previous['days'] < since
+            # units come from the same snapshot, so they line up with the stored ones
+            allDays = np.concatenate([previous['days'][keep], days])
+            waterSum = np.concatenate([previous['waterSum'][:, keep], waterSum], axis=1)
+            classes = np.concatenate([previous['classes'][:, keep], classes], axis=1)
+        else:
+            allDays = days
+        with atomicFile(rollupPath(level)) as f:
+            np.savez(f, units=units, ponds=ponds, days=allDays, waterSum=waterSum, classes=classes)
+
+    lasts = dict((str(u), int(s['time'][-1])) for u, s in series.items())
+    writeJson(statePath(), {'snapshot': snapshot, 'lasts': lasts, 'updated': time.time()})
+    log.info("Rollups: %d days recomputed for %d ponds", len(days), len(series))
+    return len(days)
+
+
+_loaded = {}
+_lock = threading.Lock()
+
+
+def _load(level):
+    mtime = modifiedTime(rollupPath(level))
+    if mtime is None:
+        return None
+    cached = _loaded.get(level)
+    if cached is None or cached[0] != mtime:
+        with _lock:
+            cached = _loaded.get(level)
+            if cached is None or cached[0] != mtime:
+                with np.load(rollupPath(level)) as data:
+                    rollup = dict((k, data[k]) for k in data.files)
+                rollup['unitIndex'] = dict((u, i) for i, u in enumerate(rollup['units'].tolist()))
+                cached = _loaded[level] = (mtime, rollup)
+    return cached[1]
+
+
+def loadRollups():
+    """Stored rollups of every level, None when one was never built
+    """
+    rollups = dict((level, _load(level)) for level in LEVELS)
+    return None if any(r is None for r in rollups.values()) else rollups
+
+
+def unitSeries(level, unit, start=None, end=None):
+    """Ponds of a unit and its rollup per day in [start, end), None for an unknown level, unit or missing rollups
+
+    Each day is [time, {"waterFraction": mean over the ponds with a value, "observed": ponds acquired,
+    "classes": {class: ponds}}].
+    """
+    rollup = _load(level) if level in LEVELS else None
+    if rollup is None:
+        return None
+    i = rollup['unitIndex'].get(str(unit))
+    if i is None:
+        return None
+    days = rollup['days']
+    lo = 0 if start is None else int(np.searchsorted(days, start))
+    hi = len(days) if end is None else int(np.searchsorted(days, end))
+    values = []
+    for j in range(lo, hi):
+        classes = rollup['classes'][i, j]
+        observed = int(classes.sum())
+        if not observed:
+            continue
+        valued = int(classes[:3].sum())
+        values.append([int(days[j]), {
+            'waterFraction': float(rollup['waterSum'][i, j]) / valued if valued else None,
+            'observed': observed,
+            'classes': dict(zip(CLASSES, classes.tolist())),
+        }])
+    return {'ponds': int(rollup['ponds'][i]), 'values': values}
+
+
+def levelUnits(level):
+    """Units of a level that have a rollup, None without rollups
+    """
+    rollup = _load(level) if level in LEVELS else None
+    return None if rollup is None else rollup['units'].tolist()
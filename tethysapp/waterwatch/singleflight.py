@@ -0,0 +1,75 @@
+import threading
+from collections import defaultdict
+
+
+class _Flight(object):
+    __slots__ = ('done', 'result', 'error', 'waiters')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """Coalesce concurrent identical computations
+
+    do(key, fn) runs fn unless a call with the same key is already running, in which case it waits
+    for that call and shares its result (or its exception). Keys are (endpoint, ...) tuples, the
+    first element is used to break the statistics down per endpoint.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._stats = defaultdict(lambda: {'calls': 0, 'coalesced': 0})
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            stats = self._stats[key[0]]
+            stats['calls'] += 1
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                flight.waiters += 1
+                stats['coalesced'] += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn(*args, **kwargs)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+    def running(self, key):
+        with self._lock:
+            return key in self._flights
+
+    def inFlight(self):
+        with self._lock:
+            return len(self._flights)
+
+    def stats(self):
+        """Calls and coalesced calls per endpoint, with the share of calls that were coalesced
+        """
+        with self._lock:
+            result = {}
+            for endpoint, stats in self._stats.items():
+                result[endpoint] = dict(stats, hitRate=stats['coalesced'] / float(stats['calls'] or 1))
+            return result
+
+
+flights = SingleFlight()
@@ -0,0 +1,254 @@
+import threading
+from collections import defaultdict
+
+import ee
+import numpy as np
+
+from . import ee_client
+from .layers import getLayer
+from .storage import dataPath, readJson, writeJson, modifiedTime
+
+# collections that are snapshotted locally and the property identifying each feature
+SNAPSHOTS = {
+    'ponds': 'uniqID',
+    'region': 'id_reg',
+    'commune': 'id_com',
+    'arrondissement': 'id_arro',
+    'village': 'OBJECTID',
+}
+
+# getInfo refuses collections larger than 5000 elements, download in pages
+PAGE_SIZE = 2000
+
+
+def _polygons(geometry):
+    """Split a GeoJSON geometry into a list of polygons, each a list of (n, 2) ring arrays
+    """
+    if geometry is None:
+        return []
+    gtype = geometry['type']
+    if gtype == 'Polygon':
+        return [[np.asarray(ring, dtype=float)[:, :2] for ring in geometry['coordinates'] if len(ring) > 2]]
+    if gtype == 'MultiPolygon':
+        return [[np.asarray(ring, dtype=float)[:, :2] for ring in poly if len(ring) > 2]
+                for poly in geometry['coordinates']]
+    if gtype == 'GeometryCollection':
+        return [poly for geom in geometry['geometries'] for poly in _polygons(geom)]
+    return []
+
+
+class _Ring(object):
+    __slots__ = ('xi', 'yi', 'xj', 'yj')
+
+    def __init__(self, ring):
+        self.xi = ring[:, 0]
+        self.yi = ring[:, 1]
+        self.xj = np.roll(self.xi, 1)
+        self.yj = np.roll(self.yi, 1)
+
+    def crossings(self, x, y):
+        """Edges crossed by a ray from each point towards +x, for a point or arrays of points
+        """
+        x, y = np.asarray(x, dtype=float)[..., None], np.asarray(y, dtype=float)[..., None]
+        # edges with yi == yj are never selected by the first test
+        straddles = (self.yi > y) != (self.yj > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xCross = (self.xj - self.xi) * (y - self.yi) / (self.yj - self.yi) + self.xi
+        return np.count_nonzero(straddles & (x < xCross), axis=-1)
+
+
+def _insideRings(rings, points):
+    """Even-odd test of (n, 2) points against all rings of a geometry, so holes are excluded
+    """
+    return sum(_Ring(ring).crossings(points[:, 0], points[:, 1]) for ring in rings) % 2 == 1
+
+
+def _edges(rings):
+    return np.concatenate([np.concatenate([ring, np.roll(ring, -1, axis=0)], axis=1) for ring in rings])
+
+
+def _turn(o, a, b):
+    return (a[..., 0] - o[..., 0]) * (b[..., 1] - o[..., 1]) - (a[..., 1] - o[..., 1]) * (b[..., 0] - o[..., 0])
+
+
+def ringsIntersect(a, b):
+    """True when the areas of two geometries given as lists of (n, 2) ring arrays overlap
+
+    One has a vertex inside the other or two of their edges cross.
+    """
+    a, b = [r for r in a if len(r) > 2], [r for r in b if len(r) > 2]
+    if not a or not b:
+        return False
+    if _insideRings(a, np.concatenate(b)).any() or _insideRings(b, np.concatenate(a)).any():
+        return True
+    ea, eb = _edges(a)[:, None, :], _edges(b)[None, :, :]
+    p, q, r, s = ea[..., :2], ea[..., 2:], eb[..., :2], eb[..., 2:]
+    crosses = (_turn(r, s, p) * _turn(r, s, q) < 0) & (_turn(p, q, r) * _turn(p, q, s) < 0)
+    return bool(crosses.any())
+
+
+def rings(geometry):
+    """All rings of a GeoJSON geometry as (n, 2) arrays
+    """
+    return [ring for poly in _polygons(geometry) for ring in poly]
+
+
+class PolygonIndex(object):
+    """Uniform grid over polygon bounding boxes with an exact point-in-polygon test
+
+    Query results keep the order of the source collection so a lookup returns the same
+    feature as filterBounds(point).first() would on the server.
+    """
+
+    def __init__(self, features, key=None):
+        self.features = features
+        self.key = key
+        self._polys = []
+        bounds = np.full((len(features), 4), np.nan)
+        for i, feature in enumerate(features):
+            polys = _polygons(feature.get('geometry'))
+            self._polys.append([[_Ring(r) for r in poly] for poly in polys])
+            points = [ring for poly in polys for ring in poly]
+            if points:
+                points = np.concatenate(points)
+                bounds[i] = [points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max()]
+        self.bounds = bounds
+
+        valid = ~np.isnan(bounds[:, 0])
+        if valid.any():
+            sizes = np.concatenate([bounds[valid, 2] - bounds[valid, 0], bounds[valid, 3] - bounds[valid, 1]])
+            self.cellSize = max(float(np.median(sizes)) * 2, 1e-6)
+            self.origin = bounds[valid, :2].min(axis=0)
+        else:
+            self.cellSize = 1.0
+            self.origin = np.zeros(2)
+
+        self._grid = defaultdict(list)
+        for i in np.flatnonzero(valid):
+            x0, y0 = self._cell(bounds[i, 0], bounds[i, 1])
+            x1, y1 = self._cell(bounds[i, 2], bounds[i, 3])
+            for cx in range(x0, x1 + 1):
+                for cy in range(y0, y1 + 1):
+                    self._grid[(cx, cy)].append(i)
+
+        self._byKey = {}
+        if key is not None:
+            for i, feature in enumerate(features):
+                self._byKey.setdefault(feature['properties'].get(key), i)
+
+    def _cell(self, x, y):
+        return (int(np.floor((x - self.origin[0]) / self.cellSize)),
+                int(np.floor((y - self.origin[1]) / self.cellSize)))
+
+    def contains(self, i, x, y):
+        b = self.bounds[i]
+        if not (b[0] <= x <= b[2] and b[1] <= y <= b[3]):
+            return False
+        for rings in self._polys[i]:
+            # even-odd over all rings so holes are excluded
+            if sum(ring.crossings(x, y) for ring in rings) % 2 == 1:
+                return True
+        return False
+
+    def query(self, lon, lat):
+        """Index of the first feature containing the point, None when no feature does
+        """
+        x, y = float(lon), float(lat)
+        for i in self._grid.get(self._cell(x, y), ()):
+            if self.contains(i, x, y):
+                return i
+        return None
+
+    def feature(self, lon, lat):
+        i = self.query(lon, lat)
+        return None if i is None else self.features[i]
+
+    def intersecting(self, west, south, east, north):
+        """Indexes of the features whose bounding box intersects a lon/lat bbox, in collection order
+        """
+        b = self.bounds
+        with np.errstate(invalid='ignore'):
+            hits = (b[:, 0] <= east) & (b[:, 1] <= north) & (b[:, 2] >= west) & (b[:, 3] >= south)
+        return np.flatnonzero(hits).tolist()
+
+    def get(self, value):
+        i = self._byKey.get(value)
+        return None if i is None else self.features[i]
+
+    def __len__(self):
+        return len(self.features)
+
+
+def snapshotPath(name):
+    return dataPath('snapshots', name + '.geojson')
+
+
+def downloadCollection(collection, pageSize=PAGE_SIZE):
+    """Download every feature of a FeatureCollection, page by page
+    """
+    size = ee_client.getInfo(collection.size())
+    features = []
+    for offset in range(0, size, pageSize):
+        page = ee_client.getInfo(ee.FeatureCollection(collection.toList(pageSize, offset)))
+        features.extend(page['features'])
+    return features
+
+
+def refreshSnapshot(name):
+    """Download a collection from Earth Engine and replace its local GeoJSON snapshot
+    """
+    features = downloadCollection(getLayer(name))
+    writeJson(snapshotPath(name), {'type': 'FeatureCollection', 'features': features})
+    return len(features)
+
+
+def checkSnapshot(name):
+    """Compare the identifiers of the local snapshot against the server collection
+    """
+    key = SNAPSHOTS[name]
+    serverIds = set(ee_client.getInfo(getLayer(name).aggregate_array(key)))
+    index = getIndex(name)
+    localIds = set() if index is None else set(f['properties'].get(key) for f in index.features)
+    return {
+        'name': name,
+        'server': len(serverIds),
+        'local': len(localIds),
+        'missing': sorted(serverIds - localIds, key=str),
+        'extra': sorted(localIds - serverIds, key=str),
+        'consistent': serverIds == localIds,
+    }
+
+
+_indexes = {}
+_indexLock = threading.Lock()
+
+
+def getIndex(name):
+    """Index of a local snapshot, reloaded when the snapshot file changes, None without a snapshot
+    """
+    path = snapshotPath(name)
+    mtime = modifiedTime(path)
+    if mtime is None:
+        return None
+    cached = _indexes.get(name)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with _indexLock:
+        cached = _indexes.get(name)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        data = readJson(path)
+        if data is None:
+            return None
+        index = PolygonIndex(data['features'], key=SNAPSHOTS.get(name))
+        _indexes[name] = (mtime, index)
+        return index
+
+
+def locate(name, lon, lat):
+    """Snapshot feature of a collection under a point, None without a snapshot or a hit
+    """
+    index = getIndex(name)
+    if index is None:
+        return None
+    return index.feature(lon, lat)
@@ -0,0 +1,55 @@
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+
+from . import config
+
+# local snapshots and precomputed tables live in the app workspace unless configured otherwise
+DATA_DIR = getattr(config, 'DATA_DIR',
+                   os.path.join(os.path.dirname(os.path.abspath(__file__)), 'workspaces', 'app_workspace'))
+
+
+def dataPath(*parts):
+    """Path of a file under DATA_DIR, the parent folder is created if needed
+    """
+    path = os.path.join(DATA_DIR, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+@contextmanager
+def atomicFile(path, mode='wb'):
+    """Write to a temporary file next to path and move it in place once complete
+
+    Readers in other workers either see the old file or the new one, never a partial write.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def readJson(path, default=None):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return default
+
+
+def writeJson(path, obj):
+    with atomicFile(path, 'w') as f:
+        json.dump(obj, f)
+
+
+def modifiedTime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
@@ -0,0 +1,197 @@
+"""Round trips and wall time of the WaterWatch request paths, against the fake Earth Engine backend
+
+    python -m tethysapp.waterwatch.tests.benchmark [--latency SECONDS] [--json]
+
+Every path is requested through its ajax view, in three states:
+    server  nothing stored locally, every lookup falls back to Earth Engine
+    local   after the localCache.py jobs (snapshots, catalogs, time series, hypsometry, forecasts)
+    cached  the same request again, answered by the result cache
+
+The check for a new acquisition, made once per CHECK_INTERVAL by each worker, happens before
+measuring and is not counted. The exit status is 1 when a path needs more round trips than BUDGETS.
+"""
+import argparse
+import contextlib
+import io
+import json
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from unittest import mock
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure()
+
+from django.test import RequestFactory
+
+from .. import acquisitions
+from .. import ajax_controllers
+from .. import forcing
+from .. import forecast_batch
+from .. import hypsometry
+from .. import pond_catalog
+from .. import pond_classes
+from .. import result_cache
+from .. import rollups
+from .. import spatial_index
+from .. import storage
+from .. import utilities
+from . import fake_ee
+
+# path -> (ajax view, http method)
+PATHS = OrderedDict([
+    ('checkFeature', ('timeseries', 'post')),
+    ('forecastFeature', ('forecast', 'post')),
+    ('details', ('details', 'post')),
+    ('pondsList', ('getPondsList', 'get')),
+    ('getMNDWI', ('mndwi', 'post')),
+])
+
+STATES = ('server', 'local', 'cached')
+
+# most round trips each path may make, a change going over them is a regression
+BUDGETS = {
+    'server': {'checkFeature': 2, 'forecastFeature': 3, 'details': 4, 'pondsList': 2, 'getMNDWI': 4},
+    # the two map ids of a clicked image are the only calls left once the local data exists
+    'local': {'checkFeature': 0, 'forecastFeature': 0, 'details': 0, 'pondsList': 0, 'getMNDWI': 2},
+    'cached': dict.fromkeys(PATHS, 0),
+}
+
+
+def resetResultCache():
+    cache = result_cache.TieredCache(pond_classes.latestAcquisition)
+    utilities.cache = ajax_controllers.cache = cache
+    shutil.rmtree(result_cache.cacheDir(), ignore_errors=True)
+
+
+@contextlib.contextmanager
+def scratchState():
+    """An empty data folder and empty in-memory caches for the duration of the block
+    """
+    tmp = tempfile.mkdtemp(prefix='waterwatch-benchmark-')
+    patches = [
+        mock.patch.object(storage, 'DATA_DIR', tmp),
+        mock.patch.object(result_cache, 'DATA_DIR', tmp),
+        mock.patch.object(utilities, 'cache', None),
+        mock.patch.object(ajax_controllers, 'cache', None),
+        # prefetched images would be counted against the next path
+        mock.patch.object(utilities, 'MNDWI_PREFETCH', 0),
+        mock.patch.object(pond_classes, '_latest', {'checked': 0, 'time': None}),
+        mock.patch.object(pond_catalog, '_cached', None),
+        mock.patch.object(acquisitions, '_catalog', None),
+        mock.patch.object(hypsometry, '_table', None),
+        mock.patch.object(forecast_batch, '_store', None),
+        mock.patch.object(forcing, 'cache', forcing.ForcingCache()),
+        mock.patch.dict(spatial_index._indexes, clear=True),
+        mock.patch.dict(rollups._loaded, clear=True),
+    ]
+    for patch in patches:
+        patch.start()
+    try:
+        resetResultCache()
+        yield tmp
+    finally:
+        for patch in reversed(patches):
+            patch.stop()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def buildLocalData():
+    """What the localCache.py jobs leave behind, computed against the installed backend
+    """
+    for name in spatial_index.SNAPSHOTS:
+        spatial_index.refreshSnapshot(name)
+    pond_catalog.rebuildCatalog()
+    acquisitions.refreshCatalog(full=True)
+    utilities.updateTimeSeriesStore()
+    hypsometry.rebuildTable()
+    forecast_batch.runBatch()
+
+
+def clickTarget(backend):
+    """Center of the first named pond and the time of the newest image, what a user clicks
+    """
+    pond = next(f for f in backend.collection(fake_ee.PONDS) if f._properties.get('Nom'))
+    centroid, _ = pond_catalog.featureCentroid(pond._geometry)
+    newest = max(image._properties['system:time_start'] for image in backend.collection(fake_ee.WATER))
+    return centroid, newest
+
+
+def measure(backend, path, point, xValue):
+    view, method = PATHS[path]
+    data = {'lon': point[0], 'lat': point[1]}
+    if path == 'getMNDWI':
+        data.update(xValue=xValue, yValue=0.5)
+    request = getattr(RequestFactory(), method)('/apps/waterwatch/', data, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+    backend.reset()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        response = getattr(ajax_controllers, view)(request)
+    seconds = time.perf_counter() - start
+
+    body = json.loads(response.content)
+    if 'error' in body:
+        raise RuntimeError("%s: %s" % (path, body['error']))
+    return {'roundTrips': backend.roundTrips(), 'getInfo': backend.calls['getInfo'],
+            'getMapId': backend.calls['getMapId'], 'seconds': seconds}
+
+
+def run(latency=0.0, backend=None):
+    """Measure every path in every state
+
+    Returns {state: {path: {roundTrips, getInfo, getMapId, seconds}}}.
+    """
+    backend = backend or fake_ee.sampleBackend()
+    results = OrderedDict()
+    with fake_ee.install(backend), scratchState():
+        point, xValue = clickTarget(backend)
+        pond_classes.latestAcquisition()
+        for state in STATES:
+            if state == 'local':
+                backend.latency = 0.0
+                buildLocalData()
+            if state != 'cached':
+                resetResultCache()
+            backend.latency = latency
+            results[state] = OrderedDict((path, measure(backend, path, point, xValue)) for path in PATHS)
+    return results
+
+
+def overBudget(results):
+    """(state, path, round trips, budget) of every path needing more round trips than its budget
+    """
+    return [(state, path, result['roundTrips'], BUDGETS[state][path])
+            for state, paths in results.items() for path, result in paths.items()
+            if result['roundTrips'] > BUDGETS[state][path]]
+
+
+def report(results):
+    lines = ['%-8s %-16s %11s %8s %9s %9s' % ('state', 'path', 'round trips', 'getInfo', 'getMapId', 'seconds')]
+    for state, paths in results.items():
+        for path, r in paths.items():
+            lines.append('%-8s %-16s %11d %8d %9d %9.3f' % (state, path, r['roundTrips'], r['getInfo'],
+                                                              r['getMapId'], r['seconds']))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every round trip')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args(argv)
+
+    results = run(args.latency)
+    print(json.dumps(results, indent=2) if args.json else report(results))
+    failures = overBudget(results)
+    for state, path, roundTrips, budget in failures:
+        print("%s %s: %d round trips, budget %d" % (state, path, roundTrips, budget), file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1509 @@
+"""In-process stand-in for the part of the Earth Engine client the app uses
+
+Objects are evaluated eagerly with NumPy on small synthetic rasters and polygons held by a
+Backend, so nothing needs credentials or a network. Only getInfo and getMapId are round trips:
+each one is counted by the backend and sleeps for its latency first, which is how a slow
+server is simulated.
+
+    backend = sampleBackend(latency=0.05)
+    with install(backend):
+        utilities.checkFeature(lon, lat)
+    print(backend.calls)
+
+Differences from the server worth knowing about:
+  - every image lives on the single pixel grid of the backend, the scale of reductions is ignored
+  - masked pixels are NaN, a mask is wherever a band is not NaN
+  - filterBounds compares bounding boxes, or tests point in polygon when one side is a point
+  - both branches of Algorithms.If are evaluated, and operations on the null image returned by
+    first() of an empty collection raise at once instead of when the result is requested
+"""
+import calendar
+import copy
+import datetime
+import json
+import math
+import re
+import sys
+import threading
+import time
+import warnings
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from unittest import mock
+
+import ee as _ee
+import numpy as np
+from ee.ee_exception import EEException
+
+from ..spatial_index import _polygons
+
+METERS_PER_DEGREE = 111320.0
+WORLD = [-180.0, -90.0, 180.0, 90.0]
+
+_backend = None
+
+
+def _current():
+    if _backend is None:
+        raise EEException("The fake Earth Engine backend is not installed")
+    return _backend
+
+
+def Initialize(*args, **kwargs):
+    pass
+
+
+def ServiceAccountCredentials(*args, **kwargs):
+    return None
+
+
+# ---------------------------------------------------------------------------------------------
+# values
+
+
+def _raw(value):
+    """Python value of numbers, strings, dates, lists and dictionaries, other objects are kept
+    """
+    if isinstance(value, (Number, String, Date)):
+        return value._value
+    if isinstance(value, List):
+        return [_raw(v) for v in value._value]
+    if isinstance(value, Dictionary):
+        return dict((k, _raw(v)) for k, v in value._value.items())
+    if type(value) is ComputedObject:
+        return _raw(value._value)
+    if isinstance(value, (list, tuple)):
+        return [_raw(v) for v in value]
+    if isinstance(value, dict):
+        return dict((k, _raw(v)) for k, v in value.items())
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _wrap(value):
+    if isinstance(value, ComputedObject):
+        return value
+    if isinstance(value, (bool, int, float)):
+        return Number(value)
+    if isinstance(value, str):
+        return String(value)
+    if isinstance(value, (list, tuple)):
+        return List(value)
+    if isinstance(value, dict):
+        return Dictionary(value)
+    return ComputedObject(value)
+
+
+def _plain(value):
+    """JSON value returned by getInfo
+    """
+    if isinstance(value, ComputedObject):
+        return value._info()
+    if isinstance(value, (list, tuple)):
+        return [_plain(v) for v in value]
+    if isinstance(value, dict):
+        return dict((k, _plain(v)) for k, v in value.items())
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def _scalar(value, ints=False):
+    value = float(value)
+    if math.isnan(value) or math.isinf(value):
+        return None
+    if ints and value.is_integer():
+        return int(value)
+    return value
+
+
+def _truthy(value):
+    value = _raw(value)
+    return True if isinstance(value, ComputedObject) else bool(value)
+
+
+def _millis(value):
+    value = _raw(value)
+    if isinstance(value, str):
+        return Date(value)._value
+    return int(value)
+
+
+class ComputedObject(object):
+    def __init__(self, value=None):
+        self._value = value
+
+    def _info(self):
+        return _plain(self._value)
+
+    def getInfo(self):
+        _current().roundTrip('getInfo')
+        return copy.deepcopy(self._info())
+
+    def serialize(self):
+        # objects are evaluated already, equal results make equal keys
+        return json.dumps(self._info(), sort_keys=True, default=str)
+
+
+class _Null(ComputedObject):
+    """Result of first() on an empty collection
+    """
+
+    def _info(self):
+        return None
+
+
+def _op(fn, name):
+    def apply(a, b):
+        with np.errstate(all='ignore'):
+            out = np.asarray(fn(a, b), dtype=np.float64)
+        out = np.where(np.isinf(out), np.nan, out)
+        if name in _COMPARISONS:
+            out = np.where(np.isnan(a) | np.isnan(b), np.nan, out)
+        return out
+    return apply
+
+
+_COMPARISONS = ('gt', 'gte', 'lt', 'lte', 'eq', 'neq', 'And', 'Or')
+_BINARY = {
+    'add': np.add,
+    'subtract': np.subtract,
+    'multiply': np.multiply,
+    'divide': np.divide,
+    'pow': np.power,
+    'min': np.fmin,
+    'max': np.fmax,
+    'gt': np.greater,
+    'gte': np.greater_equal,
+    'lt': np.less,
+    'lte': np.less_equal,
+    'eq': np.equal,
+    'neq': np.not_equal,
+    'And': lambda a, b: (a != 0) & (b != 0),
+    'Or': lambda a, b: (a != 0) | (b != 0),
+}
+_UNARY = {
+    'abs': np.abs,
+    'sqrt': np.sqrt,
+    'tan': np.tan,
+    'sin': np.sin,
+    'cos': np.cos,
+    'round': np.round,
+    'Not': lambda a: np.where(np.isnan(a), np.nan, a == 0),
+    'float': lambda a: a,
+    'double': lambda a: a,
+    'toFloat': lambda a: a,
+    'int': np.trunc,
+    'toInt': np.trunc,
+    'uint8': lambda a: np.trunc(np.clip(a, 0, 255)),
+    'byte': lambda a: np.trunc(np.clip(a, 0, 255)),
+}
+
+
+class Number(ComputedObject):
+    def __init__(self, number):
+        super(Number, self).__init__(_raw(number))
+
+    def _number(self, name):
+        if self._value is None:
+            raise EEException("Number.%s: Parameter 'left' is required." % name)
+        return np.float64(self._value)
+
+
+def _numberBinary(name, fn):
+    def method(self, right):
+        if isinstance(right, Image):
+            return getattr(Image(self), name)(right)
+        value = _raw(right)
+        if value is None:
+            raise EEException("Number.%s: Parameter 'right' is required." % name)
+        out = fn(self._number(name), np.float64(value))
+        ints = name in ('add', 'subtract', 'multiply') and isinstance(self._value, int) and isinstance(value, int)
+        return Number(_scalar(out, ints))
+    method.__name__ = name
+    return method
+
+
+def _numberUnary(name, fn):
+    def method(self):
+        out = _scalar(fn(self._number(name)), name in ('int', 'toInt', 'uint8', 'byte', 'round'))
+        return Number(out)
+    method.__name__ = name
+    return method
+
+
+for _name, _fn in _BINARY.items():
+    setattr(Number, _name, _numberBinary(_name, _op(_fn, _name)))
+for _name, _fn in _UNARY.items():
+    setattr(Number, _name, _numberUnary(_name, _fn))
+
+
+class String(ComputedObject):
+    def __init__(self, string):
+        super(String, self).__init__(_raw(string))
+
+
+class Date(ComputedObject):
+    UNITS = {'second': 1000, 'minute': 60 * 1000, 'hour': 3600 * 1000, 'day': 24 * 3600 * 1000,
+             'week': 7 * 24 * 3600 * 1000}
+
+    def __init__(self, date, tz=None):
+        date = _raw(date)
+        if isinstance(date, str):
+            parsed = datetime.datetime.strptime(date[:10], '%Y-%m-%d')
+            date = calendar.timegm(parsed.timetuple()) * 1000
+        if date is None:
+            raise EEException("Date: Parameter 'value' is required.")
+        super(Date, self).__init__(int(date))
+
+    def _info(self):
+        return {'type': 'Date', 'value': self._value}
+
+    def millis(self):
+        return Number(self._value)
+
+    def advance(self, delta, unit):
+        delta, unit = _raw(delta), _raw(unit)
+        if unit in ('month', 'year'):
+            when = datetime.datetime.utcfromtimestamp(self._value / 1000.)
+            months = when.month - 1 + int(delta) * (12 if unit == 'year' else 1)
+            when = when.replace(year=when.year + months // 12, month=months % 12 + 1)
+            return Date(calendar.timegm(when.timetuple()) * 1000)
+        return Date(self._value + int(round(delta * self.UNITS[unit])))
+
+    def difference(self, start, unit):
+        return Number((self._value - Date(start)._value) / float(self.UNITS[_raw(unit)]))
+
+    def format(self, fmt=None):
+        return String(datetime.datetime.utcfromtimestamp(self._value / 1000.).isoformat())
+
+
+class List(ComputedObject):
+    def __init__(self, items):
+        if isinstance(items, List):
+            items = items._value
+        elif type(items) is ComputedObject:
+            items = items._value
+        super(List, self).__init__(list(items))
+
+    @staticmethod
+    def sequence(start, end=None, step=1, count=None):
+        start, end, step = _raw(start), _raw(end), _raw(step)
+        if count is not None:
+            return List([start + i * step for i in range(int(_raw(count)))])
+        values = []
+        value = start
+        while value <= end:
+            values.append(value)
+            value += step
+        return List(values)
+
+    def get(self, index):
+        return _wrap(self._value[int(_raw(index))])
+
+    def add(self, element):
+        return List(self._value + [element])
+
+    def cat(self, other):
+        return List(self._value + List(other)._value)
+
+    def slice(self, start, end=None, step=None):
+        end = None if end is None else int(_raw(end))
+        return List(self._value[int(_raw(start)):end:step])
+
+    def size(self):
+        return Number(len(self._value))
+
+    length = size
+
+    def contains(self, element):
+        return Number(int(_raw(element) in _raw(self)))
+
+    def map(self, baseAlgorithm):
+        return List([baseAlgorithm(_wrap(v)) for v in self._value])
+
+    def iterate(self, function, first):
+        for v in self._value:
+            first = function(_wrap(v), first)
+        return first
+
+    def reduce(self, reducer):
+        values = np.array([np.nan if v is None else v for v in _raw(self)], dtype=np.float64)
+        outputs = reducer._reduce(values)
+        if len(outputs) == 1:
+            return Number(list(outputs.values())[0])
+        return Dictionary(outputs)
+
+
+class Dictionary(ComputedObject):
+    def __init__(self, d=None):
+        if isinstance(d, Dictionary):
+            d = d._value
+        elif type(d) is ComputedObject:
+            d = d._value
+        # keys are sorted on the server
+        super(Dictionary, self).__init__(OrderedDict(sorted((d or {}).items())))
+
+    def get(self, key, defaultValue=None):
+        key = _raw(key)
+        if key in self._value:
+            return _wrap(self._value[key])
+        if defaultValue is not None:
+            return _wrap(defaultValue)
+        raise EEException("Dictionary.get: Dictionary does not contain key: '%s'." % key)
+
+    def values(self, keys=None):
+        keys = self._value.keys() if keys is None else _raw(keys)
+        return List([self._value[k] for k in keys])
+
+    def keys(self):
+        return List(list(self._value.keys()))
+
+    def contains(self, key):
+        return Number(int(_raw(key) in self._value))
+
+    def set(self, key, value):
+        d = dict(self._value)
+        d[_raw(key)] = value
+        return Dictionary(d)
+
+    def combine(self, second, overwrite=True):
+        d = dict(self._value)
+        for k, v in Dictionary(second)._value.items():
+            if overwrite or k not in d:
+                d[k] = v
+        return Dictionary(d)
+
+    def size(self):
+        return Number(len(self._value))
+
+
+# ---------------------------------------------------------------------------------------------
+# geometries
+
+
+def _coords(geometry):
+    """Every vertex of a GeoJSON geometry as an (n, 2) array
+    """
+    if geometry is None:
+        return np.empty((0, 2))
+    gtype = geometry['type']
+    if gtype == 'GeometryCollection':
+        parts = [_coords(g) for g in geometry['geometries']]
+        return np.concatenate(parts) if parts else np.empty((0, 2))
+    coords = np.asarray(geometry['coordinates'], dtype=np.float64)
+    return coords.reshape(-1, coords.shape[-1])[:, :2]
+
+
+def _bbox(geometry):
+    if geometry is None:
+        return WORLD
+    points = _coords(geometry)
+    if not len(points):
+        return None
+    return [points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max()]
+
+
+def _rectangle(west, south, east, north):
+    return {'type': 'Polygon', 'geodesic': False,
+            'coordinates': [[[west, south], [east, south], [east, north], [west, north], [west, south]]]}
+
+
+def _inside(geometry, x, y):
+    """Even-odd point in polygon test of the arrays x, y against every polygon of a geometry
+    """
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    inside = np.zeros(x.shape, dtype=bool)
+    for rings in _polygons(geometry):
+        crossings = np.zeros(x.shape, dtype=np.int64)
+        for ring in rings:
+            for xi, yi, xj, yj in zip(ring[:, 0], ring[:, 1], np.roll(ring[:, 0], 1), np.roll(ring[:, 1], 1)):
+                if yi == yj:
+                    continue
+                straddles = (yi > y) != (yj > y)
+                xCross = (xj - xi) * (y - yi) / (yj - yi) + xi
+                crossings += straddles & (x < xCross)
+        inside |= crossings % 2 == 1
+    return inside
+
+
+def _intersects(a, b):
+    if a is None or b is None:
+        return True
+    if a['type'] == 'Point':
+        a, b = b, a
+    if b['type'] == 'Point':
+        x, y = b['coordinates'][:2]
+        if not _polygons(a):
+            box = _bbox(a)
+            return box is not None and box[0] <= x <= box[2] and box[1] <= y <= box[3]
+        return bool(_inside(a, x, y))
+    ba, bb = _bbox(a), _bbox(b)
+    if ba is None or bb is None:
+        return False
+    return ba[0] <= bb[2] and bb[0] <= ba[2] and ba[1] <= bb[3] and bb[1] <= ba[3]
+
+
+def _area(geometry):
+    """Planar area in square meters, degrees scaled at the latitude of each ring
+    """
+    total = 0.0
+    for rings in _polygons(geometry):
+        for i, ring in enumerate(rings):
+            x, y = ring[:, 0], ring[:, 1]
+            area = abs(np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y)) / 2
+            area *= METERS_PER_DEGREE ** 2 * math.cos(math.radians(y.mean()))
+            total += area if i == 0 else -area
+    return total
+
+
+def _geometryOf(obj):
+    """GeoJSON geometry of a geometry, feature, collection or image
+    """
+    if isinstance(obj, Geometry):
+        return obj._value
+    if isinstance(obj, (Feature, Image)):
+        return obj._geojson()
+    if isinstance(obj, Collection):
+        return obj.geometry()._value
+    if isinstance(obj, dict):
+        return obj
+    raise EEException("Invalid geometry: %r" % (obj,))
+
+
+class Geometry(ComputedObject):
+    def __init__(self, geoJson, opt_proj=None, opt_geodesic=None):
+        if isinstance(geoJson, Geometry):
+            geoJson = geoJson._value
+        super(Geometry, self).__init__(geoJson)
+
+    @staticmethod
+    def Point(coords, *args, **kwargs):
+        coords = _raw(coords)
+        if not isinstance(coords, list):
+            coords = [coords, _raw(args[0])]
+        return Geometry({'type': 'Point', 'coordinates': [float(c) for c in coords[:2]]})
+
+    @staticmethod
+    def Rectangle(coords, *args, **kwargs):
+        coords = _raw(coords)
+        if not isinstance(coords, list):
+            coords = [coords] + [_raw(a) for a in args[:3]]
+        coords = np.asarray(coords, dtype=np.float64).ravel()
+        return Geometry(_rectangle(*coords[:4]))
+
+    @staticmethod
+    def Polygon(coords, *args, **kwargs):
+        coords = _raw(coords)
+        if np.asarray(coords).ndim == 2:
+            coords = [coords]
+        return Geometry({'type': 'Polygon', 'coordinates': coords})
+
+    def area(self, maxError=None, proj=None):
+        return Number(_area(self._value))
+
+    def bounds(self, maxError=None, proj=None):
+        return Geometry(_rectangle(*(_bbox(self._value) or [0, 0, 0, 0])))
+
+    def coordinates(self):
+        return List(self._value.get('coordinates', []))
+
+    def type(self):
+        return String(self._value['type'])
+
+    def intersects(self, right, maxError=None, proj=None):
+        return Number(int(_intersects(self._value, _geometryOf(right))))
+
+
+class Projection(ComputedObject):
+    def nominalScale(self):
+        return Number(self._value)
+
+
+# ---------------------------------------------------------------------------------------------
+# reducers and filters
+
+
+def _nanReducer(fn, empty=np.nan):
+    def reduce(values, axis=0):
+        valid = ~np.isnan(values)
+        with warnings.catch_warnings(), np.errstate(all='ignore'):
+            warnings.simplefilter('ignore', RuntimeWarning)
+            out = fn(values, axis=axis)
+        return np.where(valid.any(axis=axis), out, empty)
+    return reduce
+
+
+def _first(values, axis=0):
+    return np.take(values, 0, axis=axis) if values.shape[axis] else np.full(np.delete(values.shape, axis), np.nan)
+
+
+def _firstNonNull(values, axis=0):
+    if not values.shape[axis]:
+        return np.full(np.delete(values.shape, axis), np.nan)
+    index = np.expand_dims(np.argmax(~np.isnan(values), axis=axis), axis)
+    return np.take_along_axis(values, index, axis=axis).squeeze(axis)
+
+
+def _count(values, axis=0):
+    return np.sum(~np.isnan(values), axis=axis).astype(np.float64)
+
+
+class Reducer(ComputedObject):
+    """List of (output name, function reducing an array along an axis, NaN ignored)
+    """
+
+    @staticmethod
+    def mean():
+        return Reducer([('mean', _nanReducer(np.nanmean))])
+
+    @staticmethod
+    def stdDev():
+        return Reducer([('stdDev', _nanReducer(np.nanstd))])
+
+    @staticmethod
+    def sum():
+        return Reducer([('sum', _nanReducer(np.nansum, 0.0))])
+
+    @staticmethod
+    def min():
+        return Reducer([('min', _nanReducer(np.nanmin))])
+
+    @staticmethod
+    def max():
+        return Reducer([('max', _nanReducer(np.nanmax))])
+
+    @staticmethod
+    def median():
+        return Reducer([('median', _nanReducer(np.nanmedian))])
+
+    @staticmethod
+    def count():
+        return Reducer([('count', _count)])
+
+    @staticmethod
+    def first():
+        return Reducer([('first', _first)])
+
+    @staticmethod
+    def firstNonNull():
+        return Reducer([('first', _firstNonNull)])
+
+    @staticmethod
+    def toList(numOptional=None):
+        # only meaningful for reduceColumns, which returns the rows themselves
+        return Reducer([('list', None)])
+
+    def combine(self, reducer2, outputPrefix=None, sharedInputs=False):
+        prefix = outputPrefix or ''
+        return Reducer(self._value + [(prefix + name, fn) for name, fn in reducer2._value])
+
+    def _outputs(self):
+        return [name for name, _ in self._value]
+
+    def _reduce(self, values, axis=0):
+        """Outputs for an array of values, scalars (None when empty) for 1-d input, arrays otherwise
+        """
+        values = np.asarray(values, dtype=np.float64)
+        outputs = OrderedDict()
+        for name, fn in self._value:
+            out = fn(values, axis=axis)
+            outputs[name] = _scalar(out) if values.ndim == 1 else out
+        return outputs
+
+
+class Filter(ComputedObject):
+    """Predicate on the properties of a feature or image
+    """
+
+    OPERATORS = {
+        'equals': 'eq', 'not_equals': 'neq', 'less_than': 'lt', 'greater_than': 'gt',
+        'not_less_than': 'gte', 'not_greater_than': 'lte',
+    }
+
+    @staticmethod
+    def _compare(name, value, test):
+        value = _raw(value)
+
+        def predicate(props):
+            left = props.get(name)
+            return left is not None and test(left, value)
+        return Filter(predicate)
+
+    @staticmethod
+    def eq(name, value):
+        return Filter._compare(name, value, lambda a, b: a == b)
+
+    @staticmethod
+    def neq(name, value):
+        return Filter(lambda props: props.get(name) != _raw(value))
+
+    @staticmethod
+    def gt(name, value):
+        return Filter._compare(name, value, lambda a, b: a > b)
+
+    @staticmethod
+    def gte(name, value):
+        return Filter._compare(name, value, lambda a, b: a >= b)
+
+    @staticmethod
+    def lt(name, value):
+        return Filter._compare(name, value, lambda a, b: a < b)
+
+    @staticmethod
+    def lte(name, value):
+        return Filter._compare(name, value, lambda a, b: a <= b)
+
+    @staticmethod
+    def inList(leftField, rightValue):
+        values = _raw(rightValue)
+        return Filter(lambda props: props.get(leftField) in values)
+
+    @staticmethod
+    def metadata(name, operator, value):
+        return getattr(Filter, Filter.OPERATORS[operator])(name, value)
+
+    @staticmethod
+    def And(*filters):
+        return Filter(lambda props: all(f._value(props) for f in filters))
+
+    @staticmethod
+    def Or(*filters):
+        return Filter(lambda props: any(f._value(props) for f in filters))
+
+    def Not(self):
+        return Filter(lambda props: not self._value(props))
+
+
+# ---------------------------------------------------------------------------------------------
+# features and images
+
+
+class _Element(ComputedObject):
+    """Properties shared by features and images
+    """
+
+    def _props(self):
+        raise NotImplementedError
+
+    def _withProps(self, props):
+        raise NotImplementedError
+
+    def get(self, property):
+        return _wrap(self._props().get(_raw(property)))
+
+    def set(self, *args):
+        props = dict(self._props())
+        if len(args) == 1:
+            updates = _raw(args[0]).items()
+        else:
+            updates = zip(args[::2], args[1::2])
+        for key, value in updates:
+            props[_raw(key)] = _raw(value)
+        return self._withProps(props)
+
+    def toDictionary(self, properties=None):
+        props = self._props()
+        keys = props.keys() if properties is None else _raw(properties)
+        return Dictionary(dict((k, props[k]) for k in keys if k in props))
+
+    def propertyNames(self):
+        return List(list(self._props().keys()))
+
+    def copyProperties(self, source=None, properties=None, exclude=None):
+        props = dict(self._props())
+        copied = source._props()
+        keys = copied.keys() if properties is None else _raw(properties)
+        for key in keys:
+            if key in copied and key not in (exclude or ()):
+                props[key] = copied[key]
+        return self._withProps(props)
+
+
+class Feature(_Element):
+    def __init__(self, geom, opt_properties=None):
+        self._null = False
+        if type(geom) is ComputedObject:
+            geom = geom._value
+        if isinstance(geom, Feature):
+            geometry, props, self._null = geom._geometry, dict(geom._properties), geom._null
+        elif isinstance(geom, _Null):
+            geometry, props, self._null = None, {}, True
+        elif isinstance(geom, dict) and geom.get('type') == 'Feature':
+            geometry, props = geom.get('geometry'), dict(geom.get('properties') or {})
+        elif geom is None or isinstance(geom, (Geometry, dict)):
+            geometry, props = None if geom is None else _geometryOf(geom), {}
+        else:
+            raise EEException("Feature: invalid geometry %r" % (geom,))
+        if opt_properties is not None:
+            props.update(_raw(opt_properties))
+        self._geometry = geometry
+        self._properties = props
+        super(Feature, self).__init__(None)
+
+    def _check(self):
+        if self._null:
+            raise EEException("Feature: Parameter 'feature' is required.")
+
+    def _props(self):
+        self._check()
+        return self._properties
+
+    def _withProps(self, props):
+        return Feature(self._geometry, props)
+
+    def _geojson(self):
+        self._check()
+        return self._geometry
+
+    def _info(self):
+        if self._null:
+            return None
+        props = dict((k, v) for k, v in self._properties.items() if k != 'system:index')
+        info = {'type': 'Feature', 'geometry': copy.deepcopy(self._geometry), 'properties': _plain(props)}
+        if 'system:index' in self._properties:
+            info['id'] = str(self._properties['system:index'])
+        return info
+
+    def geometry(self, maxError=None, proj=None, geodesics=None):
+        return Geometry(self._geojson())
+
+    def area(self, maxError=None, proj=None):
+        return Number(_area(self._geojson()))
+
+
+class _Tiles(object):
+    def __init__(self, url_format):
+        self.url_format = url_format
+
+
+class Image(_Element):
+    def __init__(self, args=None, version=None):
+        self._null = False
+        self._bandsDict = OrderedDict()
+        self._properties = {}
+        self._footprint = None
+        if type(args) is ComputedObject:
+            args = args._value
+        if isinstance(args, Image):
+            self._copyFrom(args)
+        elif isinstance(args, _Null):
+            self._null = True
+        elif isinstance(args, str):
+            self._copyFrom(_current().image(args))
+        elif isinstance(args, (list, tuple)):
+            for i, value in enumerate(args):
+                self._bandsDict['constant' if i == 0 else 'constant_%d' % i] = np.float64(_raw(value))
+        elif args is not None:
+            value = _raw(args)
+            if not isinstance(value, (int, float)):
+                raise EEException("Image: invalid argument %r" % (args,))
+            self._bandsDict['constant'] = np.float64(value)
+        super(Image, self).__init__(None)
+
+    @staticmethod
+    def _make(bands, properties=None, footprint=None):
+        image = Image()
+        image._bandsDict = OrderedDict(bands)
+        image._properties = dict(properties or {})
+        image._footprint = footprint
+        return image
+
+    def _copyFrom(self, other):
+        self._null = other._null
+        self._bandsDict = OrderedDict(other._bandsDict)
+        self._properties = dict(other._properties)
+        self._footprint = other._footprint
+
+    def _bands(self):
+        if self._null:
+            raise EEException("Image: Parameter 'image' is required.")
+        return self._bandsDict
+
+    def _props(self):
+        self._bands()
+        return self._properties
+
+    def _withProps(self, props):
+        return Image._make(self._bands(), props, self._footprint)
+
+    def _geojson(self):
+        self._bands()
+        return self._footprint
+
+    def _like(self, bands, keepProperties=True):
+        return Image._make(bands, self._properties if keepProperties else {}, self._footprint)
+
+    def _map(self, fn, keepProperties=True):
+        return self._like(OrderedDict((k, fn(v)) for k, v in self._bands().items()), keepProperties)
+
+    def _info(self):
+        if self._null:
+            return None
+        info = {'type': 'Image', 'bands': [{'id': name} for name in self._bandsDict],
+                'properties': _plain(self._properties)}
+        if 'system:id' in self._properties:
+            info['id'] = self._properties['system:id']
+        return info
+
+    def _binary(self, other, fn):
+        a, b = self._bands(), other._bands()
+        if len(a) == 1 and len(b) > 1:
+            first = list(a.values())[0]
+            bands = OrderedDict((name, fn(first, v)) for name, v in b.items())
+        elif len(b) == 1:
+            second = list(b.values())[0]
+            bands = OrderedDict((name, fn(v, second)) for name, v in a.items())
+        elif len(a) == len(b):
+            bands = OrderedDict((name, fn(u, v)) for (name, u), v in zip(a.items(), b.values()))
+        else:
+            raise EEException("Image: images must have the same number of bands or a single band.")
+        return Image._make(bands, {}, self._footprint or other._footprint)
+
+    @staticmethod
+    def pixelArea():
+        grid = _current().grid
+        return Image._make({'area': grid.pixelArea()})
+
+    def select(self, *args):
+        names = None
+        if len(args) == 2 and isinstance(_raw(args[0]), list) and isinstance(_raw(args[1]), list):
+            selectors, names = _raw(args[0]), _raw(args[1])
+        elif len(args) >= 1 and isinstance(_raw(args[0]), list):
+            selectors = _raw(args[0])
+        else:
+            selectors = [_raw(a) for a in args if a is not None]
+        bands = self._bands()
+        chosen = []
+        for selector in selectors:
+            if isinstance(selector, int):
+                matched = [list(bands)[selector]]
+            else:
+                matched = [b for b in bands if re.fullmatch(selector, b)]
+            if not matched:
+                raise EEException("Image.select: Pattern '%s' did not match any bands." % selector)
+            chosen.extend(b for b in matched if b not in chosen)
+        if names is not None:
+            return self._like(OrderedDict((n, bands[b]) for n, b in zip(names, chosen)))
+        return self._like(OrderedDict((b, bands[b]) for b in chosen))
+
+    def rename(self, names, *args):
+        names = _raw(names)
+        if not isinstance(names, list):
+            names = [names] + [_raw(a) for a in args]
+        bands = self._bands()
+        if len(names) != len(bands):
+            raise EEException("Image.rename: The number of names (%d) must match the number of bands (%d)."
+                              % (len(names), len(bands)))
+        return self._like(OrderedDict(zip(names, bands.values())))
+
+    def bandNames(self):
+        return List(list(self._bands().keys()))
+
+    def addBands(self, srcImg, names=None, overwrite=False):
+        bands = OrderedDict(self._bands())
+        added = srcImg._bands()
+        if names is not None:
+            added = OrderedDict((n, v) for n, v in added.items() if n in _raw(names))
+        for name, values in added.items():
+            if name in bands and not overwrite:
+                # duplicate names get a numbered suffix as on the server
+                i = 1
+                while '%s_%d' % (name, i) in bands:
+                    i += 1
+                name = '%s_%d' % (name, i)
+            bands[name] = values
+        return self._like(bands)
+
+    def mask(self, mask=None):
+        if mask is not None:
+            return self.updateMask(mask)
+        return self._map(lambda v: np.where(np.isnan(v), 0.0, 1.0))
+
+    def updateMask(self, mask):
+        m = list(Image(mask)._bands().values())[0]
+        return self._map(lambda v: np.where(np.isnan(m) | (m == 0), np.nan, v))
+
+    def unmask(self, value=None, sameFootprint=True):
+        fill = 0.0 if value is None else float(_raw(value))
+        return self._map(lambda v: np.where(np.isnan(v), fill, v))
+
+    def where(self, test, value):
+        t = list(Image(test)._bands().values())[0]
+        replacement = list(Image(value)._bands().values())[0]
+        return self._map(lambda v: np.where(~np.isnan(t) & (t != 0), replacement, v))
+
+    def clip(self, geometry):
+        geojson = _geometryOf(geometry)
+        grid = _current().grid
+        inside = _inside(geojson, grid.lon, grid.lat) if _polygons(geojson) else np.ones(grid.shape, dtype=bool)
+        image = self._map(lambda v: np.where(inside, v, np.nan))
+        image._footprint = geojson
+        return image
+
+    def normalizedDifference(self, bandNames=None):
+        bands = self._bands()
+        first, second = [bands[b] for b in _raw(bandNames)] if bandNames else list(bands.values())[:2]
+        with np.errstate(all='ignore'):
+            return self._like({'nd': (first - second) / (first + second)}, keepProperties=False)
+
+    def reduce(self, reducer):
+        grid = _current().grid
+        stack = np.stack([np.broadcast_to(v, grid.shape) for v in self._bands().values()])
+        return self._like(reducer._reduce(stack), keepProperties=False)
+
+    def _region(self, geometry):
+        grid = _current().grid
+        geojson = self._footprint if geometry is None else _geometryOf(geometry)
+        if geojson is None:
+            return np.ones(grid.shape, dtype=bool)
+        if _polygons(geojson):
+            return _inside(geojson, grid.lon, grid.lat)
+        # points and lines: the pixels holding their vertices
+        region = np.zeros(grid.shape, dtype=bool)
+        for x, y in _coords(geojson):
+            row, col = grid.pixelOf(x, y)
+            if row is not None:
+                region[row, col] = True
+        return region
+
+    def _reduceBands(self, reducer, region):
+        grid = _current().grid
+        bands = self._bands()
+        outputs = reducer._outputs()
+        result = OrderedDict()
+        for name, values in bands.items():
+            reduced = reducer._reduce(np.broadcast_to(values, grid.shape)[region])
+            for output, value in reduced.items():
+                if len(outputs) == 1:
+                    result[name] = value
+                else:
+                    result[output if len(bands) == 1 else '%s_%s' % (name, output)] = value
+        return result
+
+    def reduceRegion(self, reducer=None, geometry=None, scale=None, crs=None, crsTransform=None,
+                     bestEffort=False, maxPixels=None, tileScale=None):
+        return Dictionary(self._reduceBands(reducer, self._region(geometry)))
+
+    def reduceRegions(self, collection=None, reducer=None, scale=None, crs=None, crsTransform=None, tileScale=None):
+        single = len(self._bands()) == 1 and len(reducer._outputs()) == 1
+        features = []
+        for feature in collection._value:
+            reduced = self._reduceBands(reducer, self._region(feature))
+            if single:
+                reduced = {reducer._outputs()[0]: list(reduced.values())[0]}
+            features.append(feature.set(reduced))
+        return FeatureCollection(features)
+
+    def projection(self):
+        return Projection(_current().grid.scale())
+
+    def geometry(self, maxError=None, proj=None, geodesics=None):
+        return Geometry(self._geojson() or _rectangle(*WORLD))
+
+    def date(self):
+        return Date(self._props()['system:time_start'])
+
+    def getMapId(self, vis_params=None):
+        self._bands()
+        return _current().mapId(self)
+
+
+for _name, _fn in _BINARY.items():
+    def _imageBinary(self, image2, _fn=_op(_fn, _name)):
+        return self._binary(image2 if isinstance(image2, Image) else Image(image2), _fn)
+    _imageBinary.__name__ = _name
+    setattr(Image, _name, _imageBinary)
+for _name, _fn in _UNARY.items():
+    def _imageUnary(self, _fn=_fn):
+        with np.errstate(all='ignore'):
+            return self._map(lambda v: np.asarray(_fn(v), dtype=np.float64))
+    _imageUnary.__name__ = _name
+    setattr(Image, _name, _imageUnary)
+
+
+# ---------------------------------------------------------------------------------------------
+# collections
+
+
+class Collection(ComputedObject):
+    _type = None
+
+    def __init__(self, args=None):
+        if type(args) is ComputedObject:
+            args = args._value
+        if isinstance(args, str):
+            elements = _current().collection(args)
+        elif isinstance(args, (Collection, List)):
+            elements = list(args._value)
+        elif isinstance(args, (list, tuple)):
+            elements = list(args)
+        elif args is None:
+            elements = []
+        else:
+            elements = [args]
+        super(Collection, self).__init__([self._cast(e) for e in elements])
+
+    def _cast(self, element):
+        return element
+
+    def _new(self, elements):
+        collection = type(self)()
+        collection._value = list(elements)
+        return collection
+
+    def _info(self):
+        return {'type': self._type, 'features': [e._info() for e in self._value]}
+
+    def getMapId(self, vis_params=None):
+        return _current().mapId(self)
+
+    def map(self, algorithm, dropNulls=False):
+        results = []
+        for element in self._value:
+            result = algorithm(element)
+            if type(result) is ComputedObject:
+                result = result._value
+            if result is None and dropNulls:
+                continue
+            results.append(result)
+        return self._new(results)
+
+    def iterate(self, algorithm, first=None):
+        for element in self._value:
+            first = algorithm(element, first)
+        return first
+
+    def filter(self, filter):
+        return self._new(e for e in self._value if filter._value(e._props()))
+
+    def filterMetadata(self, name, operator, value):
+        return self.filter(Filter.metadata(name, operator, value))
+
+    def filterBounds(self, geometry):
+        geojson = _geometryOf(geometry)
+        return self._new(e for e in self._value if _intersects(e._geojson(), geojson))
+
+    def filterDate(self, start, opt_end=None):
+        start = _millis(Date(start))
+        end = start + 1 if opt_end is None else _millis(Date(opt_end))
+        return self._new(e for e in self._value if start <= e._props().get('system:time_start', -1) < end)
+
+    def sort(self, prop, opt_ascending=True):
+        present = [e for e in self._value if e._props().get(prop) is not None]
+        missing = [e for e in self._value if e._props().get(prop) is None]
+        present.sort(key=lambda e: e._props()[prop], reverse=not opt_ascending)
+        return self._new(present + missing)
+
+    def limit(self, maximum, opt_property=None, opt_ascending=True):
+        collection = self if opt_property is None else self.sort(opt_property, opt_ascending)
+        return self._new(collection._value[:int(_raw(maximum))])
+
+    def first(self):
+        if not self._value:
+            return _Null()
+        return self._value[0]
+
+    def size(self):
+        return Number(len(self._value))
+
+    def toList(self, count, offset=0):
+        offset = int(_raw(offset))
+        return List(self._value[offset:offset + int(_raw(count))])
+
+    def merge(self, collection2):
+        return self._new(self._value + list(collection2._value))
+
+    def aggregate_array(self, property):
+        return List([e._props()[property] for e in self._value if e._props().get(property) is not None])
+
+    def reduceColumns(self, reducer, selectors):
+        if reducer._outputs() != ['list']:
+            raise NotImplementedError("reduceColumns only supports Reducer.toList")
+        rows = [[e._props().get(s) for s in selectors] for e in self._value]
+        # like the server, rows with a null input are left out
+        return Dictionary({'list': [row for row in rows if None not in row]})
+
+    def _aggregate(self, property, reducer):
+        values = _raw(self.aggregate_array(property))
+        value = list(reducer._reduce(np.array(values, dtype=np.float64)).values())[0]
+        return Number(None if value is None else _scalar(value, all(isinstance(v, int) for v in values)))
+
+    def aggregate_max(self, property):
+        return self._aggregate(property, Reducer.max())
+
+    def aggregate_min(self, property):
+        return self._aggregate(property, Reducer.min())
+
+    def aggregate_sum(self, property):
+        return self._aggregate(property, Reducer.sum())
+
+    def aggregate_mean(self, property):
+        return self._aggregate(property, Reducer.mean())
+
+    def aggregate_count(self, property):
+        return Number(len(self.aggregate_array(property)._value))
+
+    def geometry(self, maxError=None):
+        parts = [e._geojson() for e in self._value if e._geojson() is not None]
+        polygons = [[ring.tolist() for ring in rings] for part in parts for rings in _polygons(part)]
+        if len(polygons) == len(parts):
+            return Geometry({'type': 'MultiPolygon', 'coordinates': polygons})
+        return Geometry({'type': 'GeometryCollection', 'geometries': parts})
+
+
+class FeatureCollection(Collection):
+    _type = 'FeatureCollection'
+
+    def __init__(self, args=None, opt_column=None):
+        super(FeatureCollection, self).__init__(args)
+
+    def _cast(self, element):
+        if isinstance(element, (Feature, Image)):
+            return element
+        return Feature(element)
+
+    def select(self, propertySelectors, newProperties=None, retainGeometry=True):
+        selectors = _raw(propertySelectors)
+        if not isinstance(selectors, list):
+            selectors = [selectors]
+        newProperties = _raw(newProperties)
+        features = []
+        for feature in self._value:
+            keys = [k for s in selectors for k in feature._props() if re.fullmatch(s, k)]
+            keys = list(OrderedDict.fromkeys(keys))
+            names = newProperties or keys
+            props = dict((n, feature._props()[k]) for n, k in zip(names, keys))
+            features.append(Feature(feature._geometry if retainGeometry else None, props))
+        return self._new(features)
+
+
+    def reduceToImage(self, properties, reducer):
+        # the value of the first feature covering each pixel, whatever the reducer
+        grid = _current().grid
+        name = _raw(properties)[0]
+        band = np.full(grid.shape, np.nan)
+        for feature in reversed(self._value):
+            value = feature._props().get(name)
+            if value is not None:
+                band[_inside(feature._geojson(), grid.lon, grid.lat)] = value
+        return Image._make([(reducer._outputs()[0], band)])
+
+
+class ImageCollection(Collection):
+    _type = 'ImageCollection'
+
+    def _cast(self, element):
+        return element if isinstance(element, Image) else Image(element)
+
+    @staticmethod
+    def fromImages(images):
+        return ImageCollection(images)
+
+    def select(self, selectors, opt_names=None, *args):
+        if opt_names is not None and not isinstance(_raw(opt_names), list):
+            args = (opt_names,) + args
+            opt_names = None
+        if args:
+            selectors = [selectors] + list(args)
+        if opt_names is None:
+            return self.map(lambda image: image.select(selectors))
+        return self.map(lambda image: image.select(selectors, opt_names))
+
+    def _stack(self, name):
+        grid = _current().grid
+        return np.stack([np.broadcast_to(image._bands()[name], grid.shape) for image in self._value])
+
+    def _footprint(self):
+        if not self._value or any(image._footprint is None for image in self._value):
+            return None
+        boxes = np.array([_bbox(image._footprint) for image in self._value])
+        return _rectangle(boxes[:, 0].min(), boxes[:, 1].min(), boxes[:, 2].max(), boxes[:, 3].max())
+
+    def _reduceImages(self, reducer, suffix=True):
+        if not self._value:
+            return Image._make({})
+        bands = OrderedDict()
+        for name in self._value[0]._bands():
+            for output, values in reducer._reduce(self._stack(name), axis=0).items():
+                bands['%s_%s' % (name, output) if suffix else name] = values
+        return Image._make(bands, {}, self._footprint())
+
+    def reduce(self, reducer, parallelScale=None):
+        return self._reduceImages(reducer)
+
+    def mean(self):
+        return self._reduceImages(Reducer.mean(), suffix=False)
+
+    def median(self):
+        return self._reduceImages(Reducer.median(), suffix=False)
+
+    def sum(self):
+        return self._reduceImages(Reducer.sum(), suffix=False)
+
+    def min(self):
+        return self._reduceImages(Reducer.min(), suffix=False)
+
+    def max(self):
+        return self._reduceImages(Reducer.max(), suffix=False)
+
+    def mosaic(self):
+        if not self._value:
+            return Image._make({})
+        bands = OrderedDict()
+        for name in self._value[0]._bands():
+            stack = self._stack(name)
+            # the last image is on top
+            bands[name] = _firstNonNull(stack[::-1], axis=0)
+        return Image._make(bands, {}, self._footprint())
+
+    def toBands(self):
+        bands = OrderedDict()
+        for i, image in enumerate(self._value):
+            index = image._props().get('system:index', str(i))
+            for name, values in image._bands().items():
+                bands['%s_%s' % (index, name)] = values
+        return Image._make(bands, {}, self._footprint())
+
+
+class _Landsat(object):
+    @staticmethod
+    def TOA(image):
+        return Image(image)
+
+    @staticmethod
+    def simpleCloudScore(image):
+        return Image(image).addBands(Image(0).rename('cloud'))
+
+
+class Algorithms(object):
+    Landsat = _Landsat
+
+    @staticmethod
+    def If(condition=None, trueCase=None, falseCase=None):
+        return trueCase if _truthy(condition) else falseCase
+
+
+# ---------------------------------------------------------------------------------------------
+# backend
+
+
+class Grid(object):
+    """North-up pixel grid, in degrees, shared by every image of a backend
+    """
+
+    def __init__(self, west, north, pixel, width, height):
+        self.west, self.north, self.pixel = west, north, pixel
+        self.shape = (height, width)
+        lon = west + (np.arange(width) + 0.5) * pixel
+        lat = north - (np.arange(height) + 0.5) * pixel
+        self.lon, self.lat = np.meshgrid(lon, lat)
+
+    def bounds(self):
+        height, width = self.shape
+        return [self.west, self.north - height * self.pixel, self.west + width * self.pixel, self.north]
+
+    def pixelOf(self, x, y):
+        row, col = int((self.north - y) // self.pixel), int((x - self.west) // self.pixel)
+        if 0 <= row < self.shape[0] and 0 <= col < self.shape[1]:
+            return row, col
+        return None, None
+
+    def scale(self):
+        return self.pixel * METERS_PER_DEGREE
+
+    def pixelArea(self):
+        return self.scale() ** 2 * np.cos(np.radians(self.lat))
+
+
+class Backend(object):
+    """Assets of the fake server and the round trips made against it
+
+    latency is the delay of every round trip in seconds, or a function of the kind of call
+    ('getInfo' or 'getMapId') returning it. calls counts the round trips per kind.
+    """
+
+    def __init__(self, grid, latency=0.0):
+        self.grid = grid
+        self.latency = latency
+        self.calls = Counter()
+        self._collections = {}
+        self._images = {}
+        self._lock = threading.Lock()
+
+    def addCollection(self, assetId, elements):
+        for i, element in enumerate(elements):
+            props = element._properties
+            props.setdefault('system:index', str(i))
+            if isinstance(element, Image):
+                props['system:id'] = '%s/%s' % (assetId, props['system:index'])
+                self._images[props['system:id']] = element
+        self._collections[assetId] = list(elements)
+
+    def addImage(self, assetId, image):
+        image._properties['system:id'] = assetId
+        self._images[assetId] = image
+
+    def collection(self, assetId):
+        if assetId not in self._collections:
+            raise EEException("Collection asset '%s' not found." % assetId)
+        return list(self._collections[assetId])
+
+    def image(self, assetId):
+        if assetId not in self._images:
+            raise EEException("Image asset '%s' not found." % assetId)
+        return self._images[assetId]
+
+    def roundTrip(self, kind):
+        delay = self.latency(kind) if callable(self.latency) else self.latency
+        if delay:
+            time.sleep(delay)
+        with self._lock:
+            self.calls[kind] += 1
+
+    def roundTrips(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+
+    def mapId(self, obj):
+        self.roundTrip('getMapId')
+        with self._lock:
+            mapid = 'fake-%d' % sum(self.calls.values())
+        return {'mapid': mapid, 'token': '', 'image': obj,
+                'tile_fetcher': _Tiles('https://earthengine.invalid/v1/%s/tiles/{z}/{x}/{y}' % mapid)}
+
+
+@contextmanager
+def install(backend):
+    """Point every module of the app that imported ee at this fake for the duration of the block
+    """
+    global _backend
+    from .. import layers
+    from .. import utilities  # imports the modules using ee so they can be patched
+
+    package = __name__.rsplit('.', 2)[0]
+    patches = [mock.patch.object(module, 'ee', sys.modules[__name__])
+               for name, module in list(sys.modules.items())
+               if name.startswith(package + '.') and getattr(module, 'ee', None) is _ee]
+    patches.append(mock.patch.object(layers, '_initialized', False))
+    previous, _backend = _backend, backend
+    for patch in patches:
+        patch.start()
+    layers.registry.invalidate()
+    try:
+        yield backend
+    finally:
+        for patch in reversed(patches):
+            patch.stop()
+        layers.registry.invalidate()
+        _backend = previous
+
+
+# ---------------------------------------------------------------------------------------------
+# sample data
+
+PONDS = 'projects/servir-wa/services/ephemeral_water_ferlo/ferlo_ponds'
+WATER = 'projects/servir-wa/services/ephemeral_water_ferlo/processed_ponds'
+DAY = 24 * 3600 * 1000
+
+
+def _feature(geometry, **props):
+    return Feature(geometry, props)
+
+
+def sampleBackend(rows=6, images=24, latency=0.0, seed=0):
+    """A rows x rows block of square ponds north of Dahra with the collections the app reads
+
+    Ponds fill and dry with the season, every processed_ponds image covers all of them and has
+    a Landsat scene at the same time, GFS and CFS precipitation surround the newest image.
+    """
+    rng = np.random.RandomState(seed)
+    spacing, size, pixel = 0.01, 0.005, 0.001
+    west, north = -14.45, 16.33
+    width = height = rows * 10
+    grid = Grid(west, north, pixel, width, height)
+    backend = Backend(grid, latency)
+    bounds = grid.bounds()
+    footprint = _rectangle(*bounds)
+    midLon, midLat = (bounds[0] + bounds[2]) / 2, (bounds[1] + bounds[3]) / 2
+
+    ponds, centers = [], []
+    for i in range(rows * rows):
+        x0 = west + (i % rows) * spacing + 0.0025
+        y0 = north - (i // rows) * spacing - 0.0025 - size
+        name = 'Mare %d' % (i // 2) if i % 5 else ''
+        ring = _rectangle(x0, y0, x0 + size, y0 + size)
+        ponds.append(_feature(ring, uniqID=i + 1, Nom=name, Sup=round(_area(ring) / 1e4, 2), id_reg=1,
+                              id_com=1 if x0 < midLon else 2, id_arro=1 if y0 > midLat else 2))
+        centers.append((x0 + size / 2, y0 + size / 2))
+    # below the 1 ha threshold of the ponds layer
+    ponds.append(_feature(_rectangle(bounds[2] - 0.0008, bounds[1] + 0.0003, bounds[2] - 0.0003, bounds[1] + 0.0008),
+                          uniqID=rows * rows + 1, Nom='Petite mare', Sup=0.3, id_reg=1, id_com=2, id_arro=2))
+    backend.addCollection(PONDS, ponds)
+
+    backend.addCollection('users/satigebelal/region', [_feature(footprint, id_reg=1, nom='Louga')])
+    backend.addCollection('users/satigebelal/commune', [
+        _feature(_rectangle(bounds[0], bounds[1], midLon, bounds[3]), id_com=1, nom='Ouarkhokh'),
+        _feature(_rectangle(midLon, bounds[1], bounds[2], bounds[3]), id_com=2, nom='Tessekere'),
+    ])
+    backend.addCollection('users/satigebelal/arrondissement', [
+        _feature(_rectangle(bounds[0], midLat, bounds[2], bounds[3]), id_arro=1, nom='Dahra'),
+        _feature(_rectangle(bounds[0], bounds[1], bounds[2], midLat), id_arro=2, nom='Yang-Yang'),
+    ])
+    backend.addCollection('users/satigebelal/Village', [
+        _feature({'type': 'Point', 'coordinates': [x + 0.004, y + 0.004]}, OBJECTID=j + 1, nom='Village %d' % j)
+        for j, (x, y) in enumerate(centers[::4])])
+    backend.addCollection('USDOS/LSIB_SIMPLE/2017', [_feature(footprint, country_na='Senegal')])
+
+    # water: a disc growing and shrinking with the season in every pond, some images partly cloudy
+    start = calendar.timegm(datetime.datetime(2019, 7, 1, 11, 35).timetuple()) * 1000
+    phases = rng.uniform(0, 2 * np.pi, len(centers))
+    water, scenes, times = [], [], []
+    for k in range(images):
+        t = start + k * 8 * DAY
+        when = datetime.datetime.utcfromtimestamp(t / 1000.)
+        band = np.zeros(grid.shape)
+        for (cx, cy), phase in zip(centers, phases):
+            fill = np.clip(0.5 + 0.6 * np.sin(2 * np.pi * k / images + phase), 0, 1)
+            band[np.hypot(grid.lon - cx, grid.lat - cy) <= np.sqrt(fill) * size / 2] = 1
+        if rng.uniform() < 0.25:
+            row, col = rng.randint(0, height // 2), rng.randint(0, width // 2)
+            band[row:row + height // 3, col:col + width // 3] = np.nan
+        index = when.strftime('LC08_205049_%Y%m%d') if k % 2 else when.strftime('%Y%m%dT113451_%Y%m%dT113448_T28PDB')
+        cloud = float(np.round(rng.uniform(0, 30), 1))
+        water.append(Image._make({'mndwi_water': band}, {'system:time_start': t, 'system:index': index,
+                                                         'CLOUD_COVER': cloud}, footprint))
+        scenes.append(Image._make(
+            dict((b, rng.uniform(0.02, 0.4) + np.zeros(grid.shape)) for b in ('B1', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'B10', 'B11')),
+            {'system:time_start': t, 'system:index': when.strftime('LC08_205049_%Y%m%d'), 'CLOUD_COVER': cloud,
+             'SUN_ELEVATION': 60.0}, footprint))
+        times.append(t)
+    backend.addCollection(WATER, water)
+    backend.addCollection('LANDSAT/LC08/C01/T1_RT', scenes)
+    backend.addCollection('COPERNICUS/S2', [])
+
+    # a bowl under every pond so the hypsometry has something to measure
+    elevation = 40 + 5 * (grid.lon - west) / (width * pixel)
+    for cx, cy in centers:
+        d = np.hypot(grid.lon - cx, grid.lat - cy) / (size / 2)
+        elevation = elevation - np.where(d < 1, 2.5 * (1 - d ** 2), 0)
+    backend.addImage('USGS/SRTMGL1_003', Image._make({'elevation': elevation}, {}, footprint))
+
+    # uniform over the grid, so averaging the forcing over a pond or the model output gives the same
+    newest = times[-1]
+    gfs = [Image._make({'total_precipitation_surface': rng.gamma(0.6, 2.0) + np.zeros(grid.shape)},
+                       {'system:time_start': newest, 'forecast_hours': hours}, footprint)
+           for hours in range(0, 16 * 24 + 1, 6)]
+    backend.addCollection('NOAA/GFS0P25', gfs)
+    cfs = [Image._make({'Precipitation_rate_surface_6_Hour_Average': rng.gamma(0.6, 2e-4) + np.zeros(grid.shape)},
+                       {'system:time_start': newest + hours * 3600 * 1000}, footprint)
+           for hours in range(-8 * 24, 24 + 1, 6)]
+    backend.addCollection('NOAA/CFSV2/FOR6H', cfs)
+    return backend
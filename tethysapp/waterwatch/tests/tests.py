@@ -1,5 +1,37 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import ee
+import numpy as np
+
 # Most of your test classes should inherit from TethysTestCase
 from tethys_sdk.testing import TethysTestCase
+from .. import forecast_model
+from .. import pond_catalog
+from .. import jobs
+from ..singleflight import SingleFlight
+from .. import storage
+from .. import spatial_index
+from .. import timeseries_store
+from .. import result_cache
+from .. import rollups
+from .. import acquisitions
+from .. import export_watermarks
+from .. import forcing
+from .. import forecast_batch
+from .. import utilities
+from .. import pond_classes
+from .. import ajax_controllers
+from .. import api
+from .. import metrics
+from . import benchmark
+from . import fake_ee
 
 # Use if your app has persistent stores that will be tested against.
 # Your app class from app.py must be passed as an argument to the TethysTestCase functions to both
@@ -164,3 +196,666 @@ class WaterwatchTestCase(TethysTestCase):
         context = response.context
         self.assertEqual(context['my_integer'], 10)
         '''
+
+
+def earth_engine_available():
+    try:
+        from ..layers import initializeEE
+        initializeEE()
+        return True
+    except Exception:
+        return False
+
+
+class ForecastModelTestCase(TethysTestCase):
+    """
+    Checks of the NumPy water balance model in forecast_model against the Earth Engine implementation in fClass.
+    """
+
+    def random_inputs(self, ponds=5, days=16):
+        rng = np.random.RandomState(42)
+        pArea = rng.uniform(1e4, 1e6, ponds)
+        return {
+            'pArea': pArea,
+            'So': pArea * rng.uniform(0.5, 2.0, ponds),
+            'initial': rng.uniform(0, 1, ponds),
+            'precip': rng.gamma(0.5, 0.01, (ponds, days)),
+            'prevPrecip': rng.gamma(0.5, 0.01, ponds),
+            'initIap': rng.uniform(0, 0.02, ponds),
+        }
+
+    def test_vectorized_matches_single_ponds(self):
+        inputs = self.random_inputs()
+        together = forecast_model.forecast(**inputs)
+        for i in range(len(inputs['pArea'])):
+            single = forecast_model.forecast(**{k: v[i:i + 1] for k, v in inputs.items()})
+            for key in together:
+                np.testing.assert_allclose(together[key][i], single[key][0])
+
+    def test_pct_area_is_bounded(self):
+        out = forecast_model.forecast(**self.random_inputs())
+        self.assertTrue(np.all(out['pctArea'] >= 0))
+        self.assertTrue(np.all(out['pctArea'] <= 1))
+
+    @unittest.skipUnless(earth_engine_available(), "Earth Engine credentials are not available")
+    def test_matches_earth_engine(self):
+        from .. import utilities
+
+        # a pond of ferlo_ponds near Ndiam Kagn
+        lon, lat = -14.40402, 16.28005
+        feature = utilities.sampledFeature('ponds', lon, lat)
+        selPond = utilities.selectPond(feature['properties']['uniqID'])
+        lastimg = utilities.getLayer('waterCollection').filterBounds(selPond).sort('system:time_start', False).first()
+        lastTime = ee.Date(ee.Image(lastimg).get('system:time_start'))
+
+        model = utilities.fClass(selPond, ee.Number(0.5), lastTime)
+        remote = model.forecast()
+        local = model.forecastLocal()
+
+        self.assertEqual([t for t, _ in remote], [t for t, _ in local])
+        np.testing.assert_allclose([v['water'] for _, v in local], [v['water'] for _, v in remote], atol=1e-3)
+
+
+class PondCatalogTestCase(TethysTestCase):
+    """
+    Checks of the centroids and deduplication of the pond catalog.
+    """
+
+    def square(self, x0, y0, size, name, uniqID):
+        ring = [[x0, y0], [x0 + size, y0], [x0 + size, y0 + size], [x0, y0 + size], [x0, y0]]
+        return {'type': 'Feature', 'geometry': {'type': 'Polygon', 'coordinates': [ring]},
+                'properties': {'Nom': name, 'uniqID': uniqID}}
+
+    def test_etag_revalidation(self):
+        etag = '"abc"'
+        self.assertTrue(ajax_controllers.etagMatches('"abc"', etag))
+        self.assertTrue(ajax_controllers.etagMatches('W/"abc"', etag))
+        self.assertTrue(ajax_controllers.etagMatches('"old", W/"abc"', etag))
+        self.assertTrue(ajax_controllers.etagMatches('*', etag))
+        self.assertFalse(ajax_controllers.etagMatches('"old"', etag))
+        self.assertFalse(ajax_controllers.etagMatches(None, etag))
+
+    def test_area_weighted_centroid(self):
+        # an L shape: the vertex mean and the area weighted centroid differ
+        ring = [[0, 0], [2, 0], [2, 1], [1, 1], [1, 2], [0, 2], [0, 0]]
+        centroid, bbox = pond_catalog.featureCentroid({'type': 'Polygon', 'coordinates': [ring]})
+        np.testing.assert_allclose(centroid, [5 / 6., 5 / 6.])
+        self.assertEqual(bbox, [0, 0, 2, 2])
+
+    def test_hole_is_subtracted(self):
+        outer = [[0, 0], [4, 0], [4, 4], [0, 4], [0, 0]]
+        hole = [[2, 1], [3, 1], [3, 3], [2, 3], [2, 1]]
+        centroid, _ = pond_catalog.featureCentroid({'type': 'Polygon', 'coordinates': [outer, hole]})
+        np.testing.assert_allclose(centroid, [(16 * 2 - 2 * 2.5) / 14., 2])
+
+    def test_names_are_unique_and_sorted(self):
+        features = [self.square(0, 0, 1, 'Keur', 1), self.square(5, 5, 1, 'Adia', 2),
+                    self.square(9, 9, 1, 'Keur', 3), self.square(7, 7, 1, None, 4)]
+        catalog = pond_catalog.buildCatalog(features)
+        self.assertEqual(catalog['names'], ['Adia', 'Keur'])
+        self.assertEqual(catalog['uniqIDs'], [2, 1])
+        self.assertEqual(catalog['etag'], pond_catalog.buildCatalog(features)['etag'])
+
+
+class JobsTestCase(TethysTestCase):
+    """
+    Checks of the SQLite backed job queue, with a stand-in task instead of Earth Engine.
+    """
+
+    def set_up(self):
+        self.tmp = tempfile.mkdtemp()
+        self.release = threading.Event()
+
+        def task(lon, lat):
+            self.release.wait(5)
+            return {"values": [[0, {"water": 0.5}]], "name": "pond"}
+
+        self.patches = [
+            mock.patch.object(jobs, 'databasePath', lambda: os.path.join(self.tmp, 'jobs.sqlite3')),
+            mock.patch.object(jobs, '_schemaReady', False),
+            mock.patch.object(jobs, 'locate', lambda name, lon, lat: {'properties': {'uniqID': 42}}),
+            mock.patch.dict(jobs.TASKS, {'timeseries': task}),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tear_down(self):
+        self.release.set()
+        for patch in self.patches:
+            patch.stop()
+
+    def wait(self, jobId):
+        for _ in range(50):
+            state = jobs.status(jobId)
+            if state['status'] in (jobs.DONE, jobs.FAILED):
+                return state
+            time.sleep(0.1)
+        self.fail("job did not finish")
+
+    def test_in_flight_jobs_are_shared(self):
+        first = jobs.submit('timeseries', -14.4, 16.3)
+        second = jobs.submit('timeseries', -14.4, 16.3)
+        self.assertEqual(first, second)
+        self.release.set()
+        state = self.wait(first)
+        self.assertEqual(state['status'], jobs.DONE)
+        self.assertEqual(state['result']['name'], 'pond')
+
+    def test_finished_jobs_are_not_reused(self):
+        self.release.set()
+        first = jobs.submit('timeseries', -14.4, 16.3)
+        self.wait(first)
+        second = jobs.submit('timeseries', -14.4, 16.3)
+        self.assertNotEqual(first, second)
+        self.wait(second)
+
+    def test_queued_jobs_wait_for_their_process(self):
+        # every worker busy: the jobs stay queued
+        with mock.patch.object(jobs, '_executor', mock.Mock()), mock.patch.object(jobs, 'JOB_TIMEOUT', -1):
+            waiting = jobs.submit('timeseries', -14.4, 16.3)
+            self.assertEqual(jobs.status(waiting)['status'], jobs.QUEUED)
+            self.assertEqual(jobs.submit('timeseries', -14.4, 16.3), waiting)
+
+            # a job of a process that is gone, e.g. before a restart
+            jobs._update(waiting, owner='%s:999999999:0' % jobs._BOOT)
+            self.assertEqual(jobs.status(waiting)['message'], 'lost')
+            self.assertNotEqual(jobs.submit('timeseries', -14.4, 16.3), waiting)
+
+    def test_unknown_job(self):
+        self.assertIsNone(jobs.status('missing'))
+        with self.assertRaises(ValueError):
+            jobs.submit('nothing', -14.4, 16.3)
+
+
+class SingleFlightTestCase(TethysTestCase):
+    """
+    Checks that concurrent identical calls share one computation.
+    """
+
+    def test_concurrent_calls_are_coalesced(self):
+        flights = SingleFlight()
+        calls = []
+        results = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return [[0, {"water": 0.5}]]
+
+        threads = [threading.Thread(target=lambda: results.append(flights.do(('timeseries', 1, None, None), compute)))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(results), 4)
+        stats = flights.stats()['timeseries']
+        self.assertEqual((stats['calls'], stats['coalesced']), (4, 3))
+
+    def test_errors_are_shared_and_not_kept(self):
+        flights = SingleFlight()
+
+        def fail():
+            raise ValueError("no image")
+
+        with self.assertRaises(ValueError):
+            flights.do(('forecast', 1, None, None), fail)
+        self.assertEqual(flights.do(('forecast', 1, None, None), lambda: 'ok'), 'ok')
+
+
+class TieredCacheTestCase(TethysTestCase):
+    """
+    Checks of the memory and disk tiers of the result cache and of the invalidation on new images.
+    """
+
+    def set_up(self):
+        self.tmp = tempfile.mkdtemp()
+        self.patches = [mock.patch.object(storage, 'DATA_DIR', self.tmp),
+                        mock.patch.object(result_cache, 'DATA_DIR', self.tmp)]
+        for patch in self.patches:
+            patch.start()
+        self.image = 1
+        self.computed = []
+
+    def tear_down(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def compute(self, uniqID):
+        self.computed.append(uniqID)
+        return [[0, {"water": 0.5}]]
+
+    def test_memory_then_disk(self):
+        cache = result_cache.TieredCache(lambda: self.image, maxEntries=1)
+        cache.fetch('timeseries', 1, self.compute, 1)
+        cache.fetch('timeseries', 1, self.compute, 1)
+        cache.fetch('timeseries', 2, self.compute, 2)
+        # evicted from memory, still on disk
+        self.assertEqual(cache.fetch('timeseries', 1, self.compute, 1), [[0, {"water": 0.5}]])
+        self.assertEqual(self.computed, [1, 2])
+        stats = cache.stats()['endpoints']['timeseries']
+        self.assertEqual((stats['memoryHits'], stats['diskHits'], stats['misses']), (1, 1, 2))
+        self.assertEqual(stats['evictions'], 2)
+
+    def test_new_image_invalidates(self):
+        cache = result_cache.TieredCache(lambda: self.image)
+        cache.fetch('timeseries', 1, self.compute, 1)
+        self.image = 2
+        cache.fetch('timeseries', 1, self.compute, 1)
+        self.assertEqual(self.computed, [1, 1])
+        self.assertEqual(cache.stats()['invalidations'], 1)
+
+    def test_expired_entries_are_recomputed(self):
+        cache = result_cache.TieredCache(lambda: self.image)
+        cache.fetch('mndwi', 1, self.compute, 1, ttl=-1)
+        cache.fetch('mndwi', 1, self.compute, 1, ttl=-1)
+        self.assertEqual(self.computed, [1, 1])
+
+    def test_prefetch_skips_known_images(self):
+        cache = result_cache.TieredCache(lambda: self.image)
+        cache.fetch('mndwi', [7, 9], dict)
+        flights = SingleFlight()
+        release = threading.Event()
+        running = threading.Thread(target=flights.do, args=(('mndwi', 7, 8, 8), release.wait))
+        running.start()
+        while not flights.running(('mndwi', 7, 8, 8)):
+            time.sleep(0.01)
+        submitted = []
+        prefetcher = mock.Mock(submit=lambda fn, *args: submitted.append(args))
+        values = [[t, {'water': 0.5}] for t in range(10)]
+        try:
+            with mock.patch.object(utilities, 'cache', cache), mock.patch.object(utilities, 'flights', flights), \
+                    mock.patch.object(utilities, '_prefetcher', prefetcher), \
+                    mock.patch.object(utilities, '_prefetching', set()), \
+                    mock.patch.object(utilities, 'MNDWI_PREFETCH_QUEUE', 2):
+                utilities.prefetchClickedImages(7, values)
+                utilities.prefetchClickedImages(7, values)
+        finally:
+            release.set()
+            running.join()
+
+        # 9 is cached, 8 is being computed, the queue holds two
+        self.assertEqual(submitted, [(7, 5), (7, 6)])
+
+    def test_disk_tier_is_bounded(self):
+        cache = result_cache.TieredCache(lambda: self.image, maxFiles=2)
+        for uniqID in range(5):
+            cache.fetch('mndwi', uniqID, self.compute, uniqID, ttl=60 + uniqID)
+        folder = os.path.dirname(cache._path('1', 'mndwi', 0))
+        now = time.time()
+
+        # an expired file is deleted when it is read
+        cache._memory.clear()
+        self.assertEqual(cache._lookup('1', 'mndwi', 0, now + 61), (None, None))
+        self.assertEqual(len(os.listdir(folder)), 4)
+        # the sweep drops the expired files, then the ones expiring first
+        self.assertEqual(cache.sweep(now + 61.5), 2)
+        self.assertEqual(sorted(os.listdir(folder)),
+                         sorted(os.path.basename(cache._path('1', 'mndwi', u)) for u in (3, 4)))
+
+    def test_failed_check_keeps_the_shared_tier(self):
+        cache = result_cache.TieredCache(lambda: self.image)
+        cache.fetch('timeseries', 1, self.compute, 1)
+
+        def down():
+            raise IOError("Earth Engine is down")
+
+        # a worker starting while the server cannot be asked
+        starting = result_cache.TieredCache(down)
+        starting.fetch('timeseries', 1, self.compute, 1)
+        self.assertEqual(os.listdir(result_cache.cacheDir()), ['1'])
+        # an older worker keeps its generation
+        cache._generation = down
+        cache.fetch('timeseries', 1, self.compute, 1)
+        self.assertEqual(self.computed, [1, 1])
+        # a worker still on an older image leaves the newer generation alone
+        self.image = 0
+        result_cache.TieredCache(lambda: self.image).fetch('timeseries', 1, self.compute, 1)
+        self.assertEqual(sorted(os.listdir(result_cache.cacheDir())), ['0', '1'])
+
+
+class AcquisitionCatalogTestCase(TethysTestCase):
+    """
+    Checks of the local image lookups of the acquisition catalog.
+    """
+
+    def set_up(self):
+        self.tmp = tempfile.mkdtemp()
+        day = 24 * 3600 * 1000
+        rows = [
+            {'id': 'a/LC08_1', 'index': 'LC08_1', 'time': 10 * day, 'cloud': 5.0, 'lower': [-16, 14], 'upper': [-14, 16]},
+            {'id': 'a/2019T_2', 'index': '20190105T113451_2', 'time': 12 * day, 'cloud': None, 'lower': [-14, 14], 'upper': [-12, 16]},
+            {'id': 'a/LC08_3', 'index': 'LC08_3', 'time': 20 * day, 'cloud': 1.0, 'lower': [-16, 14], 'upper': [-14, 16]},
+            # a tilted scene: its bbox reaches the south west corner, its footprint does not
+            {'id': 'a/LC08_4', 'index': 'LC08_4', 'time': 20 * day, 'cloud': 0.0, 'lower': [-16, 14], 'upper': [-14, 16],
+             'footprint': {'type': 'Polygon', 'coordinates': [[[-16, 16], [-14, 14], [-14, 16], [-16, 16]]]}},
+        ]
+        for r in rows:
+            r.setdefault('footprint', self.box(r['lower'] + r['upper']))
+        self.day = day
+        self.patches = [mock.patch.object(storage, 'DATA_DIR', self.tmp),
+                        mock.patch.object(acquisitions, 'latestAcquisition', lambda: 20 * day)]
+        for patch in self.patches:
+            patch.start()
+        with open(acquisitions.catalogPath(), 'wb') as f:
+            np.savez(f, **acquisitions._arrays(rows))
+
+    def tear_down(self):
+        for patch in self.patches:
+            patch.stop()
+
+    def box(self, bbox):
+        west, south, east, north = bbox
+        return {'type': 'Polygon', 'coordinates': [[[west, south], [east, south], [east, north], [west, north], [west, south]]]}
+
+    def test_find_clicked_date(self):
+        image = acquisitions.find(12 * self.day, self.box([-13.5, 15, -13.4, 15.1]))
+        self.assertEqual(image['id'], 'a/2019T_2')
+        self.assertEqual(image['sensor'], 'S2')
+        self.assertIsNone(image['cloud'])
+        self.assertIsNone(acquisitions.find(13 * self.day, self.box([-13.5, 15, -13.4, 15.1])))
+
+    def test_latest_covering_image(self):
+        self.assertEqual(acquisitions.latest(self.box([-15, 15, -14.9, 15.1]))['id'], 'a/LC08_4')
+        self.assertEqual(acquisitions.latest(self.box([-13.5, 15, -13.4, 15.1]))['time'], 12 * self.day)
+
+    def test_footprints_not_bboxes(self):
+        corner = self.box([-15.9, 14.1, -15.8, 14.2])
+        self.assertEqual(acquisitions.latest(corner)['id'], 'a/LC08_3')
+        self.assertEqual(acquisitions.find(20 * self.day, corner)['id'], 'a/LC08_3')
+        # a pond across the tip of the tilted scene, with no vertex of one inside the other
+        self.assertEqual(acquisitions.latest(self.box([-14.6, 14.5, -13.9, 14.51]))['id'], 'a/LC08_4')
+
+    def test_stale_catalog_is_not_used(self):
+        with mock.patch.object(acquisitions, 'latestAcquisition', lambda: 30 * self.day):
+            self.assertIsNone(acquisitions.latest(self.box([-15, 15, -14.9, 15.1])))
+
+
+class ExportWatermarkTestCase(TethysTestCase):
+    """
+    Checks that the export watermark moves past exported images and images that never export.
+    """
+
+    def test_failing_image_is_given_up(self):
+        day = 24 * 3600 * 1000
+        names, times = ['a', 'b', 'c'], [1 * day, 2 * day, 3 * day]
+        entry = export_watermarks.advance(None, names, times, set(), set(names), 3)
+        self.assertNotIn('time_start', entry)
+        # a and c are exported, b fails every time
+        entry = export_watermarks.advance(entry, names, times, {'a', 'c'}, {'b'}, 3)
+        self.assertEqual((entry['time_start'], entry['attempts']), (1 * day, {'b': 2}))
+        self.assertEqual(export_watermarks.givenUp(entry, 3), set())
+        entry = export_watermarks.advance(entry, names, times, {'a', 'c'}, {'b'}, 3)
+        self.assertEqual(entry['time_start'], 3 * day)
+        self.assertEqual(export_watermarks.givenUp(entry, 3), {'b'})
+        # once b shows up after all it is forgotten
+        entry = export_watermarks.advance(entry, names, times, {'a', 'b', 'c'}, set(), 3)
+        self.assertEqual((entry['time_start'], entry['attempts']), (3 * day, {}))
+
+    def test_saved_atomically(self):
+        path = os.path.join(tempfile.mkdtemp(), 'watermarks.json')
+        self.assertEqual(export_watermarks.loadWatermarks(path), {})
+        export_watermarks.saveWatermarks(path, {'ferlo': {'time_start': 1}})
+        self.assertEqual(export_watermarks.loadWatermarks(path), {'ferlo': {'time_start': 1}})
+        shutil.rmtree(os.path.dirname(path))
+
+
+class SeriesShapingTestCase(TethysTestCase):
+    """
+    Checks the date range and downsampling of pond time series.
+    """
+
+    def set_up(self):
+        day = 24 * 3600 * 1000
+        times = np.arange(400, dtype=np.int64) * 8 * day
+        water = np.sin(np.arange(400) / 10.0) ** 2
+        water[200] = 3.0
+        water[50] = np.nan
+        self.series = {'time': times, 'water': water, 'stddev': water / 10}
+
+    def test_lttb_keeps_ends_and_peaks(self):
+        reduced = timeseries_store.lttb(self.series, 50)
+        self.assertEqual(len(reduced['time']), 50)
+        self.assertEqual(reduced['time'][0], self.series['time'][0])
+        self.assertEqual(reduced['time'][-1], self.series['time'][-1])
+        self.assertIn(self.series['time'][200], reduced['time'])
+        self.assertFalse(np.isnan(reduced['water']).any())
+        self.assertIs(timeseries_store.lttb(self.series, 400), self.series)
+
+    def test_monthly_means(self):
+        binned = timeseries_store.binned(self.series, 'month')
+        months = self.series['time'].astype('datetime64[ms]').astype('datetime64[M]')
+        self.assertEqual(len(binned['time']), len(np.unique(months)))
+        first = months == months[0]
+        self.assertAlmostEqual(binned['water'][0], np.nanmean(self.series['water'][first]))
+        self.assertIn(binned['time'][5], self.series['time'])
+
+    def test_between_and_options(self):
+        options = utilities.seriesOptions({'start': '1970-02-01', 'end': '1970-02-28', 'max_points': '10'})
+        part = timeseries_store.between(self.series, options['start'], options['end'])
+        self.assertEqual(utilities.dateMillis('1970-02-01'), 31 * 24 * 3600 * 1000)
+        self.assertTrue(((part['time'] >= options['start']) & (part['time'] < options['end'])).all())
+        self.assertEqual(len(part['time']), 4)
+        with self.assertRaises(ValueError):
+            utilities.seriesOptions({'max_points': '2'})
+        with self.assertRaises(ValueError):
+            utilities.seriesOptions({'interval': 'year'})
+
+
+class FakeEarthEngineTestCase(TethysTestCase):
+    """
+    Round trip budgets of the request paths and the forecast, against the fake Earth Engine backend.
+    """
+
+    def test_round_trip_budgets(self):
+        results = benchmark.run()
+        self.assertEqual(benchmark.overBudget(results), [])
+        self.assertEqual(results['local']['getMNDWI']['getMapId'], 2)
+
+    def test_local_data_gives_the_server_answers(self):
+        backend = fake_ee.sampleBackend()
+        with fake_ee.install(backend), benchmark.scratchState():
+            point, xValue = benchmark.clickTarget(backend)
+            server = utilities.checkFeature(*point)[0], utilities.forecastFeature(*point)[0]
+            benchmark.buildLocalData()
+            benchmark.resetResultCache()
+            local = utilities.checkFeature(*point)[0], utilities.forecastFeature(*point)[0]
+
+        self.assertEqual(server[0], local[0])
+        self.assertTrue(any(v['water'] for _, v in local[0]))
+        self.assertEqual([t for t, _ in server[1]], [t for t, _ in local[1]])
+        np.testing.assert_allclose([v['water'] for _, v in server[1]], [v['water'] for _, v in local[1]], atol=1e-9)
+
+    def test_forecast_matches_local_model(self):
+        backend = fake_ee.sampleBackend()
+        with fake_ee.install(backend), mock.patch.object(forcing, 'cache', forcing.ForcingCache()):
+            point, modelDate = benchmark.clickTarget(backend)
+            selPond = utilities.selectPond(utilities.sampledId('ponds', *point))
+            model = utilities.fClass(selPond, fake_ee.Number(0.5), modelDate)
+            remote = model.forecast()
+            local = model.forecastLocal()
+
+        self.assertEqual([t for t, _ in remote], [t for t, _ in local])
+        np.testing.assert_allclose([v['water'] for _, v in local], [v['water'] for _, v in remote], atol=1e-9)
+
+    def test_pond_forcing_is_only_read(self):
+        backend = fake_ee.sampleBackend()
+        with fake_ee.install(backend), benchmark.scratchState():
+            point, modelDate = benchmark.clickTarget(backend)
+            uniqID = utilities.sampledId('ponds', *point)
+            backend.reset()
+            missing = forcing.cache.pondForcing(modelDate, uniqID)
+            roundTrips = backend.roundTrips()
+            forcing.cache.samples(modelDate)
+            stored = forcing.cache.pondForcing(modelDate, uniqID)
+
+        self.assertIsNone(missing)
+        self.assertEqual(roundTrips, 0)
+        self.assertEqual(stored['precip'].shape, (forcing.FORECAST_DAYS + 1,))
+
+    def test_forcing_is_sampled_over_the_given_ponds(self):
+        backend = fake_ee.sampleBackend()
+        with fake_ee.install(backend), benchmark.scratchState(), mock.patch.object(forcing, 'DISK_DAYS', 1e6):
+            _, modelDate = benchmark.clickTarget(backend)
+            cache = forcing.ForcingCache()
+            with mock.patch.object(cache, 'sample', wraps=cache.sample) as sample:
+                cache.samples(modelDate, [1, 2])
+                cache.samples(modelDate, [2, 3])
+                cache.samples(modelDate, [3, 1])
+            stored = forcing.ForcingCache().stored(modelDate)
+
+        self.assertEqual([c[0][1] for c in sample.call_args_list], [[1, 2], [3]])
+        self.assertEqual(sorted(stored[1]), [1, 2, 3])
+
+    def test_forecast_after_a_new_image_is_live(self):
+        backend = fake_ee.sampleBackend()
+        with fake_ee.install(backend), benchmark.scratchState():
+            point, _ = benchmark.clickTarget(backend)
+            benchmark.buildLocalData()
+            feature = utilities.sampledFeature('ponds', *point)
+            uniqID = feature['properties']['uniqID']
+            stored = forecast_batch.lookup(uniqID, feature['geometry'])
+            newest = acquisitions.latest(feature['geometry'])
+            with mock.patch.object(acquisitions, 'latest', lambda geometry: dict(newest, time=newest['time'] + 1)):
+                stale = forecast_batch.lookup(uniqID, feature['geometry'])
+
+        self.assertIsNotNone(stored)
+        self.assertIsNone(stale)
+
+    def test_calls_are_timed_per_call_site(self):
+        backend = fake_ee.sampleBackend()
+        registry = metrics.Registry()
+        with fake_ee.install(backend), benchmark.scratchState(), mock.patch.object(metrics, 'registry', registry):
+            point, _ = benchmark.clickTarget(backend)
+            request = benchmark.RequestFactory().post('/apps/waterwatch/', {'lon': point[0], 'lat': point[1]},
+                                                      HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            response = ajax_controllers.timeseries(request)
+            text = ajax_controllers.metricsText(request).content.decode()
+
+        timing = response['Server-Timing']
+        self.assertIn('ee.utilities.makeTimeSeries;dur=', timing)
+        self.assertIn('total;dur=', timing)
+        calls = sum(n for (site, kind, outcome), n in registry.calls.items() if outcome != 'memo')
+        self.assertEqual(calls, backend.roundTrips())
+        self.assertIn('waterwatch_ee_call_seconds_count{kind="getInfo",site="utilities.makeTimeSeries"} 1', text)
+        self.assertIn('waterwatch_requests_total{view="timeseries"} 1', text)
+        self.assertIn('waterwatch_result_cache_total{endpoint="timeseries",result="misses"}', text)
+
+    def test_bulk_time_series(self):
+        backend = fake_ee.sampleBackend()
+        with fake_ee.install(backend), benchmark.scratchState():
+            start = utilities.dateMillis('2019-10-01')
+            request = benchmark.RequestFactory().get('/apps/waterwatch/', {'commune': '1', 'start': '2019-10-01'})
+            rows = [json.loads(line) for line in b''.join(api.api_get_timeseries_bulk(request).streaming_content).splitlines()]
+            roundTrips = backend.roundTrips()
+            uniqID = rows[0]['uniqID']
+            expected = utilities.makeTimeSeries(utilities.getLayer('waterCollection'), utilities.selectPond(uniqID))
+
+            request = benchmark.RequestFactory().get('/apps/waterwatch/', {'uniqIDs': '%s,999' % uniqID})
+            unknown = [json.loads(line) for line in b''.join(api.api_get_timeseries_bulk(request).streaming_content).splitlines()]
+
+        communes = [f._properties['id_com'] for f in backend.collection(fake_ee.PONDS)[:-1]]
+        self.assertEqual(rows[-1], {'ponds': communes.count(1), 'errors': 0, 'success': 'success'})
+        # the pond selection and one batched reduction, instead of a request per pond
+        self.assertEqual(roundTrips, 3)
+        self.assertEqual([t for t, _ in rows[0]['values']], [t for t, _ in expected if t >= start])
+        np.testing.assert_allclose([v['water'] for _, v in rows[0]['values']],
+                                   [v['water'] for t, v in expected if t >= start], atol=1e-9)
+        self.assertEqual(unknown[0], {'uniqID': '999', 'error': 'Unknown pond'})
+        self.assertEqual(unknown[1]['uniqID'], uniqID)
+        self.assertEqual(unknown[-1]['errors'], 1)
+
+    def test_bulk_stream_is_counted_when_it_ends(self):
+        backend = fake_ee.sampleBackend()
+        registry = metrics.Registry()
+        with fake_ee.install(backend), benchmark.scratchState(), mock.patch.object(metrics, 'registry', registry):
+            request = benchmark.RequestFactory().get('/apps/waterwatch/', {'commune': '1'})
+            response = api.api_get_timeseries_bulk(request)
+            before = dict(registry.views)
+            b''.join(response.streaming_content)
+            roundTrips = backend.roundTrips()
+
+        requests, _, _, viewRoundTrips, _ = registry.views['api_get_timeseries_bulk']
+        self.assertEqual(before, {})
+        # the reductions made while streaming are counted against the view
+        self.assertEqual((requests, viewRoundTrips), (1, roundTrips))
+
+    def test_date_range_is_filtered_on_the_server(self):
+        backend = fake_ee.sampleBackend()
+        with fake_ee.install(backend), benchmark.scratchState():
+            point, _ = benchmark.clickTarget(backend)
+            full = utilities.checkFeature(*point)[0]
+            shutil.rmtree(os.path.join(storage.DATA_DIR, 'timeseries'))
+            request = benchmark.RequestFactory().post('/apps/waterwatch/', {
+                'lon': point[0], 'lat': point[1], 'start': '2019-09-01', 'end': '2019-10-31', 'max_points': 4,
+            }, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            ranged = json.loads(ajax_controllers.timeseries(request).content)['values']
+            stored = timeseries_store.readSeries(utilities.sampledId('ponds', *point))
+
+        start, end = utilities.dateMillis('2019-09-01'), utilities.dateMillis('2019-10-31', endOfDay=True)
+        inRange = [t for t, _ in full if start <= t < end]
+        self.assertEqual(len(ranged), 4)
+        self.assertEqual([ranged[0][0], ranged[-1][0]], [inRange[0], inRange[-1]])
+        self.assertTrue(set(t for t, _ in ranged) <= set(inRange))
+        # a partial series is never stored
+        self.assertIsNone(stored)
+
+    def test_rollups_are_updated_incrementally(self):
+        backend = fake_ee.sampleBackend()
+        with fake_ee.install(backend), benchmark.scratchState():
+            benchmark.buildLocalData()
+            rollups.updateRollups()
+            ponds = [f['properties'] for f in spatial_index.getIndex('ponds').features if f['properties']['id_com'] == 1]
+            day = rollups.unitSeries('commune', 1)['values'][3]
+
+            last = timeseries_store.lastTime(ponds[0]['uniqID'])
+            timeseries_store.appendSeries(ponds[0]['uniqID'], [[last + 3 * rollups.DAY, {'water': 0.9, 'stddev': 0.0}]])
+            self.assertEqual(rollups.updateRollups(), 1)
+            incremental = dict((level, rollups.unitSeries(level, '1')) for level in rollups.LEVELS)
+            rollups.updateRollups(full=True)
+            full = dict((level, rollups.unitSeries(level, '1')) for level in rollups.LEVELS)
+
+            request = benchmark.RequestFactory().get('/apps/waterwatch/', {'level': 'commune', 'unit': '1'})
+            served = json.loads(api.api_get_rollups(request).content)
+            water = []
+            for pond in ponds:
+                series = timeseries_store.readSeries(pond['uniqID'])
+                sameDay = series['time'] // rollups.DAY * rollups.DAY == day[0]
+                if sameDay.any():
+                    water.append(np.nanmean(series['water'][sameDay]))
+
+        self.assertEqual(day[1]['observed'], len(water))
+        self.assertAlmostEqual(day[1]['waterFraction'], np.mean(water))
+        self.assertEqual(sum(day[1]['classes'].values()), len(water))
+        self.assertEqual(incremental, full)
+        self.assertEqual(full['commune']['values'][-1][1]['classes']['full'], 1)
+        self.assertEqual(served['units'][0]['ponds'], len(ponds))
+        self.assertEqual(served['units'][0]['values'], full['commune']['values'])
+
+    def test_tile_url_never_classifies_in_a_request(self):
+        backend = fake_ee.sampleBackend()
+        with fake_ee.install(backend), benchmark.scratchState():
+            classes = pond_classes.refreshClasses()
+            ponds = [f._properties['uniqID'] for f in backend.collection(fake_ee.PONDS)[:-1]]
+            # a newer acquisition arrived since the classes were stored
+            storage.writeJson(pond_classes.classesPath(), dict(classes, acquisition=classes['acquisition'] - 1))
+            backend.reset()
+            with mock.patch.object(pond_classes, 'refreshClasses', side_effect=AssertionError("classified")):
+                url = pond_classes.tileUrl()
+                self.assertEqual(pond_classes.tileUrl(), url)
+
+        self.assertEqual(sorted(classes['classes']), ponds)
+        self.assertTrue(set(classes['classes'].values()) <= {0, 1, 2, 3})
+        self.assertEqual(dict(backend.calls), {'getMapId': 1})
+
+    def test_classes_stay_with_their_pond(self):
+        backend = fake_ee.sampleBackend()
+        ponds = fake_ee.FeatureCollection([fake_ee.Feature(None, {'uniqID': 1, 'pondCls': 2}),
+                                           fake_ee.Feature(None, {'uniqID': 2, 'pondCls': None}),
+                                           fake_ee.Feature(None, {'uniqID': 3, 'pondCls': 0})])
+        with fake_ee.install(backend), benchmark.scratchState(), \
+                mock.patch.object(pond_classes, 'getLayer', lambda name: ponds):
+            classes = pond_classes.refreshClasses(acquisition=1)
+        self.assertEqual(classes['classes'], {1: 2, 3: 0})
@@ -0,0 +1,148 @@
+import os
+import time
+
+import numpy as np
+
+from . import config
+from .storage import dataPath, atomicFile, readJson, writeJson
+
+# how long after the last store update the stored series are served without asking the server
+STORE_MAX_AGE = getattr(config, 'TIMESERIES_MAX_AGE', 36 * 3600)
+
+FIELDS = ('water', 'stddev')
+
+
+def seriesPath(uniqID):
+    return dataPath('timeseries', '%s.npz' % uniqID)
+
+
+def statePath():
+    return dataPath('timeseries', 'state.json')
+
+
+def readSeries(uniqID):
+    """Stored arrays of a pond as a dict of time, water and stddev, None when nothing is stored
+    """
+    try:
+        with np.load(seriesPath(uniqID)) as data:
+            return {k: data[k] for k in ('time',) + FIELDS}
+    except (IOError, ValueError, KeyError):
+        return None
+
+
+def writeSeries(uniqID, series):
+    with atomicFile(seriesPath(uniqID)) as f:
+        np.savez(f, **series)
+
+
+def lastTime(uniqID):
+    series = readSeries(uniqID)
+    if series is None or not len(series['time']):
+        return None
+    return int(series['time'][-1])
+
+
+def fromValues(values):
+    """Convert makeTimeSeries output, [[time, {"water": .., "stddev": ..}], ...], to arrays
+    """
+    values = sorted(values, key=lambda v: v[0])
+    series = {'time': np.array([int(v[0]) for v in values], dtype=np.int64)}
+    for k in FIELDS:
+        series[k] = np.array([np.nan if v[1].get(k) is None else v[1][k] for v in values], dtype=np.float64)
+    return series
+
+
+def toValues(series):
+    """Convert stored arrays back to the makeTimeSeries format returned by the endpoints
+    """
+    columns = [[None if np.isnan(x) else float(x) for x in series[k]] for k in FIELDS]
+    return [[int(t), dict(zip(FIELDS, row))] for t, row in zip(series['time'], zip(*columns))]
+
+
+def between(series, start=None, end=None):
+    """Part of a series acquired in [start, end), times in milliseconds, None leaves that side open
+    """
+    times = series['time']
+    lo = 0 if start is None else int(np.searchsorted(times, start, 'left'))
+    hi = len(times) if end is None else int(np.searchsorted(times, end, 'left'))
+    return {k: v[lo:hi] for k, v in series.items()}
+
+
+def binned(series, interval):
+    """Mean water and stddev per week or month, each bin at the time of its first acquisition
+
+    Bins keep an acquisition time so a clicked chart point still finds its image.
+    """
+    if not len(series['time']):
+        return series
+    unit = {'week': 'W', 'month': 'M'}[interval]
+    bins = series['time'].astype('datetime64[ms]').astype('datetime64[%s]' % unit)
+    _, first, which = np.unique(bins, return_index=True, return_inverse=True)
+    result = {'time': series['time'][first]}
+    for k in FIELDS:
+        values = series[k]
+        valid = ~np.isnan(values)
+        total = np.bincount(which, np.where(valid, values, 0), minlength=len(first))
+        count = np.bincount(which, valid, minlength=len(first))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result[k] = np.where(count > 0, total / count, np.nan)
+    return result
+
+
+def lttb(series, maxPoints):
+    """At most maxPoints acquisitions picked by largest triangle three buckets on the water values
+
+    The first and last acquisitions are always kept, acquisitions without a water value are
+    dropped when the series has to be reduced.
+    """
+    if len(series['time']) <= maxPoints:
+        return series
+    series = {k: v[~np.isnan(series['water'])] for k, v in series.items()}
+    size = len(series['time'])
+    if size <= maxPoints:
+        return series
+    x = series['time'].astype(np.float64)
+    y = series['water']
+    every = (size - 2) / float(maxPoints - 2)
+    keep = [0]
+    a = 0
+    for i in range(maxPoints - 2):
+        start = int(i * every) + 1
+        stop = min(int((i + 1) * every) + 1, size - 1)
+        nextStop = min(int((i + 2) * every) + 1, size)
+        avgX, avgY = x[stop:nextStop].mean(), y[stop:nextStop].mean()
+        area = np.abs((x[a] - avgX) * (y[start:stop] - y[a]) - (x[a] - x[start:stop]) * (avgY - y[a]))
+        a = start + int(np.argmax(area))
+        keep.append(a)
+    keep.append(size - 1)
+    return {k: v[keep] for k, v in series.items()}
+
+
+def appendSeries(uniqID, values):
+    """Append the acquisitions newer than the last stored one, returns how many were added
+    """
+    new = fromValues(values)
+    old = readSeries(uniqID)
+    if old is not None and len(old['time']):
+        keep = new['time'] > old['time'][-1]
+        new = {k: np.concatenate([old[k], v[keep]]) for k, v in new.items()}
+        added = int(keep.sum())
+    else:
+        added = len(new['time'])
+    if added or old is None:
+        writeSeries(uniqID, new)
+    return added
+
+
+def markUpdated():
+    writeJson(statePath(), {'updated': time.time()})
+
+
+def isCurrent(uniqID):
+    """True when the store was refreshed recently and holds a series for this pond
+    """
+    state = readJson(statePath(), {})
+    updated = state.get('updated')
+    if updated is None or time.time() - updated > STORE_MAX_AGE:
+        return False
+    return os.path.exists(seriesPath(uniqID))
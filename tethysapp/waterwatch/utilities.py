@@ -5,15 +5,29 @@ import json
 import math
 import random
 import datetime, time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from . import config
 from django.http import JsonResponse
-try:
-    credentials = ee.ServiceAccountCredentials(config.EE_SERVICE_ACCOUNT,
-                                               config.EE_SECRET_KEY)
-    ee.Initialize(credentials)
-except:
-    ee.Initialize()
+from .layers import registry, getLayer, MAPID_TTL
+from .spatial_index import SNAPSHOTS, locate, getIndex, downloadCollection
+from . import timeseries_store
+from .batch_extract import extractTimeSeries, reduceSeries
+from . import forecast_model
+from . import hypsometry
+from . import forcing
+from . import forecast_batch
+from . import pond_classes
+from . import pond_catalog
+from . import ee_client
+from . import acquisitions
+from .singleflight import flights
+from .result_cache import cache
+from .forcing import prepGfs, accumGFS, accumCFS, calcInitIap
+
+log = logging.getLogger(__name__)
 
 def addArea(feature):
     return feature.set('area', feature.area());
@@ -128,7 +142,7 @@ def cloudProject(img):
         .subtract(ee.Number(meanZenith).multiply(math.pi).divide(180.0));
 
     # Find the shadows
-    shadows = cloudHeights.map(projectHeights);
+    shadows = getLayer('cloudHeights').map(projectHeights);
 
     shadow = ee.ImageCollection.fromImages(shadows).max();
 
@@ -204,7 +218,7 @@ def waterClassifier(img):
 
 
 def pondClassifier(shape):
-    waterList = waterCollection.filterBounds(shape.geometry()) \
+    waterList = getLayer('waterCollection').filterBounds(shape.geometry()) \
         .sort('system:time_start', False)
 
     latest = ee.Image(waterList.reduce(ee.Reducer.firstNonNull()))
@@ -251,92 +265,45 @@ def makeTimeSeries(collection, feature, key=None, hasMask=False):
     filteredCollection = collection.filterBounds(feature.geometry()).sort("system:time_start")
     indexCollection = filteredCollection.map(reducerMapping)
     indexCollection2 = indexCollection.aggregate_array('indexValue')
-    values = indexCollection2.getInfo()
+    values = ee_client.getInfo(indexCollection2)
     return values
 
 
-def getClickedImage(xValue, yValue, feature):
-    equalDate = ee.Date(int(xValue))
-
-    # true_image = ee.Image(mergedCollection.filterBounds(feature.geometry()).filterDate(equalDate,equalDate.advance(7    ,'day')).first())
-    # t_image = ee.Image().paint(true_image, 0, 2)
-    # true_imageid = t_image.getMapId({'min':0.05,'max':0.50,'gamma':1.5,'bands':'swir2,nir,green'})
-
-    true_imageid = true_image.getMapId({'min': 0.05, 'max': 0.50, 'gamma': 1.5, 'bands': 'swir2,nir,green'})
-
-    water_image = ee.Image(waterCollection.select('mndwi').filterBounds(feature.geometry()).filterDate(equalDate,
-                                                                                                       equalDate.advance(
-                                                                                                           2,
-                                                                                                           'day')).first())
-    # w_image = ee.Image().paint(water_image, 0, 2)
-    # water_imageid = w_image.getMapId({'min':-0.2,'max':-0.05,'palette':'d3d3d3,84adff,9698d1,0000cc'})
-    water_imageid = water_image.getMapId({'min': -0.2, 'max': -0.05, 'palette': 'd3d3d3,84adff,9698d1,0000cc'})
+def getClickedImage(xValue, yValue, feature, image=None):
+    """Map ids of the true colour and water images of an acquisition and the water image properties
 
-    properties = water_image.getInfo()['properties']
+    image is the acquisition catalog row of the water image when it was found locally.
+    """
+    equalDate = ee.Date(int(xValue))
+    geometry = feature.geometry()
+
+    # processed_ponds only holds the water bands, the true colour image comes from the raw scenes
+    true_image = ee.Image(mergeCollections(getLayer('lc8'), getLayer('st2'), geometry,
+                                           equalDate, equalDate.advance(2, 'day')).first())
+    true_imageid = ee_client.getMapId(true_image, {'min': 0.05, 'max': 0.50, 'gamma': 1.5, 'bands': 'swir2,nir,green'})
+
+    if image is not None:
+        water_image = ee.Image(image['id']).select('mndwi_water')
+    else:
+        water_image = ee.Image(getLayer('waterCollection').select('mndwi_water').filterBounds(geometry).filterDate(equalDate,
+                                                                                                           equalDate.advance(
+                                                                                                               2,
+                                                                                                               'day')).first())
+    water_imageid = ee_client.getMapId(water_image, {'min': 0, 'max': 1, 'palette': 'd3d3d3,84adff,9698d1,0000cc'})
+
+    if image is not None:
+        properties = {'CLOUD_COVER': image['cloud'], 'system:time_start': image['time']}
+    else:
+        # only the properties, not the band metadata
+        properties = ee_client.getInfo(water_image.toDictionary())
     return true_imageid, water_imageid, properties
 
 
-def prepGfs(img):
-    d = img.date()
-    offset = ee.Number(img.get("forecast_hours"))
-    new_date = d.advance(offset, "hour")
-    return img.set("system:time_start", new_date.millis())
-
-
-def accumGFS(collection, startDate, nDays):
-    if (nDays > 16):
-        raise Warning('Max forecast days is 16, only producing forecast for 16 days...')
-        nDays = 16
-
-    cnt = 1
-    imgList = []
-    precipScale = ee.Image(1).divide(ee.Image(1e3))
-    for i in range(nDays + 1):
-        t1 = startDate.advance(i, 'day')
-        t2 = t1.advance(1, "day")
-
-        dayPrecip = collection.filterDate(t1, t2)
-        imgList.append(dayPrecip.sum().multiply(precipScale)
-                       .set('system:time_start', t1.millis()))
-
-    return ee.ImageCollection(imgList)
-
-
-def accumCFS(collection, startDate, nDays):
-    imgList = []
-    precipScale = ee.Image(1).divide(ee.Image(1e3))
-    for i in range(nDays):
-        newDate = startDate.advance(i, 'day')
-        dayPrecip = collection.filterDate(newDate, newDate.advance(24, 'hour'))
-        imgList.append(dayPrecip.sum().multiply(precipScale) \
-                       .set('system:time_start', newDate.millis()))
-    return ee.ImageCollection(imgList)
-
-
-def calcInitIap(collection, startDate, pastDays):
-    off = pastDays * -1
-    s = startDate.advance(off, 'day')
-    e = s.advance(pastDays, 'day')
-    prevPrecip = collection.filterDate(s, e)
-
-    dailyPrev = accumCFS(prevPrecip, s, pastDays)
-
-    imgList = dailyPrev.toList(pastDays)
-    outList = []
-
-    for i in range(pastDays):
-        pr = ee.Image(imgList.get(i))
-        antecedent = pr.multiply(ee.Image(1).divide(pastDays - i))
-        outList.append(antecedent)
-
-    Iap = ee.ImageCollection(outList).sum().rename(['Iap'])
-
-    return Iap
-
-
 class fClass(object):
     def __init__(self, feature, initCond, initTime,
-                 k=0.9, Gmax=0.01487, L=0.00114, Kr=0.4946, n=19.89, alpha=2.514):
+                 k=0.9, Gmax=0.01487, L=0.00114, Kr=0.4946, n=19.89, alpha=2.514, constants=None):
+        self.params = {'k': k, 'Gmax': Gmax, 'L': L, 'Kr': Kr, 'n': n, 'alpha': alpha}
+        self.forecastDays = 15
         # set parameters to EE variables
         self.k = ee.Image(k)
         self.Gmax = ee.Image(Gmax)
@@ -344,29 +311,43 @@ class fClass(object):
         self.Kr = ee.Image(Kr)
         self.n = ee.Image(n)
         self.alpha = ee.Image(alpha)
-        self.pArea = feature.geometry().area()
+        # pond constants from the hypsometry table, when None they are derived from the DEM
+        self.constants = constants
+        if constants is not None:
+            self.pArea = ee.Number(constants['area'])
+        else:
+            self.pArea = feature.geometry().area()
         self.initial = ee.Image(initCond)
+        # a start time given in ms lets the forcing be shared through forcing.cache
+        self.initMillis = None
+        if not isinstance(initTime, ee.Date):
+            self.initMillis = int(initTime)
+            initTime = ee.Date(self.initMillis)
         self.initTime = initTime
         self.pond = feature
 
-    def forecast(self):
+    def _prepare(self):
         # calculate volume - area/height relationship parameters
         self.Ac = self.n.multiply(self.pArea)
         self.h0 = ee.Image(1)
-        pondMin = ee.Number(elv.reduceRegion(
-            geometry=self.pond.geometry(),
-            reducer=ee.Reducer.min(),
-            scale=demScale, maxPixels=1e6
-        ).get('elevation'))
-        SoInit = ee.Image(0).where(elv.gte(pondMin).And(elv.lte(pondMin.add(self.h0))), 1)
-        self.So = ee.Image(ee.Number(SoInit.reduceRegion(
-            geometry=self.pond.geometry(),
-            reducer=ee.Reducer.sum(),
-            scale=demScale, maxPixels=1e6
-        ).get('constant'))).multiply(ee.Image.pixelArea())
+        if self.constants is not None:
+            self.So = ee.Image(self.constants['So'])
+        else:
+            elv = getLayer('elv')
+            demScale = getLayer('demScale')
+            pondMin = ee.Number(elv.reduceRegion(
+                geometry=self.pond.geometry(),
+                reducer=ee.Reducer.min(),
+                scale=demScale, maxPixels=1e6
+            ).get('elevation'))
+            SoInit = ee.Image(0).where(elv.gte(pondMin).And(elv.lte(pondMin.add(self.h0))), 1)
+            self.So = ee.Image(ee.Number(SoInit.reduceRegion(
+                geometry=self.pond.geometry(),
+                reducer=ee.Reducer.sum(),
+                scale=demScale, maxPixels=1e6
+            ).get('constant'))).multiply(ee.Image.pixelArea())
 
         # begin forecasting water area
-        forecastDays = 15
         modelDate = self.initTime
 
         # calculate initial conditions
@@ -375,27 +356,58 @@ class fClass(object):
         self.Vo = (self.So.multiply(self.h0)).divide(self.alpha.add(1))
         vInit = ee.Image(self.Vo.multiply(hInit.divide(self.h0).pow(self.alpha.add(1))))
 
-        precipData = gfs.filterDate(modelDate, modelDate.advance(1, 'hour')) \
-            .filterMetadata('forecast_hours', 'greater_than', 0) \
-            .select(['total_precipitation_surface'], ['precip']) \
-            .map(prepGfs)
-        dailyPrecip = accumGFS(precipData, modelDate, forecastDays)
-
-        initIap = calcInitIap(cfs, modelDate, 7)
+        if self.initMillis is not None:
+            modelForcing = forcing.cache.images(self.initMillis)
+        else:
+            modelForcing = forcing.buildForcing(modelDate, self.forecastDays)
+        self.dailyPrecip = modelForcing['dailyPrecip']
+        self.initIap = modelForcing['initIap']
 
         # set model start with t-1 forcing
-        first = ee.Image(cfs.filterDate(modelDate.advance(-1, 'day'), modelDate).select(['precip']).sum()) \
-            .multiply(precipScale).addBands(initIap) \
+        self.first = modelForcing['prevPrecip'].addBands(self.initIap) \
             .addBands(vInit).addBands(A).addBands(hInit) \
-            .rename(['precip', 'Iap', 'vol', 'area', 'height']).clip(studyArea) \
+            .rename(['precip', 'Iap', 'vol', 'area', 'height']).clip(getLayer('studyArea')) \
             .set('system:time_start', modelDate.advance(-12, 'hour').millis()).float()
 
-        modelOut = ee.List(dailyPrecip.iterate(self._accumVolume, ee.List([first]))).slice(1)
+    def forecast(self):
+        self._prepare()
+        modelOut = ee.List(self.dailyPrecip.iterate(self._accumVolume, ee.List([self.first]))).slice(1)
         modelOut = ee.ImageCollection.fromImages(modelOut)
         results = modelOut.map(self._pctArea)
         ts = self._timeseries(results, self.pond, key='pctArea')
         return ts
 
+    def inputs(self):
+        """Pond averages of the model constants and forcing, what forecast_model needs to run locally
+        """
+        self._prepare()
+        geometry = self.pond.geometry()
+
+        def sample(img, band):
+            return ee.Image(img).reduceRegion(ee.Reducer.mean(), geometry, 30).get(band, 0)
+
+        days = self.forecastDays + 1
+        return ee.Dictionary({
+            'pArea': self.pArea,
+            'So': sample(self.So, 'constant'),
+            'initial': sample(self.initial, 'constant'),
+            'prevPrecip': sample(self.first, 'precip'),
+            'Iap': sample(self.initIap, 'Iap'),
+            'precip': self.dailyPrecip.toList(days).map(lambda img: sample(img, 'precip')),
+            'modelDate': self.initTime.millis(),
+        })
+
+    def forecastLocal(self, inputs=None):
+        """Same result as forecast, with a single request for the inputs and the model run in NumPy
+        """
+        if inputs is None:
+            inputs = ee_client.getInfo(self.inputs())
+        out = forecast_model.forecast([inputs['pArea']], [inputs['So']], [inputs['initial']],
+                                      [inputs['precip']], [inputs['prevPrecip']], [inputs['Iap']],
+                                      **self.params)
+        times = forecast_model.forecastTimes(inputs['modelDate'], len(inputs['precip']))
+        return forecast_model.toValues(times, out['pctArea'][0])
+
     def _accumVolume(self, img, imgList):
         # extract out forcing and state variables
         past = ee.Image(ee.List(imgList).get(-1))  # .clip(studyArea)
@@ -450,7 +462,7 @@ class fClass(object):
 
         indexCollection = filteredCollection.map(reducerMapping)
         indexCollection2 = indexCollection.aggregate_array('indexValue')
-        values = indexCollection2.getInfo()
+        values = ee_client.getInfo(indexCollection2)
         return values
 
     def _pctArea(self, img):
@@ -459,181 +471,571 @@ class fClass(object):
         return img.addBands(pct)
 
 
-studyArea = ee.Geometry.Rectangle([-15.866, 14.193, -12.990, 16.490])
-lc8 = ee.ImageCollection('LANDSAT/LC08/C01/T1_RT')
-st2 = ee.ImageCollection('COPERNICUS/S2')
-ponds = ee.FeatureCollection('projects/servir-wa/services/ephemeral_water_ferlo/ferlo_ponds') \
-    .map(addArea).filter(ee.Filter.gt("area", 10000))
+@registry.register('studyArea')
+def _studyArea():
+    return ee.Geometry.Rectangle([-15.866, 14.193, -12.990, 16.490])
 
 
-region = ee.FeatureCollection('users/satigebelal/region').map(addArea)
-commune = ee.FeatureCollection('users/satigebelal/commune').map(addArea)
-arrondissement = ee.FeatureCollection('users/satigebelal/arrondissement')
-countries = ee.FeatureCollection('USDOS/LSIB_SIMPLE/2017')
-area_senegal = ee.FeatureCollection(countries).filter(ee.Filter.eq('country_na','Senegal'));
-village = ee.FeatureCollection('users/satigebelal/Village');
-today = time.strftime("%Y-%m-%d")
-precipScale = ee.Image(1).divide(ee.Image(1e3))
+@registry.register('lc8')
+def _lc8():
+    return ee.ImageCollection('LANDSAT/LC08/C01/T1_RT')
+
+
+@registry.register('st2')
+def _st2():
+    return ee.ImageCollection('COPERNICUS/S2')
+
+
+@registry.register('ponds')
+def _ponds():
+    return ee.FeatureCollection('projects/servir-wa/services/ephemeral_water_ferlo/ferlo_ponds') \
+        .map(addArea).filter(ee.Filter.gt("area", 10000))
+
+
+@registry.register('region')
+def _region():
+    return ee.FeatureCollection('users/satigebelal/region').map(addArea)
+
+
+@registry.register('commune')
+def _commune():
+    return ee.FeatureCollection('users/satigebelal/commune').map(addArea)
+
+
+@registry.register('arrondissement')
+def _arrondissement():
+    return ee.FeatureCollection('users/satigebelal/arrondissement')
+
+
+@registry.register('area_senegal')
+def _area_senegal():
+    countries = ee.FeatureCollection('USDOS/LSIB_SIMPLE/2017')
+    return ee.FeatureCollection(countries).filter(ee.Filter.eq('country_na', 'Senegal'))
+
+
+@registry.register('village')
+def _village():
+    return ee.FeatureCollection('users/satigebelal/Village')
+
+
+@registry.register('precipScale')
+def _precipScale():
+    return ee.Image(1).divide(ee.Image(1e3))
+
+
+@registry.register('iniTime')
+def _iniTime():
+    return ee.Date('2015-01-01')
+
+
+@registry.register('endTime', ttl=3600)
+def _endTime():
+    return ee.Date(time.strftime("%Y-%m-%d"))
+
+
+@registry.register('cloudHeights')
+def _cloudHeights():
+    return ee.List.sequence(200, 5000, 500)
+
+
+@registry.register('mergedCollection')
+def _mergedCollection():
+    return ee.ImageCollection("projects/servir-wa/services/ephemeral_water_ferlo/processed_ponds")
+
+
+@registry.register('waterCollection')
+def _waterCollection():
+    return ee.ImageCollection("projects/servir-wa/services/ephemeral_water_ferlo/processed_ponds")
+
+
+@registry.register('gfs')
+def _gfs():
+    return ee.ImageCollection('NOAA/GFS0P25')
+
+
+@registry.register('cfs')
+def _cfs():
+    return ee.ImageCollection('NOAA/CFSV2/FOR6H').select(['Precipitation_rate_surface_6_Hour_Average'], ['precip'])
+
 
-iniTime = ee.Date('2015-01-01')
-endTime = ee.Date(today)
+@registry.register('elv')
+def _elv():
+    return ee.Image('USGS/SRTMGL1_003')
+
+
+@registry.register('demScale')
+def _demScale():
+    return getLayer('elv').projection().nominalScale()
+
+
+@registry.register('ponds_cls')
+def _ponds_cls():
+    return ee.FeatureCollection(getLayer('ponds').map(pondClassifier))
+
+
+@registry.register('Pimage')
+def _Pimage():
+    # Pimage = ee.Image().paint(ponds,"pondCls").blend(
+    #     ee.Image().paint(ponds,"pondCls",1.5)
+    # )
+    return getLayer('ponds_cls').reduceToImage(
+        properties=['pondCls'],
+        reducer=ee.Reducer.first()
+    )
+
+
+# map ids, each one is a server round-trip so they are only requested when a page needs them
+@registry.register('water_img', ttl=MAPID_TTL)
+def _water_img():
+    return ee_client.getMapId(ee.Image(getLayer('waterCollection').select('mndwi_water').mosaic()), palette)
+
+
+@registry.register('pondsTileUrl', ttl=pond_classes.CHECK_INTERVAL)
+def _pondsTileUrl():
+    # classification and map id are cached across workers by pond_classes
+    return pond_classes.tileUrl()
+
+
+@registry.register('regionImgID', ttl=MAPID_TTL)
+def _regionImgID():
+    return ee_client.getMapId(getLayer('region'))
+
+
+@registry.register('arrondissementImgID', ttl=MAPID_TTL)
+def _arrondissementImgID():
+    return ee_client.getMapId(getLayer('arrondissement'))
+
+
+@registry.register('communeImgID', ttl=MAPID_TTL)
+def _communeImgID():
+    return ee_client.getMapId(getLayer('commune'))
+
+
+@registry.register('villageImgID', ttl=MAPID_TTL)
+def _villageImgID():
+    return ee_client.getMapId(getLayer('village'))
+
+
+@registry.register('mndwiImg', ttl=MAPID_TTL)
+def _mndwiImg():
+    median = getLayer('mergedCollection').select('mndwi_water').median().clip(getLayer('area_senegal'))
+    return ee_client.getMapId(median, params)
+
+
+today = time.strftime("%Y-%m-%d")
 
 dilatePixels = 2;
-cloudHeights = ee.List.sequence(200, 5000, 500);
 zScoreThresh = -0.8;
 shadowSumThresh = 0.35;
 cloudThresh = 10
-mergedCollection = ee.ImageCollection("projects/servir-wa/services/ephemeral_water_ferlo/processed_ponds")
-#mndwiCollection = mergedCollection.map(calcWaterIndex)
 palette = {'palette': 'yellow,green,gray'}
 
+# acquisitions of a pond whose map ids are computed in the background once its time series is shown
+MNDWI_PREFETCH = getattr(config, 'MNDWI_PREFETCH', 5)
+# at most this many prefetches wait for the pool, more are dropped
+MNDWI_PREFETCH_QUEUE = getattr(config, 'MNDWI_PREFETCH_QUEUE', 20)
+_prefetcher = ThreadPoolExecutor(max_workers=getattr(config, 'MNDWI_PREFETCH_WORKERS', 2), thread_name_prefix='prefetch')
+_prefetching = set()
+_prefetchLock = threading.Lock()
+params = {'min': 0.05, 'max': -0.2, 'palette': '#d3d3d3,#84adff,#9698d1,#0000cc'}
+# ponds of one bulk time series request, and how many of those missing from the store are reduced per server call
+BULK_MAX_PONDS = getattr(config, 'BULK_MAX_PONDS', 2000)
+BULK_CHUNK = getattr(config, 'BULK_CHUNK_SIZE', 25)
+
 
 def cliip(image):
     # Crop by table extension
-    return image.clip(studyArea)
+    return image.clip(getLayer('studyArea'))
 def cliip1(image):
     # Crop by table extension
-    return image.clip(area_senegal)
+    return image.clip(getLayer('area_senegal'))
 
 
-img = mergedCollection.map(cliip)
-# img = mergedCollection.median().clip(studyArea)
-#mndwiImg = mndwiCollection.map(cliip)
-waterCollection = ee.ImageCollection("projects/servir-wa/services/ephemeral_water_ferlo/processed_ponds")
-# ee.Image(waterCollection.select('water').mosaic())
-palette = {'palette': 'yellow,green,gray'}
-
-water_img = ee.Image(waterCollection.select('mndwi_water').mosaic()).getMapId(palette)
-
-ponds_cls = ee.FeatureCollection(ponds.map(pondClassifier))
-
-# Pimage = ee.Image().paint(ponds,"pondCls").blend(
-#     ee.Image().paint(ponds,"pondCls",1.5)
-# )
-Pimage = ponds_cls.reduceToImage(
-    properties=['pondCls'],
-    reducer=ee.Reducer.first()
-)
-
-visParams = {'min': 0, 'max': 3, 'palette': 'red,yellow,green,gray'}
-
-# pondsImgID = Pimage.getMapId(visParams)
-regionImgID = region.getMapId()
-arrondissementImgID = arrondissement.getMapId()
-communeImgID = commune.getMapId()
-villageImgID = village.getMapId()
-test=mergedCollection.select('mndwi_water').median().clip(area_senegal)
-params={'min':0.05,'max':-0.2,'palette':'#d3d3d3,#84adff,#9698d1,#0000cc'}
-mndwiImg = test.getMapId(params)
-gfs = ee.ImageCollection('NOAA/GFS0P25')
-cfs = ee.ImageCollection('NOAA/CFSV2/FOR6H').select(['Precipitation_rate_surface_6_Hour_Average'], ['precip'])
-elv = ee.Image('USGS/SRTMGL1_003')
-demScale = elv.projection().nominalScale()
 def initMndwi():
-    return mndwiImg['tile_fetcher'].url_format
+    return getLayer('mndwiImg')['tile_fetcher'].url_format
 
 def initLayers():
-    pondsImgID = Pimage.getMapId(visParams)
-    return pondsImgID['tile_fetcher'].url_format
+    return getLayer('pondsTileUrl')
 
 
 def pondsList():
-    xx = ponds.getInfo()
-    names=[]
-    centers=[]
-    return_obj = {}
-    for feature in xx['features']:
-        if feature['properties']['Nom']:
-            name=feature['properties']['Nom']
-            if len(feature['geometry']['coordinates'][0][0])>2:
-                # print(len(feature['geometry']['coordinates'][0][0]))
-                points= feature['geometry']['coordinates'][0][0]
-            else:
-                # print(len(feature['geometry']['coordinates'][0][0]))
-                points = feature['geometry']['coordinates'][0]
-            x = [p[0] for p in points if p[0] and p[1]]
-            y = [p[1] for p in points if p[0] and p[1]]
-            centroid = [sum(x) / len(points), sum(y) / len(points)]
-            if name not in names:
-                names.append(str(name))
-                centers.append(centroid)
-    names, centers = (list(t) for t in zip(*sorted(zip( names,centers), reverse=False)))
-
-    return names,centers
-    #return xx['features'] #np.unique([i['properties']['Nom'] for i in xx['features'] if i['properties']['Nom']]).tolist()
+    """Names and area weighted centroids of the named ponds, from the cached pond catalog
+    """
+    etag, body = pond_catalog.getCatalog()
+    catalog = json.loads(body)
+    return catalog['names'], catalog['centers']
 
 def regionLayers():
-    return region
+    return getLayer('region')
 def communeLayers():
-    return commune
+    return getLayer('commune')
 def arrondissementLayers():
-    return arrondissement
+    return getLayer('arrondissement')
 def villageLayers():
-    return village
+    return getLayer('village')
+def sampledFeature(name, lon, lat):
+    """Feature of a collection under a point, answered from the local snapshot when there is one
+    """
+    feature = locate(name, lon, lat)
+    if feature is None:
+        point = ee.Geometry.Point(float(lon), float(lat))
+        feature = ee_client.getInfo(ee.Feature(getLayer(name).filterBounds(point).first()))
+    return feature
+
+
+def sampledId(name, lon, lat):
+    return sampledFeature(name, lon, lat)['properties'][SNAPSHOTS[name]]
+
+
 def filterPond(lon, lat):
-    point = ee.Geometry.Point(float(lon), float(lat))
-    sampledPoint = ee.Feature(ponds.filterBounds(point).first())
-    computedValue = sampledPoint.getInfo()['properties']['uniqID']
-    selPond = ponds.filter(ee.Filter.eq('uniqID', computedValue))
+    computedValue = sampledId('ponds', lon, lat)
+    selPond = selectPond(computedValue)
     return selPond
 
 
-def checkFeature(lon, lat):
-    selPond = filterPond(lon, lat)
-
-    ts_values = makeTimeSeries(waterCollection, selPond, key='water', hasMask=True)
-    name = selPond.getInfo()['features'][0]['properties']['Nom']
-    if len(name) < 2:
+def pondName(feature):
+    name = feature['properties']['Nom']
+    if not name or len(name) < 2:
         name = ' Unnamed Pond'
-    coordinates = selPond.getInfo()['features'][0]['geometry']['coordinates']
+    return name
+
+
+def pondGeometry(uniqID):
+    """GeoJSON geometry of a pond from the snapshot, None without a snapshot or an unknown pond
+    """
+    index = getIndex('ponds')
+    feature = None if index is None else index.get(uniqID)
+    return None if feature is None else feature.get('geometry')
+
+
+def selectPond(uniqID):
+    return getLayer('ponds').filter(ee.Filter.eq('uniqID', uniqID))
+
+
+def newAcquisitions(uniqID):
+    """Images of the water collection acquired after the last one stored for a pond
+    """
+    collection = getLayer('waterCollection')
+    last = timeseries_store.lastTime(uniqID)
+    if last is not None:
+        collection = collection.filter(ee.Filter.gt('system:time_start', last))
+    return collection
+
+
+def pondTimeSeries(uniqID, selPond=None, start=None, end=None):
+    """Water time series of a pond in [start, end), read from the local store when it is current
+
+    Otherwise only the acquisitions newer than the stored ones are reduced on the server
+    and appended to the store before answering. A pond without any stored acquisition and a
+    date range is reduced over that range only, which is not stored.
+    """
+    if timeseries_store.isCurrent(uniqID):
+        return timeseries_store.toValues(timeseries_store.between(timeseries_store.readSeries(uniqID), start, end))
+
+    if selPond is None:
+        selPond = selectPond(uniqID)
+    if (start is not None or end is not None) and timeseries_store.lastTime(uniqID) is None:
+        collection = getLayer('waterCollection')
+        if start is not None:
+            collection = collection.filter(ee.Filter.gte('system:time_start', start))
+        if end is not None:
+            collection = collection.filter(ee.Filter.lt('system:time_start', end))
+        return timeseries_store.toValues(timeseries_store.fromValues(
+            makeTimeSeries(collection, selPond, key='water', hasMask=True)))
+    new_values = makeTimeSeries(newAcquisitions(uniqID), selPond, key='water', hasMask=True)
+    timeseries_store.appendSeries(uniqID, new_values)
+    return timeseries_store.toValues(timeseries_store.between(timeseries_store.readSeries(uniqID), start, end))
+
+
+def updateTimeSeriesStore(uniqIDs=None):
+    """Append new acquisitions for every pond (or the given ones) to the local store
+
+    Uses the batched reduceRegions extraction, returns its statistics for each pass.
+    """
+    if uniqIDs is None:
+        uniqIDs = [f['properties']['uniqID'] for f in getIndex('ponds').features]
+    lasts = {uniqID: timeseries_store.lastTime(uniqID) for uniqID in uniqIDs}
+    # ponds never stored need the whole archive, the others only what came after the oldest of them
+    new_ponds = set(u for u in uniqIDs if timeseries_store.readSeries(u) is None)
+    known = [u for u in uniqIDs if u not in new_ponds]
+    stats = []
+    if new_ponds:
+        stats.append(extractTimeSeries(sorted(new_ponds)))
+    if known:
+        times = [lasts[u] for u in known if lasts[u] is not None]
+        stats.append(extractTimeSeries(known, since=min(times) if times else None))
+    timeseries_store.markUpdated()
+    return stats
+
+
+def seriesOptions(info):
+    """start, end, maxPoints and interval of a time series request from its parameters
+
+    start and end are YYYY-MM-DD dates, both included, max_points is at least 3 and
+    interval is week or month.
+    """
+    options = {
+        'start': dateMillis(info.get('start')),
+        'end': dateMillis(info.get('end'), endOfDay=True),
+        'maxPoints': int(info['max_points']) if info.get('max_points') else None,
+        'interval': info.get('interval') or None,
+    }
+    if options['maxPoints'] is not None and options['maxPoints'] < 3:
+        raise ValueError("max_points must be at least 3")
+    if options['interval'] not in (None, 'week', 'month'):
+        raise ValueError("interval is week or month")
+    return options
+
+
+def shapeSeries(values, maxPoints=None, interval=None):
+    """Time series values averaged per interval and reduced to at most maxPoints acquisitions
+    """
+    if maxPoints is None and interval is None:
+        return values
+    series = timeseries_store.fromValues(values)
+    if interval is not None:
+        series = timeseries_store.binned(series, interval)
+    if maxPoints is not None:
+        series = timeseries_store.lttb(series, maxPoints)
+    return timeseries_store.toValues(series)
+
+
+def checkFeature(lon, lat, start=None, end=None, maxPoints=None, interval=None, prefetch=False):
+    """Time series, coordinates and name of the pond under a point
+
+    With prefetch the images of the latest chart points are computed in the background, for the
+    interactive chart whose points are clicked.
+    """
+    feature = sampledFeature('ponds', lon, lat)
+    uniqID = feature['properties']['uniqID']
+
+    # concurrent clicks on the same pond and dates share one computation, downsampling is cheap and done after
+    ts_values = cache.fetch('timeseries', [uniqID, start, end], flights.do, ('timeseries', uniqID, start, end),
+                            pondTimeSeries, uniqID, start=start, end=end)
+    ts_values = shapeSeries(ts_values, maxPoints, interval)
+    if prefetch:
+        # the chart points clicked most are the latest ones
+        prefetchClickedImages(uniqID, ts_values)
+    name = pondName(feature)
+    coordinates = feature['geometry']['coordinates']
     return ts_values, coordinates, name
 
-def checkVillage():
-    coordinates = village.getInfo()['features']
+def dateMillis(value, endOfDay=False):
+    """Milliseconds since the epoch of a YYYY-MM-DD date (UTC), None for an empty value
+
+    With endOfDay the start of the next day is returned, so an end date includes its acquisitions.
+    """
+    if not value:
+        return None
+    day = datetime.datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=datetime.timezone.utc)
+    if endOfDay:
+        day += datetime.timedelta(days=1)
+    return int(day.timestamp() * 1000)
+
+
+def selectPonds(uniqIDs=None, bbox=None, commune=None, arrondissement=None):
+    """(uniqID, name) of the ponds given by id, intersecting a lon/lat bbox, or in a commune or arrondissement
+
+    Exactly one selection is expected. Answered from the pond snapshot when there is one, otherwise
+    from the server. Returns the ponds and the requested uniqIDs that are not ponds.
+    """
+    given = [v is not None for v in (uniqIDs, bbox, commune, arrondissement)]
+    if sum(given) != 1:
+        raise ValueError("Give one of uniqIDs, bbox, commune or arrondissement")
+
+    index = getIndex('ponds')
+    if index is not None:
+        features = index.features
+        if uniqIDs is not None:
+            byId = dict((str(f['properties']['uniqID']), f) for f in features)
+            features = [byId[str(u)] for u in uniqIDs if str(u) in byId]
+        elif bbox is not None:
+            features = [features[i] for i in index.intersecting(*bbox)]
+        else:
+            key, value = ('id_com', commune) if commune is not None else ('id_arro', arrondissement)
+            features = [f for f in features if str(f['properties'].get(key)) == str(value)]
+    else:
+        # identifiers from a query string are text, the server compares them with their numeric values
+        number = lambda v: int(v) if str(v).isdigit() else v
+        ponds = getLayer('ponds')
+        if uniqIDs is not None:
+            ponds = ponds.filter(ee.Filter.inList('uniqID', [number(u) for u in uniqIDs]))
+        elif bbox is not None:
+            ponds = ponds.filterBounds(ee.Geometry.Rectangle([float(v) for v in bbox]))
+        elif commune is not None:
+            ponds = ponds.filter(ee.Filter.eq('id_com', number(commune)))
+        else:
+            ponds = ponds.filter(ee.Filter.eq('id_arro', number(arrondissement)))
+        features = downloadCollection(ponds.select(['uniqID', 'Nom'], None, False))
+
+    if len(features) > BULK_MAX_PONDS:
+        raise ValueError("%d ponds selected, at most %d per request" % (len(features), BULK_MAX_PONDS))
+    ponds = [(f['properties']['uniqID'], pondName(f)) for f in features]
+    found = set(str(u) for u, _ in ponds)
+    unknown = [u for u in uniqIDs if str(u) not in found] if uniqIDs is not None else []
+    return ponds, unknown
+
+
+def storeSeries(uniqIDs):
+    """Reduce the acquisitions of some ponds missing from the store in one server request and append them
+    """
+    lasts = [timeseries_store.lastTime(u) for u in uniqIDs]
+    collection = getLayer('waterCollection')
+    if None not in lasts:
+        collection = collection.filter(ee.Filter.gt('system:time_start', min(lasts)))
+    ponds = getLayer('ponds').select(['uniqID']).filter(ee.Filter.inList('uniqID', list(uniqIDs)))
+    series = reduceSeries(collection, ponds, len(uniqIDs))
+    for uniqID in uniqIDs:
+        timeseries_store.appendSeries(uniqID, series.get(uniqID, []))
+
+
+def _seriesRow(uniqID, name, start, end, maxPoints, interval):
+    series = timeseries_store.between(timeseries_store.readSeries(uniqID), start, end)
+    values = shapeSeries(timeseries_store.toValues(series), maxPoints, interval)
+    return {'uniqID': uniqID, 'name': name, 'values': values}
+
+
+def bulkTimeSeries(ponds, start=None, end=None, maxPoints=None, interval=None, chunkSize=BULK_CHUNK):
+    """Rows {uniqID, name, values} of the time series of many (uniqID, name) ponds, as they become available
+
+    Series that are current in the local store come first. The others are brought up to date
+    chunkSize ponds per server request; when a request fails its ponds get a row with an error.
+    Times in milliseconds, start included and end excluded, see shapeSeries for maxPoints and interval.
+    """
+    stale = []
+    for uniqID, name in ponds:
+        if timeseries_store.isCurrent(uniqID):
+            yield _seriesRow(uniqID, name, start, end, maxPoints, interval)
+        else:
+            stale.append((uniqID, name))
+
+    for i in range(0, len(stale), chunkSize):
+        chunk = stale[i:i + chunkSize]
+        try:
+            ee_client.call(storeSeries, [uniqID for uniqID, _ in chunk])
+        except Exception as e:
+            log.warning("Bulk time series of %d ponds failed: %s", len(chunk), e)
+            for uniqID, name in chunk:
+                yield {'uniqID': uniqID, 'name': name, 'error': str(e)}
+            continue
+        for uniqID, name in chunk:
+            yield _seriesRow(uniqID, name, start, end, maxPoints, interval)
+
+
+def checkVillage(bbox):
+    # mapbox_vector_tile and shapely are only needed by the village views
+    from . import village_tiles
+    coordinates = village_tiles.villagesWithin(bbox)
     return coordinates
-def forecastFeature(lon, lat):
-    selPond = filterPond(lon, lat)
-    coll = waterCollection.filterBounds(selPond).sort('system:time_start', False)
-    lastimg = ee.Image(coll.first())
+def pondForecast(uniqID):
+    """Live 15 day forecast of a pond, as [time, {"water": pctArea}]
+    """
+    selPond = selectPond(uniqID)
+    coll = getLayer('waterCollection').filterBounds(selPond).sort('system:time_start', False)
+    # the newest image over the pond from the local acquisition catalog, else from the server
+    geometry = pondGeometry(uniqID)
+    latest = acquisitions.latest(geometry) if geometry is not None else None
+    if latest is not None:
+        lastimg = ee.Image(latest['id'])
+        lastTime = ee.Date(latest['time'])
+    else:
+        lastimg = ee.Image(coll.first())
+        lastTime = ee.Date(lastimg.get('system:time_start'))
     bnames = lastimg.bandNames()
 
     featureImg = ee.Image(coll.reduce(ee.Reducer.firstNonNull())).rename(bnames)
-    lastTime = ee.Date(lastimg.get('system:time_start'))
 
     reductionScale = lastimg.projection().nominalScale()
 
     pondFraction = ee.Number(
         featureImg.reduceRegion(ee.Reducer.mean(), selPond.geometry(), reductionScale).get("mndwi_water"))
-    fModel = fClass(selPond, pondFraction, lastTime)
+    start = ee_client.getInfo(ee.Dictionary({'lastTime': lastTime.millis(), 'pondFraction': pondFraction}))
+    modelDate = start['lastTime']
+
+    # with stored constants and the forcing the batch stored for this start time the model runs locally,
+    # otherwise on the server with the forcing images shared through forcing.cache
+    constants = hypsometry.lookup(uniqID)
+    pondForcing = None
+    if constants is not None:
+        pondForcing = forcing.cache.pondForcing(modelDate, uniqID)
+    if pondForcing is not None:
+        ts_values = forecast_model.forecastPond(constants, start['pondFraction'], pondForcing, modelDate)
+    else:
+        fModel = fClass(selPond, pondFraction, modelDate, constants=constants)
+        ts_values = fModel.forecast()
+    return ts_values
 
-    ts_values = fModel.forecast()
-    name = selPond.getInfo()['features'][0]['properties']['Nom']
-    if len(name) < 2:
-        name = ' Unnamed Pond'
 
-    coordinates = selPond.getInfo()['features'][0]['geometry']['coordinates']
+def forecastFeature(lon, lat):
+    feature = sampledFeature('ponds', lon, lat)
+    uniqID = feature['properties']['uniqID']
+
+    # precomputed by the batch job, only stale or missing ponds are computed live
+    ts_values = forecast_batch.lookup(uniqID, feature.get('geometry'))
+    if ts_values is None:
+        ts_values = cache.fetch('forecast', uniqID, flights.do, ('forecast', uniqID, None, None), pondForecast, uniqID)
+    name = pondName(feature)
+    coordinates = feature['geometry']['coordinates']
     return ts_values, coordinates, name
 
 
 def getMNDWI(lon, lat, xValue, yValue):
-    selPond = filterPond(lon, lat)
-
-    mndwi_img = getClickedImage(xValue, yValue, selPond)
-
-    return mndwi_img
+    uniqID = sampledId('ponds', lon, lat)
+    return clickedImage(uniqID, xValue, yValue)
+
+
+def clickedImage(uniqID, xValue, yValue=None):
+    """Tile urls and properties of a pond's acquisition, cached per (pond, acquisition time)
+    """
+    xValue = int(xValue)
+    # map ids are only valid as long as their token
+    return cache.fetch('mndwi', [uniqID, xValue], flights.do, ('mndwi', uniqID, xValue, xValue),
+                       clickedImageUrls, xValue, yValue, uniqID, ttl=MAPID_TTL)
+
+
+def _prefetchImage(uniqID, xValue):
+    try:
+        clickedImage(uniqID, xValue)
+    except Exception as e:
+        log.warning("Prefetching the image of pond %s at %s failed: %s", uniqID, xValue, e)
+    finally:
+        with _prefetchLock:
+            _prefetching.discard((uniqID, xValue))
+
+
+def prefetchClickedImages(uniqID, ts_values, count=None):
+    """Compute the map ids of the most recent acquisitions of a pond in the background
+
+    Acquisitions that are cached, being computed or already queued are skipped, and nothing
+    is queued while MNDWI_PREFETCH_QUEUE prefetches are waiting.
+    """
+    count = MNDWI_PREFETCH if count is None else count
+    times = [int(t) for t, v in ts_values if v.get('water') is not None]
+    for xValue in times[-count:] if count > 0 else []:
+        if cache.has('mndwi', [uniqID, xValue]) or flights.running(('mndwi', uniqID, xValue, xValue)):
+            continue
+        with _prefetchLock:
+            if (uniqID, xValue) in _prefetching or len(_prefetching) >= MNDWI_PREFETCH_QUEUE:
+                continue
+            _prefetching.add((uniqID, xValue))
+        _prefetcher.submit(_prefetchImage, uniqID, xValue)
+
+
+def clickedImageUrls(xValue, yValue, uniqID):
+    geometry = pondGeometry(uniqID)
+    image = acquisitions.find(xValue, geometry) if geometry is not None else None
+    true_imageid, water_imageid, properties = getClickedImage(xValue, yValue, selectPond(uniqID), image)
+    return {'true_mapurl': true_imageid['tile_fetcher'].url_format,
+            'water_mapurl': water_imageid['tile_fetcher'].url_format,
+            'properties': properties}
 
 def detailsFeature(lon,lat):
-    point = ee.Geometry.Point(float(lon), float(lat))
-
-    sampledPoint = ee.Feature(ponds.filterBounds(point).first())
-    sampledRegion = ee.Feature(region.filterBounds(point).first())
-    sampledCommune = ee.Feature(commune.filterBounds(point).first())
-    sampledArrondissement = ee.Feature(arrondissement.filterBounds(point).first())
+    ponds = getLayer('ponds')
 
-    computedValuePonds = sampledPoint.getInfo()['properties']['uniqID']
-    computedValueRegion = sampledRegion.getInfo()['properties']['id_reg']
-    computedValueCommune = sampledCommune.getInfo()['properties']['id_com']
-    computedValueArrondissement = sampledArrondissement.getInfo()['properties']['id_arro']
+    computedValuePonds = sampledId('ponds', lon, lat)
+    computedValueRegion = sampledId('region', lon, lat)
+    computedValueCommune = sampledId('commune', lon, lat)
+    computedValueArrondissement = sampledId('arrondissement', lon, lat)
 
     selPond = ponds.filter(ee.Filter.eq('uniqID', computedValuePonds))
     selRegion = ponds.filter(ee.Filter.eq('id_reg', computedValueRegion))
@@ -643,41 +1045,32 @@ def detailsFeature(lon,lat):
     return selPond, selRegion, selCommune, selArrondissement
 
 def filterRegion(lon, lat):
-    point = ee.Geometry.Point(float(lon), float(lat))
-    sampledPoint = ee.Feature(region.filterBounds(point).first())
-
-    computedValue = sampledPoint.getInfo()['properties']['id_reg']
+    computedValue = sampledId('region', lon, lat)
 
-    selRegion = region.filter(ee.Filter.eq('id_reg', computedValue))
+    selRegion = getLayer('region').filter(ee.Filter.eq('id_reg', computedValue))
 
     return selRegion
 
 def filterCommune(lon, lat):
-    point = ee.Geometry.Point(float(lon), float(lat))
-    sampledPoint = ee.Feature(commune.filterBounds(point).first())
-
-    computedValue = sampledPoint.getInfo()['properties']['id_com']
+    computedValue = sampledId('commune', lon, lat)
 
-    selCommune = commune.filter(ee.Filter.eq('id_com', computedValue))
+    selCommune = getLayer('commune').filter(ee.Filter.eq('id_com', computedValue))
 
     return selCommune
 
 def filterArrondissement(lon, lat):
-    point = ee.Geometry.Point(float(lon), float(lat))
-    sampledPoint = ee.Feature(arrondissement.filterBounds(point).first())
-
-    computedValue = sampledPoint.getInfo()['properties']['id_arro']
+    computedValue = sampledId('arrondissement', lon, lat)
 
-    selArrondissement = arrondissement.filter(ee.Filter.eq('id_arro', computedValue))
+    selArrondissement = getLayer('arrondissement').filter(ee.Filter.eq('id_arro', computedValue))
 
     return selArrondissement
 
 def filterVillage(lon, lat):
-
+    village = getLayer('village')
     point = ee.Geometry.Point(float(lon), float(lat))
     sampledPoint = ee.Feature(village.filterBounds(point).first())
 
-    computedValue = sampledPoint.getInfo()['properties']['OBJECTID']
+    computedValue = ee_client.getInfo(sampledPoint)['properties']['OBJECTID']
 
     selVillage = village.filter(ee.Filter.eq('OBJECTID', computedValue))
 
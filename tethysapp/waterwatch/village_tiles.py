@@ -0,0 +1,180 @@
+import math
+import threading
+
+import ee
+import mapbox_vector_tile
+import numpy as np
+from shapely.geometry import shape, box
+from shapely.ops import transform
+
+from . import config
+from . import ee_client
+from .layers import getLayer
+from .spatial_index import getIndex, snapshotPath
+from .storage import dataPath, atomicFile, modifiedTime
+
+# Mapbox Vector Tiles of the village snapshot, generated on first request and kept in DATA_DIR/tiles
+MIN_ZOOM = getattr(config, 'VILLAGE_TILE_MIN_ZOOM', 8)
+MAX_ZOOM = getattr(config, 'VILLAGE_TILE_MAX_ZOOM', 14)
+EXTENT = 4096
+# margin around each tile, in tile units, so symbols and outlines are not cut at tile edges
+BUFFER = 64
+LAYER_NAME = 'villages'
+# properties kept in the tiles, the rest of the attribute table stays on the server
+PROPERTIES = ('OBJECTID', 'Toponymie', 'EffectifPo')
+
+ORIGIN = 20037508.342789244
+
+
+def _mercator(x, y, z=None):
+    x = np.asarray(x, dtype=float) * ORIGIN / 180.0
+    y = np.log(np.tan((90 + np.clip(np.asarray(y, dtype=float), -85.0511, 85.0511)) * np.pi / 360.0)) * ORIGIN / np.pi
+    return x, y
+
+
+def tileBounds(z, x, y):
+    """Web Mercator bounds (minx, miny, maxx, maxy) of a tile in the XYZ scheme
+    """
+    size = 2 * ORIGIN / 2 ** z
+    return (-ORIGIN + x * size, ORIGIN - (y + 1) * size, -ORIGIN + (x + 1) * size, ORIGIN - y * size)
+
+
+def tileRange(z, bbox):
+    """x and y ranges of the tiles of zoom z covering a lon/lat bbox
+    """
+    n = 2 ** z
+
+    def tile(lon, lat):
+        lat = math.radians(max(min(lat, 85.0511), -85.0511))
+        tx = int((lon + 180.0) / 360.0 * n)
+        ty = int((1.0 - math.log(math.tan(lat) + 1 / math.cos(lat)) / math.pi) / 2.0 * n)
+        return min(max(tx, 0), n - 1), min(max(ty, 0), n - 1)
+
+    x0, y0 = tile(bbox[0], bbox[3])
+    x1, y1 = tile(bbox[2], bbox[1])
+    return range(x0, x1 + 1), range(y0, y1 + 1)
+
+
+class _Villages(object):
+    """Village snapshot projected to Web Mercator, with the bounds of every feature for tile lookups
+    """
+
+    def __init__(self, features):
+        self.features = features
+        self.geometries = []
+        bounds = np.full((len(features), 4), np.nan)
+        for i, feature in enumerate(features):
+            geometry = feature.get('geometry')
+            geometry = transform(_mercator, shape(geometry)) if geometry else None
+            self.geometries.append(geometry)
+            if geometry is not None and not geometry.is_empty:
+                bounds[i] = geometry.bounds
+        self.bounds = bounds
+
+    def within(self, bounds):
+        minx, miny, maxx, maxy = bounds
+        hits = ((self.bounds[:, 0] <= maxx) & (self.bounds[:, 2] >= minx) &
+                (self.bounds[:, 1] <= maxy) & (self.bounds[:, 3] >= miny))
+        return np.flatnonzero(hits)
+
+
+_villages = None
+_lock = threading.Lock()
+
+
+def loadVillages():
+    """Projected village snapshot, reloaded when the snapshot changes, None without a snapshot
+    """
+    global _villages
+    mtime = modifiedTime(snapshotPath('village'))
+    if mtime is None:
+        return None
+    if _villages is None or _villages[0] != mtime:
+        with _lock:
+            if _villages is None or _villages[0] != mtime:
+                index = getIndex('village')
+                _villages = (mtime, _Villages(index.features))
+    return _villages[1]
+
+
+def tilePath(z, x, y):
+    return dataPath('tiles', LAYER_NAME, str(z), str(x), '%d.pbf' % y)
+
+
+def renderTile(z, x, y):
+    """Encode the villages of a tile, clipped to the buffered tile and simplified to the tile resolution
+    """
+    villages = loadVillages()
+    bounds = tileBounds(z, x, y)
+    margin = (bounds[2] - bounds[0]) * BUFFER / EXTENT
+    clip = box(bounds[0] - margin, bounds[1] - margin, bounds[2] + margin, bounds[3] + margin)
+    tolerance = (bounds[2] - bounds[0]) / EXTENT
+
+    features = []
+    for i in villages.within(clip.bounds):
+        geometry = villages.geometries[i]
+        if geometry.geom_type not in ('Point', 'MultiPoint'):
+            geometry = geometry.intersection(clip).simplify(tolerance, preserve_topology=True)
+            if geometry.is_empty:
+                continue
+        properties = villages.features[i]['properties']
+        features.append({
+            'geometry': geometry,
+            'properties': dict((k, properties[k]) for k in PROPERTIES if properties.get(k) is not None),
+        })
+    if not features:
+        return b''
+    return mapbox_vector_tile.encode(
+        [{'name': LAYER_NAME, 'features': features}],
+        default_options={'quantize_bounds': bounds, 'extents': EXTENT},
+    )
+
+
+def getTile(z, x, y):
+    """Cached tile bytes, rendered again when the village snapshot is newer than the cached file
+    """
+    if not MIN_ZOOM <= z <= MAX_ZOOM or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        return b''
+    snapshot = modifiedTime(snapshotPath('village'))
+    if snapshot is None:
+        raise RuntimeError("The village snapshot is missing, run 'localCache.py snapshot village' first")
+    path = tilePath(z, x, y)
+    cached = modifiedTime(path)
+    if cached is not None and cached >= snapshot:
+        with open(path, 'rb') as f:
+            return f.read()
+    data = renderTile(z, x, y)
+    with atomicFile(path) as f:
+        f.write(data)
+    return data
+
+
+def seedTiles(maxZoom=None):
+    """Render the tiles holding villages up to maxZoom that are missing or stale, returns how many tiles there are
+    """
+    villages = loadVillages()
+    if villages is None:
+        raise RuntimeError("The village snapshot is missing, run 'localCache.py snapshot village' first")
+    valid = ~np.isnan(villages.bounds[:, 0])
+    count = 0
+    for z in range(MIN_ZOOM, (MAX_ZOOM if maxZoom is None else maxZoom) + 1):
+        size = 2 * ORIGIN / 2 ** z
+        # only the tiles holding at least one village
+        cols = np.floor((villages.bounds[valid, 0] + ORIGIN) / size).astype(int)
+        rows = np.floor((ORIGIN - villages.bounds[valid, 3]) / size).astype(int)
+        for x, y in set(zip(cols.tolist(), rows.tolist())):
+            getTile(z, x, y)
+            count += 1
+    return count
+
+
+def villagesWithin(bbox):
+    """Villages intersecting a lon/lat bbox (west, south, east, north), from the snapshot when there is one
+    """
+    villages = loadVillages()
+    if villages is None:
+        region = ee.Geometry.Rectangle([float(v) for v in bbox])
+        return ee_client.getInfo(getLayer('village').filterBounds(region))['features']
+    x0, y0 = _mercator(float(bbox[0]), float(bbox[1]))
+    x1, y1 = _mercator(float(bbox[2]), float(bbox[3]))
+    return [villages.features[i] for i in villages.within((x0, y0, x1, y1))]